@@ -157,6 +157,7 @@ def get_args_iko():
     ## TRUE LIKELIHOOD
     parser.add_argument("--gtl-src", help="source of GTL", choices=['ld', 'hd-cos','hd-corr'], default='hd-cos')
     parser.add_argument("--gtl-output", choices=['softmax','softermax','linear'], default='softmax')
+    parser.add_argument("--scan-storage", help="dtype of the reference scans: float64, float16 ranges or uint16 millimetres", choices=['float64','float16','mm'], default='float64')
 
 
     ## LM-GENERAL
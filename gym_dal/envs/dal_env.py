@@ -51,6 +51,9 @@ from torchvision.models.densenet import densenet121, densenet169, densenet201, d
 
 from networks import intrinsic_model
 from networks import policy_A3C
+from sim.scan_bank import scan_array, encode_scans, decode_scans
+from sim.utils import scan_2d_n_headings
+from sim.belief import BeliefFilter
 
 def shift(grid, d, axis=None, fill = 0.5):
 	grid = np.roll(grid, d, axis=axis)
@@ -263,8 +266,8 @@ class DalEnv(gym.Env):
 		self.sigma_theta = self.heading_resol * 0.1
 			
 
-		self.scans_over_map = np.zeros((self.grid_rows,self.grid_cols,360))
-		self.scans_over_map_high = np.zeros((self.map_rows, self.map_cols, 360))
+		self.scans_over_map = scan_array((self.grid_rows,self.grid_cols,360), self.args.scan_storage)
+		self._scans_over_map_high = None # map_rows x map_cols x 360, allocated on first use
 
 		self.scan_2d = np.zeros((self.map_rows, self.map_cols))
 		self.scan_2d_low = np.zeros((self.grid_rows, self.grid_cols))
@@ -287,8 +290,10 @@ class DalEnv(gym.Env):
 		self.gt_likelihood_unnormalized_high = np.ones((self.grid_dirs, self.grid_rows, self.grid_cols))
 
 		# self.belief = torch.ones((self.grid_dirs,self.map_rows, self.map_cols),device=torch.device(self.device))
-		self.belief = torch.ones((self.grid_dirs, self.grid_rows, self.grid_cols), device=torch.device(self.device))
-		self.belief = self.belief / self.belief.sum()
+		# a filter of one episode: self.belief is its batch entry 0 (see the belief property)
+		self.bel_filter = BeliefFilter(1, self.grid_dirs, self.grid_rows, self.grid_cols, device=torch.device(self.device),
+									   rot_step=self.args.rot_step, fwd_step=self.args.fwd_step,
+									   trans_belief=self.args.trans_belief, sigma_xy=self.sigma_xy)
 
 		self.loss_policy = 0
 		self.loss_value = 0
@@ -307,6 +312,7 @@ class DalEnv(gym.Env):
 		#grid pose
 		self.true_grid = Grid(head=0,row=0,col=0)
 		self.bel_grid = Grid(head=0,row=0,col=0)
+		self.bel_stats = None # see product_belief
 
 
 		self.reward_block_penalty = 0
@@ -357,8 +363,8 @@ class DalEnv(gym.Env):
 		self.rewards = []
 		self.manhattans=[]
 		self.reward = 0
-		self.explored_space = np.zeros((self.grid_dirs,self.grid_rows, self.grid_cols),dtype='float')
-		self.bel_list = []
+		self.explored = set() # (head, row, col) of the true poses visited in this episode
+		self.bel_set = set() # (head, row, col) of the argmax of the belief in this episode
 
 		self.state[0,:,:] = self.map_design
 		ding = self.belief.detach().cpu().numpy()
@@ -367,9 +373,23 @@ class DalEnv(gym.Env):
 
 		return self.state
 
+	@property
+	def belief(self):
+		return self.bel_filter.belief[0]
+
+	@belief.setter
+	def belief(self, bel):
+		self.bel_filter.belief = bel.unsqueeze(0)
+
 	@property
 	def steps_remaining(self):
 		return self.max_steps - self.step_count
+
+	@property
+	def scans_over_map_high(self):
+		if self._scans_over_map_high is None:
+			self._scans_over_map_high = scan_array((self.map_rows, self.map_cols, 360), self.args.scan_storage)
+		return self._scans_over_map_high
 	
 
 	def reset_pose(self):
@@ -379,8 +399,7 @@ class DalEnv(gym.Env):
 		self.step_count = 0
 
 		# reset belief too
-		self.belief[:,:,:]=1.0
-		self.belief /= self.belief.sum()#np.sum(self.belief, dtype=float)
+		self.bel_filter.reset()
 
 		done = False
 
@@ -440,11 +459,9 @@ class DalEnv(gym.Env):
 									'reward_inv_dist': self.reward_inv_dist }
 
 	def update_explored(self):
-		if self.explored_space[self.true_grid.head,self.true_grid.row, self.true_grid.col] == 0.0:
-			self.new_pose = True
-		else:
-			self.new_pose = False
-		self.explored_space[self.true_grid.head,self.true_grid.row, self.true_grid.col] = 1.0
+		pose = (self.true_grid.head, self.true_grid.row, self.true_grid.col)
+		self.new_pose = pose not in self.explored
+		self.explored.add(pose)
 		return
 
 	def compute_gtl(self):
@@ -482,9 +499,14 @@ class DalEnv(gym.Env):
 		y = np.clip(y, self.min_scan_range, self.max_scan_range)
 		# y[y==np.inf]= self.max_scan_range
 
+		if self._scans_over_map_high is None:
+			# never filled (see get_synth_scan): the same zero scans without allocating the high-res bank
+			scans_high = np.zeros((self.grid_rows, self.grid_cols, 360), dtype=self.scans_over_map.dtype)
+		else:
+			scans_high = self.scans_over_map_high
 		for heading in range(self.grid_dirs):  ## that is, each direction
 			#compute cosine similarity at each loc
-			X = np.roll(self.scans_over_map_high, int(-offset*heading),axis=2)[:,:,::self.args.pm_scan_step]
+			X = decode_scans(np.roll(scans_high, int(-offset*heading),axis=2)[:,:,::self.args.pm_scan_step])
 			for i_ld in range(self.grid_rows):
 				for j_ld in range(self.grid_cols):
 					if (i_ld*self.map_cols+j_ld == self.taken).any():
@@ -507,7 +529,7 @@ class DalEnv(gym.Env):
 		# y[y==np.inf]= self.max_scan_range
 		for heading in range(self.grid_dirs):  ## that is, each direction
 			#compute cosine similarity at each loc
-			X = np.roll(self.scans_over_map, -offset*heading,axis=2)[:,:,::self.args.pm_scan_step]
+			X = decode_scans(np.roll(self.scans_over_map, -offset*heading,axis=2)[:,:,::self.args.pm_scan_step])
 			for i_ld in range(self.grid_rows):
 				for j_ld in range(self.grid_cols):
 					if (i_ld*self.grid_cols+j_ld == self.taken).any():
@@ -527,10 +549,11 @@ class DalEnv(gym.Env):
 			x_real = to_real(row_ld, self.xlim, self.grid_rows ) # from low-dim location to real
 			y_real = to_real(col_ld, self.ylim, self.grid_cols ) # from low-dim location to real
 			scan = self.get_a_scan(x_real, y_real,scan_step=self.args.pm_scan_step)
-			self.scans_over_map[row_ld, col_ld,:] = np.clip(scan, 1e-10, self.max_scan_range)
+			self.scans_over_map[row_ld, col_ld,:] = encode_scans(np.clip(scan, 1e-10, self.max_scan_range), self.scans_over_map.dtype)
 			# if i_place%10==0: print ('.')
 
 		## Uncomment the following if you want scans_over_map at high resolution.
+		## (sim/parallel.py build_scan_bank makes the same bank in parallel into a resumable .npy file)
 		# n_places = self.map_rows * self.map_cols
 		# for i_place in range(n_places):
 		#     row_ld = i_place // self.map_rows
@@ -538,7 +561,7 @@ class DalEnv(gym.Env):
 		#     x_real = to_real(row_ld, self.xlim, self.map_rows ) # from low-dim location to real
 		#     y_real = to_real(col_ld, self.ylim, self.map_cols ) # from low-dim location to real
 		#     scan = self.get_a_scan(x_real, y_real,scan_step=self.args.pm_scan_step)
-		#     self.scans_over_map_high[row_ld, col_ld,:] = np.clip(scan, 1e-10, self.max_scan_range)
+		#     self.scans_over_map_high[row_ld, col_ld,:] = encode_scans(np.clip(scan, 1e-10, self.max_scan_range), self.scans_over_map_high.dtype)
 		#     if i_place%100==0: print ('.')
 
 
@@ -826,23 +849,10 @@ class DalEnv(gym.Env):
 		O=self.grid_dirs
 		N=self.map_rows
 		M=self.map_cols
-		self.scan_2d = np.zeros(shape=(O,N,M))
 		# self.scan_2d_rotate = np.zeros(shape=(O,N,M))
-		angles = np.linspace(data.angle_min, data.angle_max, data.ranges.size, endpoint=False)
-
-		for i,dist in enumerate(data.ranges):
-			for rotate in range(O):
-				offset = 2*np.pi/O*rotate
-				angle = offset + angles[i]
-				if angle > math.radians(self.args.fov[0]) and angle < math.radians(self.args.fov[1]):
-					continue
-				if ~np.isinf(dist):
-					x = (dist)*np.cos(angle)
-					y = (dist)*np.sin(angle)
-					n = to_index(x, N, self.xlim)
-					m = to_index(y, M, self.ylim)
-					if n>=0 and n<N and m>0 and m<M:
-						self.scan_2d[rotate,n,m] = 1.0
+		# all rays of all headings at once, refilling the last scan_2d when it has this shape
+		self.scan_2d = scan_2d_n_headings(data.ranges, data.angle_min, data.angle_max, O, (N,M), self.xlim, self.ylim,
+										  self.args.fov, out=self.scan_2d)
 
 		rows1 = self.args.n_state_grids
 		cols1 = self.args.n_state_grids
@@ -898,15 +908,11 @@ class DalEnv(gym.Env):
 
 		
 	def product_belief(self):
-		if type(self.belief) is np.ndarray:
-			self.belief = torch.from_numpy(self.belief).float().to(self.device)
-		self.belief = self.belief * (self.likelihood)
-
-		#normalize belief
-		self.belief /= self.belief.sum()
-		#update bel_grid
-		guess = np.unravel_index(np.argmax(self.belief.cpu().detach().numpy(), axis=None), self.belief.shape)
-		self.bel_grid = Grid(head=guess[0],row=guess[1],col=guess[2])
+		self.bel_filter.update(self.likelihood)
+		#update bel_grid, and what get_reward needs of the belief: one pass on the device, one transfer
+		true_pose = [[int(self.true_grid.head), int(self.true_grid.row), int(self.true_grid.col)]]
+		self.bel_stats = dict(zip(BeliefFilter.STATS, self.bel_filter.stats(true_pose)[0].tolist()))
+		self.bel_grid = Grid(head=int(self.bel_stats['head']),row=int(self.bel_stats['row']),col=int(self.bel_stats['col']))
 	   
 		
 	def update_target_pose(self):
@@ -1059,75 +1065,14 @@ class DalEnv(gym.Env):
 		return True
 
 	def transit_belief(self):
-		self.belief = self.belief.cpu().detach().numpy()
+		# the motion model of belief.TransitionModel. a blocked move leaves the belief as it is
 		if self.collision == True:
-			self.prior = np.copy(self.belief)
-			self.belief = torch.from_numpy(self.belief).float().to(self.device)
 			return
-
-		self.belief = self.trans_bel()
-		self.belief = torch.from_numpy(self.belief).float().to(self.device)#$ requires_grad=True)
-		if type(self.belief).__name__ == 'torch.CudaTensor':
-			self.belief = self.belief.cpu().numpy()
-		elif type(self.belief).__name__ == 'Tensor':
-			self.belief = self.belief.cpu().numpy()
-		else:
-			self.belief = self.belief
-		self.prior = np.copy(self.belief)
-
-	def trans_bel(self):
-		
-
-		rotation_step = self.args.rot_step
-
-		if self.action_name == "turn_right":
-			self.belief=np.roll(self.belief,-rotation_step, axis=0)
-		elif self.action_name == "turn_left":
-			self.belief=np.roll(self.belief, rotation_step, axis = 0)
-		elif self.action_name == "go_fwd":
-			if self.args.trans_belief == "roll":
-				self.belief[0,:,:]=np.roll(self.belief[0,:,:], -1, axis=0)
-				self.belief[1,:,:]=np.roll(self.belief[1,:,:], -1, axis=1)
-				self.belief[2,:,:]=np.roll(self.belief[2,:,:], 1, axis=0)
-				self.belief[3,:,:]=np.roll(self.belief[3,:,:], 1, axis=1)
-
-			elif self.args.trans_belief == "stoch-shift" or self.args.trans_belief == "shift":
-				prior = self.belief.min()
-				for i in range(self.grid_dirs):
-					theta = i * self.heading_resol
-					fwd_dist = self.args.fwd_step
-					dx = fwd_dist*np.cos(theta+np.pi)
-					dy = fwd_dist*np.sin(theta+np.pi)
-					# simpler way:
-					DX = np.round(dx)
-					DY = np.round(dy)
-					shft_hrz = shift(self.belief[i,:,:], int(DY), axis=1, fill=prior)
-					self.belief[i,:,:]=shift(shft_hrz, int(DX), axis=0, fill=prior)
-					
-
-		if self.args.trans_belief == "stoch-shift" and self.action_name != "hold":
-			for ch in range(self.grid_dirs):
-				self.belief[ch,:,:] = ndimage.gaussian_filter(self.belief[ch,:,:], sigma=self.sigma_xy)
-			
-			n_dir = self.grid_dirs//4
-			p_roll = 0.20
-			roll_n = []
-			roll_p = []
-			for r in range(1, n_dir):
-				if roll_n == [] and roll_p == []:
-					roll_n.append(p_roll*np.roll(bel,-1,axis=0))
-					roll_p.append(p_roll*np.roll(bel, 1,axis=0))
-				else:
-					roll_n.append(p_roll*np.roll(roll_n[-1],-1,axis=0))
-					roll_p.append(p_roll*np.roll(roll_p[-1], 1,axis=0))
-			self.belief = sum(roll_n + roll_p)+self.belief    
-			
-		self.belief /= np.sum(self.belief)
-		return self.belief
+		self.bel_filter.predict([self.action_name])
 
 	
 	def get_reward(self):
-		self.manhattan = self.get_manhattan(self.belief.cpu().detach().numpy()) #manhattan distance between gt and belief.
+		self.manhattan = self.bel_stats['manhattan'] #manhattan distance between gt and belief.
 		self.manhattans.append(self.manhattan)
 		self.reward = 0.0
 		# if self.args.penalty_for_block and self.action_name == "go_fwd_blocked":
@@ -1137,18 +1082,17 @@ class DalEnv(gym.Env):
 		else:
 			self.reward_block_penalty = 0.0
 
-		self.reward_bel_gt = torch.log(self.belief[self.true_grid.head,self.true_grid.row,self.true_grid.col]).cpu().detach().numpy()
+		# bel_stats is set in product_belief
+		with np.errstate(divide='ignore'):
+			self.reward_bel_gt = np.log(self.bel_stats['bel_gt'])
 		
-		self.reward_bel_gt_nonlog = self.belief[self.true_grid.head,self.true_grid.row,self.true_grid.col].cpu().detach().numpy()
+		self.reward_bel_gt_nonlog = self.bel_stats['bel_gt']
 		
-		bel = torch.clamp(self.belief, 1e-9, 1.0)
-		# info gain = p*log(p) - q*log(q)
-		infogain = (bel * torch.log(bel)).sum().detach() - self.bel_ent
-		self.bel_ent = (bel * torch.log(bel)).sum().detach()
-		self.reward_infogain = infogain.cpu().detach().numpy()
+		# info gain = p*log(p) - q*log(q), p clamped to [1e-9, 1]
+		self.reward_infogain = self.bel_stats['neg_ent_clamped'] - self.bel_ent
+		self.bel_ent = self.bel_stats['neg_ent_clamped']
 		
-		bel=self.belief
-		self.reward_bel_ent = (bel * torch.log(bel)).sum().cpu().detach().numpy()
+		self.reward_bel_ent = self.bel_stats['neg_ent']
 		
 		if self.manhattan == 0:
 			self.reward_hit = 1
@@ -1182,14 +1126,11 @@ class DalEnv(gym.Env):
 	def get_manhattan(self, bel):
 		guess = (self.bel_grid.head, self.bel_grid.row, self.bel_grid.col)
 		e_dir = abs(guess[0]-self.true_grid.head)
-		e_dir = min(4-e_dir, e_dir)
+		e_dir = min(self.grid_dirs-e_dir, e_dir)
 		return float(e_dir+abs(guess[1]-self.true_grid.row)+abs(guess[2]-self.true_grid.col))
 
 
 	def update_bel_list(self):
-		guess = self.bel_grid
-		if guess not in self.bel_list:
-			self.new_bel = True
-			self.bel_list.append(guess)
-		else:
-			self.new_bel = False
\ No newline at end of file
+		guess = (self.bel_grid.head, self.bel_grid.row, self.bel_grid.col)
+		self.new_bel = guess not in self.bel_set
+		self.bel_set.add(guess)
\ No newline at end of file
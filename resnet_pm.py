@@ -141,6 +141,58 @@ class ResNet(nn.Module):
         return x
 
 
+class SplitResNet(ResNet):
+    # the LM as two encoders, the stem and the first `split` layers of a ResNet each:
+    # a map encoder and a narrower one (scan_width) for the scan image, projected to the map features
+    # and added to them, then the remaining layers. the map features depend on the map only, so with
+    # a fixed model encode_map runs once per map and forward_scan once per step.
+    # forward(x) on the usual (n, 2, H, W) input (map, scan) is the same network, for training.
+    def __init__(self, block, layers, num_classes=11*11*4, split=3, scan_width=32):
+        nn.Module.__init__(self)
+        self.map_encoder = self._encoder(block, layers[:split], 64)
+        map_planes = self.inplanes
+        self.scan_encoder = self._encoder(block, layers[:split], scan_width)
+        self.scan_proj = nn.Sequential(nn.Conv2d(self.inplanes, map_planes, kernel_size=1, bias=False),
+                                       nn.BatchNorm2d(map_planes))
+        self.relu = nn.ReLU(inplace=True)
+        self.inplanes = map_planes
+        self.head = nn.Sequential(*[self._make_layer(block, 64 * 2 ** i, layers[i], stride=2) for i in range(split, 4)])
+        self.avgpool = nn.AdaptiveAvgPool2d(1)
+        self.fc = nn.Linear(512 * block.expansion, num_classes)
+
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d):
+                nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+            elif isinstance(m, nn.BatchNorm2d):
+                nn.init.constant_(m.weight, 1)
+                nn.init.constant_(m.bias, 0)
+
+    def _encoder(self, block, layers, width):
+        self.inplanes = width
+        modules = [nn.Conv2d(1, width, kernel_size=7, stride=2, padding=3, bias=False),
+                   nn.BatchNorm2d(width), nn.ReLU(inplace=True), nn.MaxPool2d(kernel_size=3, stride=2, padding=1)]
+        for i, blocks in enumerate(layers):
+            modules.append(self._make_layer(block, width * 2 ** i, blocks, stride=1 if i == 0 else 2))
+        return nn.Sequential(*modules)
+
+    def encode_map(self, map_img):
+        # (1, 1, H, W) map image to the features forward_scan takes
+        return self.map_encoder(map_img)
+
+    def forward_scan(self, scan_imgs, map_features):
+        # (n, 1, H, W) scan images, one per heading, on the map of map_features
+        x = self.relu(self.scan_proj(self.scan_encoder(scan_imgs)) + map_features)
+        x = self.head(x)
+        x = self.avgpool(x)
+        x = x.view(x.size(0), -1)
+        x = self.fc(x)
+
+        return x
+
+    def forward(self, x):
+        return self.forward_scan(x[:, 1:2], self.map_encoder(x[:, 0:1]))
+
+
 def resnet18(pretrained=False, **kwargs):
     """Constructs a ResNet-18 model.
     Args:
@@ -184,3 +236,46 @@ def resnet152(pretrained=False, **kwargs):
     """
     model = ResNet(Bottleneck, [3, 8, 36, 3], **kwargs)
     return model
+
+
+def split_resnet18(pretrained=False, **kwargs):
+    """Constructs a ResNet-18 LM with a cached map encoder, see SplitResNet.
+    """
+    model = SplitResNet(BasicBlock, [2, 2, 2, 2], **kwargs)
+    return model
+
+
+def split_resnet34(pretrained=False, **kwargs):
+    """Constructs a ResNet-34 LM with a cached map encoder, see SplitResNet.
+    """
+    model = SplitResNet(BasicBlock, [3, 4, 6, 3], **kwargs)
+    return model
+
+
+def split_resnet50(pretrained=False, **kwargs):
+    """Constructs a ResNet-50 LM with a cached map encoder, see SplitResNet.
+    """
+    model = SplitResNet(Bottleneck, [3, 4, 6, 3], **kwargs)
+    return model
+
+
+if __name__ == "__main__":
+    import time
+    import torch
+    # 4 headings on one map: the ResNet-18 LM against the split one with the map encoded once
+    torch.manual_seed(0)
+    x = torch.zeros(4, 2, 224, 224)
+    x[:, 0] = (torch.rand(224, 224) > 0.8).float()
+    x[:, 1] = (torch.rand(4, 224, 224) > 0.99).float()
+    joint = resnet18(num_classes=121).eval()
+    split = split_resnet18(num_classes=121).eval()
+    with torch.no_grad():
+        map_features = split.encode_map(x[:1, 0:1])
+        assert torch.allclose(split(x), split.forward_scan(x[:, 1:2], map_features), atol=1e-5)
+        for name, run in [('resnet18', lambda: joint(x)), ('split, map cached', lambda: split.forward_scan(x[:, 1:2], map_features)),
+                          ('split, map encoded', lambda: split.forward_scan(x[:, 1:2], split.encode_map(x[:1, 0:1])))]:
+            run()
+            mark = time.time()
+            for _ in range(5):
+                run()
+            print('%-18s %.4f sec per step' % (name, (time.time() - mark) / 5))
@@ -8,6 +8,10 @@
 # --RL-type: 0 for our original setup.
 # --load-map: load a map (nupy matrix) if you have one ('randombox' to use random box map)
 # --lidar-sigma: scale of gaussian noise to scan vector
+# --raycast: march (default, random 1~2 cm probe steps), dda (exact map cell traversal, deterministic ranges) or edt (march jumping by the map clearance, fastest on open maps)
+# --scan-cache DIR: keep the reference scans over the map (scans_over_map) in DIR by map content, and load them on the next run of the same map.
+# --scan-storage: float64 (default), float16 or mm (uint16 millimetres). the compact ones take a quarter of the memory, ~1 mm error.
+# --gtl-cache N: reuse the GTL of the last N (map, true grid pose) pairs. the unperturbed scan is then cast by dda, so reuse is exact.
 # --flip-map: num of random pixels to flip in the map
 # --distort-map: erode/dilate the map.
 # -f: show figure
@@ -0,0 +1,502 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import ndimage
+
+
+def shift_t(grid, d, dim, fill):
+    # torch version of shift in dal.py: roll by d along dim, the rows/cols rolled in set to fill
+    grid = torch.roll(grid, d, dims=dim)
+    if d > 0:
+        grid.narrow(dim, 0, d).fill_(fill)
+    elif d < 0:
+        grid.narrow(dim, grid.shape[dim] + d, -d).fill_(fill)
+    return grid
+
+
+def gaussian_kernel1d(sigma, truncate=4.0):
+    # the weights of ndimage.gaussian_filter
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    w = np.exp(-0.5 / sigma ** 2 * x ** 2)
+    return w / w.sum()
+
+
+def _pad_symmetric(x, r, dim):
+    # ndimage 'reflect' mode: d c b a | a b c d | d c b a
+    if r == 0:
+        return x
+    n = x.shape[dim]
+    return torch.cat([x.narrow(dim, 0, r).flip(dim), x, x.narrow(dim, n - r, r).flip(dim)], dim=dim)
+
+
+def gaussian_filter_t(bel, sigma):
+    # ndimage.gaussian_filter of every (H, W) slice of bel (..., H, W), as two 1-d convolutions
+    w = torch.tensor(gaussian_kernel1d(sigma), dtype=bel.dtype, device=bel.device)
+    r = (len(w) - 1) // 2
+    shape = bel.shape
+    x = bel.reshape(-1, 1, shape[-2], shape[-1])
+    x = F.conv2d(_pad_symmetric(x, r, 2), w.view(1, 1, -1, 1))
+    x = F.conv2d(_pad_symmetric(x, r, 3), w.view(1, 1, 1, -1))
+    return x.reshape(shape)
+
+
+def fwd_shifts(grid_dirs, fwd_step):
+    # (row, col) cells moved per heading by go_fwd
+    theta = np.arange(grid_dirs) * 2 * np.pi / grid_dirs
+    return (np.round(fwd_step * np.cos(theta + np.pi)).astype(int),
+            np.round(fwd_step * np.sin(theta + np.pi)).astype(int))
+
+
+class TransitionModel:
+    # the motion model compiled once per configuration, applied to a belief (grid_dirs, rows, cols)
+    # or a batch of them (..., grid_dirs, rows, cols) in one call: model(bel, action).
+    # per action it is at most a gather (the forward shift of each heading, fill cells marked),
+    # a (grid_dirs, grid_dirs) matrix over headings (the turn and the heading spread of stoch-shift)
+    # and the gaussian blur as (rows, rows) and (cols, cols) matrices, which are exact ndimage.gaussian_filter.
+    # "roll" wraps the forward shift around the map for any number of headings.
+    ACTIONS = ['turn_left', 'turn_right', 'go_fwd', 'hold']
+
+    def __init__(self, grid_dirs, rows, cols, rot_step=1, fwd_step=1, trans_belief='stoch-shift', sigma_xy=0.5,
+                 p_roll=0.20, device=None, dtype=torch.float32):
+        self.shape = (grid_dirs, rows, cols)
+        self.dtype = dtype
+        self.trans_belief = trans_belief
+        stoch = trans_belief == 'stoch-shift'
+        eye = np.eye(grid_dirs)
+        spread = np.copy(eye)
+        for r in range(1, grid_dirs // 4):
+            spread += p_roll ** r * (np.roll(eye, r, axis=1) + np.roll(eye, -r, axis=1))
+        turn = {'turn_right': np.roll(eye, rot_step, axis=1), 'turn_left': np.roll(eye, -rot_step, axis=1)}
+
+        def to_t(a):
+            return torch.as_tensor(a, dtype=dtype, device=device)
+
+        self.heading_op = {'turn_left': to_t(spread.dot(turn['turn_left']) if stoch else turn['turn_left']),
+                           'turn_right': to_t(spread.dot(turn['turn_right']) if stoch else turn['turn_right']),
+                           'go_fwd': to_t(spread) if stoch else None,
+                           'hold': None}
+        self.blur = None
+        if stoch:
+            # column j of the filtered identity is the filter of e_j: a matrix that is the filter
+            self.blur = (to_t(ndimage.gaussian_filter1d(np.eye(rows), sigma_xy, axis=0)),
+                         to_t(ndimage.gaussian_filter1d(np.eye(cols), sigma_xy, axis=0).T))
+        self.fwd_index = None
+        self.fwd_fill = None
+        if trans_belief in ['roll', 'shift', 'stoch-shift']:
+            DX, DY = fwd_shifts(grid_dirs, fwd_step)
+            h, r, c = np.meshgrid(np.arange(grid_dirs), np.arange(rows), np.arange(cols), indexing='ij')
+            src_r = r - DX[:, np.newaxis, np.newaxis]
+            src_c = c - DY[:, np.newaxis, np.newaxis]
+            fill = (src_r < 0) | (src_r >= rows) | (src_c < 0) | (src_c >= cols)
+            index = (h * rows + src_r % rows) * cols + src_c % cols
+            self.fwd_index = torch.as_tensor(index.ravel(), dtype=torch.long, device=device)
+            if trans_belief != 'roll' and fill.any():
+                self.fwd_fill = torch.as_tensor(fill.ravel(), device=device)
+
+    def __call__(self, bel, action):
+        shape = bel.shape
+        O, H, W = self.shape
+        if action == 'go_fwd' and self.fwd_index is not None:
+            flat = bel.reshape(-1, O * H * W)
+            out = flat[:, self.fwd_index]
+            if self.fwd_fill is not None:
+                prior = flat.min(dim=1, keepdim=True)[0]
+                out = torch.where(self.fwd_fill, prior.expand_as(out), out)
+            bel = out
+        op = self.heading_op[action]
+        if op is not None:
+            bel = torch.matmul(op, bel.reshape(-1, O, H * W))
+        if self.blur is not None and action != 'hold':
+            bel = torch.matmul(torch.matmul(self.blur[0], bel.reshape(-1, O, H, W)), self.blur[1])
+        bel = bel.reshape(shape)
+        return bel / bel.sum(dim=(-3, -2, -1), keepdim=True)
+
+
+def trans_bel_t(bel, action, grid_dirs, rot_step, fwd_step, trans_belief, sigma_xy, p_roll=0.20):
+    # the motion model of LocalizationNode.trans_bel on a torch belief (grid_dirs, rows, cols), op by op.
+    # TransitionModel does the same with operators made once; kept as the reference for the check below
+    bel = bel.clone()
+    if action == "turn_right":
+        bel = torch.roll(bel, -rot_step, dims=0)
+    elif action == "turn_left":
+        bel = torch.roll(bel, rot_step, dims=0)
+    elif action == "go_fwd":
+        if trans_belief == "roll":
+            bel[0] = torch.roll(bel[0], -1, dims=0)
+            bel[1] = torch.roll(bel[1], -1, dims=1)
+            bel[2] = torch.roll(bel[2], 1, dims=0)
+            bel[3] = torch.roll(bel[3], 1, dims=1)
+        elif trans_belief == "stoch-shift" or trans_belief == "shift":
+            prior = bel.min()
+            for i in range(grid_dirs):
+                theta = i * 2 * np.pi / grid_dirs
+                DX = int(np.round(fwd_step * np.cos(theta + np.pi)))
+                DY = int(np.round(fwd_step * np.sin(theta + np.pi)))
+                bel[i] = shift_t(shift_t(bel[i], DY, 1, prior), DX, 0, prior)
+
+    if trans_belief == "stoch-shift" and action != "hold":
+        bel = gaussian_filter_t(bel, sigma_xy)
+        out = bel.clone()
+        rolled_n = bel
+        rolled_p = bel
+        for r in range(1, grid_dirs // 4):
+            rolled_n = p_roll * torch.roll(rolled_n, -1, dims=0)
+            rolled_p = p_roll * torch.roll(rolled_p, 1, dims=0)
+            out = out + rolled_n + rolled_p
+        bel = out
+    return bel / bel.sum()
+
+
+class BeliefFilter:
+    # histogram Bayes filters of n episodes over (grid_dirs, rows, cols) poses, stepped in lockstep:
+    # belief is (n, grid_dirs, rows, cols) on the device and every method works on all episodes at once.
+    # the motion model is the given TransitionModel, or one made from the keyword arguments.
+    # columns of stats()
+    STATS = ['head', 'row', 'col', 'bel_gt', 'neg_ent', 'neg_ent_clamped', 'manhattan', 'xy_error']
+
+    def __init__(self, n, grid_dirs, rows, cols, transition=None, device=None, **kwargs):
+        self.shape = (grid_dirs, rows, cols)
+        self.device = device
+        if transition is None:
+            transition = TransitionModel(grid_dirs, rows, cols, device=device, **kwargs)
+        self.transition = transition
+        self.belief = None
+        self.reset(n)
+
+    def reset(self, n=None, index=None):
+        # uniform belief: n new episodes, or the episodes in index, or all
+        if n is not None:
+            self.belief = torch.ones((n,) + self.shape, dtype=self.transition.dtype, device=self.device)
+        elif index is None:
+            self.belief = torch.ones_like(self.belief)
+        else:
+            self.belief = self.belief.clone()
+            self.belief[index] = 1.0
+        self.belief = self.belief / self.belief.sum(dim=(1, 2, 3), keepdim=True)
+
+    def predict(self, actions):
+        # one action per episode, None to keep a belief as it is (a blocked move).
+        # the episodes with the same action go through the motion model in one call
+        bel = self.belief.detach()
+        out = bel.clone()
+        for action in set(a for a in actions if a is not None):
+            index = torch.tensor([i for i, a in enumerate(actions) if a == action], device=bel.device)
+            out[index] = self.transition(bel[index], action)
+        self.belief = out
+        return self.belief
+
+    def update(self, likelihoods):
+        # likelihoods (n, grid_dirs, rows, cols), or one for all episodes
+        bel = self.belief * likelihoods
+        self.belief = bel / bel.sum(dim=(1, 2, 3), keepdim=True)
+        return self.belief
+
+    def argmax(self):
+        # (n, 3): head, row, col of the most likely pose of each episode
+        _, rows, cols = self.shape
+        flat = torch.argmax(self.belief.detach().reshape(self.belief.shape[0], -1), dim=1)
+        return torch.stack((flat // (rows * cols), (flat // cols) % rows, flat % cols), dim=1)
+
+    def entropy(self):
+        # (n,) -sum(p log p), 0 log 0 = 0
+        bel = self.belief
+        return -torch.where(bel > 0, bel * torch.log(bel), torch.zeros_like(bel)).sum(dim=(1, 2, 3))
+
+    def manhattan(self, true_poses, ignore_hd=False):
+        # (n,) manhattan distance of the argmax to true_poses (n, 3), the heading error wrapped around
+        true_poses = torch.as_tensor(true_poses, device=self.belief.device)
+        err = torch.abs(self.argmax() - true_poses)
+        e_dir = torch.min(self.shape[0] - err[:, 0], err[:, 0])
+        if ignore_hd:
+            e_dir = e_dir * 0
+        return (e_dir + err[:, 1] + err[:, 2]).float()
+
+    def stats(self, true_poses):
+        # (n, len(STATS)) in one pass on the device: the argmax pose, the belief at true_poses (n, 3),
+        # sum p log p as is and with p clamped to [1e-9, 1], and the manhattan error of the argmax
+        # with and without the heading. one .tolist() brings all of it to the host
+        bel = self.belief.detach()
+        n = bel.shape[0]
+        dirs, rows, cols = self.shape
+        true_poses = torch.as_tensor(true_poses, device=bel.device).long().view(n, 3)
+        flat = bel.reshape(n, -1)
+        guess = self.argmax()
+        bel_gt = flat.gather(1, ((true_poses[:, 0] * rows + true_poses[:, 1]) * cols + true_poses[:, 2])[:, None])[:, 0]
+        clamped = torch.clamp(flat, 1e-9, 1.0)
+        err = torch.abs(guess - true_poses)
+        xy_error = err[:, 1] + err[:, 2]
+        manhattan = torch.min(dirs - err[:, 0], err[:, 0]) + xy_error
+        return torch.cat((guess.to(bel.dtype), torch.stack((bel_gt, (flat * torch.log(flat)).sum(dim=1),
+                                                            (clamped * torch.log(clamped)).sum(dim=1),
+                                                            manhattan.to(bel.dtype), xy_error.to(bel.dtype)), dim=1)), dim=1)
+
+
+class BeliefWindow:
+    # a finer belief (grid_dirs, cells*sub, cells*sub) over a window of cells x cells grid cells
+    # of a BeliefFilter of one episode, each grid cell split into sub x sub.
+    # it has its own motion model at that resolution and takes a likelihood of its own cells only,
+    # so its cost does not grow with the map. after an update it is pooled back to grid cells and replaces
+    # the grid belief under the window, which keeps its mass there: the belief the node reads is refined by it.
+    # the window moves, in whole grid cells, when the mode of the grid belief comes within margin cells
+    # of its edge. the fine cells it moves onto start from the grid belief, the overlap is kept.
+    def __init__(self, bel_filter, cells, sub, margin=1, rot_step=1, fwd_step=1, trans_belief='stoch-shift',
+                 sigma_xy=0.5, p_roll=0.20):
+        dirs, rows, cols = bel_filter.shape
+        self.bel_filter = bel_filter
+        self.cells = min(cells, rows, cols)
+        self.sub = sub
+        self.margin = margin
+        n = self.cells * sub
+        self.shape = (dirs, n, n)
+        # roll would wrap the window onto itself: shift it
+        self.transition = TransitionModel(dirs, n, n, rot_step=rot_step, fwd_step=fwd_step * sub,
+                                          trans_belief='shift' if trans_belief == 'roll' else trans_belief,
+                                          sigma_xy=sigma_xy * sub, p_roll=p_roll, device=bel_filter.device,
+                                          dtype=bel_filter.transition.dtype)
+        self.origin = (0, 0)
+        self.belief = None
+        self.reset()
+
+    def from_grid(self, origin):
+        # the grid belief under a window at origin, spread evenly over the fine cells
+        r0, c0 = origin
+        K = self.cells
+        bel = self.bel_filter.belief[0].detach()[:, r0:r0 + K, c0:c0 + K]
+        return bel.repeat_interleave(self.sub, dim=1).repeat_interleave(self.sub, dim=2) / self.sub ** 2
+
+    def place(self, row, col):
+        # origin of the window centered on the grid cell (row, col), inside the grid
+        _, rows, cols = self.bel_filter.shape
+        K = self.cells
+        return (int(np.clip(row - K // 2, 0, rows - K)), int(np.clip(col - K // 2, 0, cols - K)))
+
+    def reset(self):
+        # on the mode of the grid belief (on reset, the center of the grid)
+        _, rows, cols = self.bel_filter.shape
+        self.origin = self.place(rows // 2, cols // 2)
+        bel = self.from_grid(self.origin)
+        self.belief = bel / bel.sum()
+
+    def fine_cells(self):
+        # rows and cols of the window on the fine grid (rows*sub, cols*sub)
+        r0, c0 = self.origin
+        n = self.cells * self.sub
+        return np.arange(r0 * self.sub, r0 * self.sub + n), np.arange(c0 * self.sub, c0 * self.sub + n)
+
+    def predict(self, action):
+        if action is None:
+            return
+        self.belief = self.transition(self.belief, action)
+
+    def update(self, likelihood):
+        # likelihood (grid_dirs, cells*sub, cells*sub) of the fine cells of the window
+        bel = self.belief * likelihood
+        self.belief = bel / bel.sum()
+        self.fold()
+        self.recenter()
+
+    def fold(self):
+        dirs, n, _ = self.shape
+        r0, c0 = self.origin
+        K = self.cells
+        grid = self.bel_filter.belief[0]
+        pooled = self.belief.view(dirs, K, self.sub, K, self.sub).sum(dim=(2, 4))
+        grid = grid.clone()
+        grid[:, r0:r0 + K, c0:c0 + K] = pooled * grid[:, r0:r0 + K, c0:c0 + K].sum()
+        self.bel_filter.belief = grid.unsqueeze(0)
+
+    def recenter(self):
+        _, row, col = self.bel_filter.argmax()[0].tolist()
+        r0, c0 = self.origin
+        K = self.cells
+        lo, hi = self.margin, K - 1 - self.margin
+        if lo <= row - r0 <= hi and lo <= col - c0 <= hi:
+            return
+        origin = self.place(row, col)
+        if origin == self.origin:
+            return
+        # in grid belief units: the old window is the pooled grid belief under it, in detail
+        mass = self.bel_filter.belief[0].detach()[:, r0:r0 + K, c0:c0 + K].sum()
+        bel = self.from_grid(origin)
+        s = self.sub
+        dr, dc = (origin[0] - r0) * s, (origin[1] - c0) * s
+        n = K * s
+        src_r, src_c = slice(max(dr, 0), n + min(dr, 0)), slice(max(dc, 0), n + min(dc, 0))
+        dst_r, dst_c = slice(max(-dr, 0), n + min(-dr, 0)), slice(max(-dc, 0), n + min(-dc, 0))
+        bel[:, dst_r, dst_c] = self.belief[:, src_r, src_c] * mass
+        self.origin = origin
+        self.belief = bel / bel.sum()
+
+    def argmax(self):
+        # head, row, col of the mode of the window on the fine grid (rows*sub, cols*sub)
+        dirs, n, _ = self.shape
+        flat = int(torch.argmax(self.belief))
+        rows, cols = self.fine_cells()
+        return flat // (n * n), int(rows[(flat // n) % n]), int(cols[flat % n])
+
+
+if __name__ == "__main__":
+    # against the numpy motion model of dal.py
+    from scipy import ndimage
+
+    def shift(grid, d, axis=None, fill=0.5):
+        grid = np.roll(grid, d, axis=axis)
+        if axis == 0:
+            if d > 0:
+                grid[:d, :] = fill
+            elif d < 0:
+                grid[d:, :] = fill
+        elif axis == 1:
+            if d > 0:
+                grid[:, :d] = fill
+            elif d < 0:
+                grid[:, d:] = fill
+        return grid
+
+    def trans_bel(bel, action, grid_dirs, rot_step, fwd_step, trans_belief, sigma_xy):
+        if action == "turn_right":
+            bel = np.roll(bel, -rot_step, axis=0)
+        elif action == "turn_left":
+            bel = np.roll(bel, rot_step, axis=0)
+        elif action == "go_fwd":
+            if trans_belief == "roll":
+                bel[0, :, :] = np.roll(bel[0, :, :], -1, axis=0)
+                bel[1, :, :] = np.roll(bel[1, :, :], -1, axis=1)
+                bel[2, :, :] = np.roll(bel[2, :, :], 1, axis=0)
+                bel[3, :, :] = np.roll(bel[3, :, :], 1, axis=1)
+            else:
+                prior = bel.min()
+                for i in range(grid_dirs):
+                    theta = i * 2 * np.pi / grid_dirs
+                    DX = np.round(fwd_step * np.cos(theta + np.pi))
+                    DY = np.round(fwd_step * np.sin(theta + np.pi))
+                    shft_hrz = shift(bel[i, :, :], int(DY), axis=1, fill=prior)
+                    bel[i, :, :] = shift(shft_hrz, int(DX), axis=0, fill=prior)
+        if trans_belief == "stoch-shift" and action != "hold":
+            for ch in range(grid_dirs):
+                bel[ch, :, :] = ndimage.gaussian_filter(bel[ch, :, :], sigma=sigma_xy)
+            roll_n = []
+            roll_p = []
+            for r in range(1, grid_dirs // 4):
+                if roll_n == [] and roll_p == []:
+                    roll_n.append(0.2 * np.roll(bel, -1, axis=0))
+                    roll_p.append(0.2 * np.roll(bel, 1, axis=0))
+                else:
+                    roll_n.append(0.2 * np.roll(roll_n[-1], -1, axis=0))
+                    roll_p.append(0.2 * np.roll(roll_p[-1], 1, axis=0))
+            bel = sum(roll_n + roll_p) + bel
+        bel /= np.sum(bel)
+        return bel
+
+    for dirs, mode in [(4, 'roll'), (4, 'stoch-shift'), (36, 'stoch-shift'), (8, 'shift')]:
+        bel = np.random.rand(dirs, 11, 11)
+        bel /= bel.sum()
+        for action in ['turn_left', 'turn_right', 'go_fwd', 'hold']:
+            ref = trans_bel(bel.copy(), action, dirs, 1, 1, mode, 0.5)
+            out = trans_bel_t(torch.from_numpy(bel), action, dirs, 1, 1, mode, 0.5).numpy()
+            assert np.allclose(ref, out), (dirs, mode, action)
+        print('%d headings, %s: same as numpy' % (dirs, mode))
+    # the compiled operators, and roll at any number of headings
+    import time
+    for dirs, mode in [(4, 'roll'), (4, 'stoch-shift'), (36, 'stoch-shift'), (8, 'shift'), (4, 'shift')]:
+        bel = torch.rand(dirs, 11, 11, dtype=torch.float64)
+        bel /= bel.sum()
+        model = TransitionModel(dirs, 11, 11, trans_belief=mode, dtype=torch.float64)
+        t_ref = t_op = 0
+        for action in TransitionModel.ACTIONS:
+            mark = time.time()
+            for _ in range(100):
+                ref = trans_bel_t(bel, action, dirs, 1, 1, mode, 0.5)
+            t_ref += (time.time() - mark) / 400
+            mark = time.time()
+            for _ in range(100):
+                out = model(bel, action)
+            t_op += (time.time() - mark) / 400
+            assert torch.allclose(ref, out), (dirs, mode, action)
+        print('%d headings, %s: compiled %.5f sec, op by op %.5f sec per action' % (dirs, mode, t_op, t_ref))
+        batch = torch.stack([bel, torch.roll(bel, 1, dims=0)])
+        assert torch.allclose(model(batch, 'go_fwd')[1], model(batch[1], 'go_fwd'))
+    bel = torch.rand(8, 11, 11, dtype=torch.float64)
+    out = TransitionModel(8, 11, 11, trans_belief='roll', dtype=torch.float64)(bel, 'go_fwd')
+    assert torch.allclose(out[2] * bel.sum(), torch.roll(bel[2], -1, dims=1))
+
+    # a batch of episodes in lockstep against one filter per episode
+    n, dirs = 16, 8
+    batch = BeliefFilter(n, dirs, 11, 11, trans_belief='stoch-shift', dtype=torch.float64)
+    singles = [BeliefFilter(1, dirs, 11, 11, transition=batch.transition) for _ in range(n)]
+    truth = torch.stack([torch.randint(0, m, (n,)) for m in (dirs, 11, 11)], dim=1)
+    t_batch = t_singles = 0
+    for step in range(10):
+        actions = [TransitionModel.ACTIONS[a] for a in np.random.randint(4, size=n)]
+        actions[0] = None
+        likelihoods = torch.rand(n, dirs, 11, 11, dtype=torch.float64)
+        mark = time.time()
+        batch.predict(actions)
+        batch.update(likelihoods)
+        t_batch += time.time() - mark
+        mark = time.time()
+        for i in range(n):
+            singles[i].predict(actions[i:i + 1])
+            singles[i].update(likelihoods[i:i + 1])
+        t_singles += time.time() - mark
+    print('%d episodes x 10 steps: lockstep %.4f sec, one by one %.4f sec' % (n, t_batch, t_singles))
+    assert torch.allclose(batch.belief, torch.cat([f.belief for f in singles]))
+    bel = batch.belief.numpy()
+    for i in range(n):
+        guess = np.unravel_index(np.argmax(bel[i]), bel[i].shape)
+        assert tuple(batch.argmax()[i].tolist()) == guess
+        e_dir = min(abs(guess[0] - truth[i, 0].item()), dirs - abs(guess[0] - truth[i, 0].item()))
+        assert batch.manhattan(truth)[i].item() == e_dir + abs(guess[1] - truth[i, 1].item()) + abs(guess[2] - truth[i, 2].item())
+        assert np.isclose(batch.entropy()[i].item(), -(bel[i] * np.log(bel[i])).sum())
+        stats = dict(zip(BeliefFilter.STATS, batch.stats(truth)[i].tolist()))
+        assert [stats['head'], stats['row'], stats['col']] == list(guess)
+        assert stats['manhattan'] == batch.manhattan(truth)[i].item()
+        assert stats['xy_error'] == batch.manhattan(truth, ignore_hd=True)[i].item()
+        assert np.isclose(stats['bel_gt'], bel[i][tuple(truth[i].tolist())])
+        assert np.isclose(stats['neg_ent'], -batch.entropy()[i].item())
+        assert np.isclose(stats['neg_ent_clamped'], (np.clip(bel[i], 1e-9, 1) * np.log(np.clip(bel[i], 1e-9, 1))).sum())
+    batch.reset(index=[1, 2])
+    assert torch.allclose(batch.belief[1], torch.full((dirs, 11, 11), 1.0 / (dirs * 121), dtype=torch.float64))
+
+    # a window over the whole grid at sub 1 is the grid filter
+    grid = BeliefFilter(1, 8, 11, 11, trans_belief='stoch-shift', dtype=torch.float64)
+    ref = BeliefFilter(1, 8, 11, 11, transition=grid.transition)
+    window = BeliefWindow(grid, 11, 1)
+    for step in range(10):
+        action = TransitionModel.ACTIONS[np.random.randint(4)]
+        likelihood = torch.rand(8, 11, 11, dtype=torch.float64)
+        for f in [grid, ref]:
+            f.predict([action])
+            f.update(likelihood)
+        window.predict(action)
+        window.update(likelihood)
+        assert torch.allclose(grid.belief, ref.belief)
+    # a 5x5 window at 4x follows a robot going forward at heading 2 (-1 col per step), at the same cost on any grid
+    for size in [11, 33, 99]:
+        grid = BeliefFilter(1, 8, size, size, trans_belief='stoch-shift', dtype=torch.float64)
+        window = BeliefWindow(grid, 5, 4)
+        row, col = size // 3, size - 2
+        t_window = 0
+        for step in range(9):
+            if step > 0:
+                col -= 1
+                grid.predict(['go_fwd'])
+                mark = time.time()
+                window.predict('go_fwd')
+                t_window += time.time() - mark
+            peak = torch.full((8, size, size), 1e-3, dtype=torch.float64)
+            peak[2, row, col] = 1.0
+            grid.update(peak)
+            mark = time.time()
+            rows, cols = window.fine_cells()
+            fine = torch.full(window.shape, 1e-3, dtype=torch.float64)
+            fine[2, np.flatnonzero(rows == row * 4 + 1)[:, None], np.flatnonzero(cols == col * 4 + 2)] = 1.0
+            window.update(fine)
+            t_window += time.time() - mark
+            assert np.isclose(grid.belief.sum().item(), 1.0)
+            r0, c0 = window.origin
+            assert r0 + 1 <= row <= r0 + 3 and c0 + 1 <= col <= c0 + 3, (step, (row, col), window.origin)
+        print('%dx%d grid: 5x5 window at 4x %.5f sec per step' % (size, size, t_window / 9))
+        assert window.argmax() == (2, row * 4 + 1, col * 4 + 2)
+        assert grid.argmax()[0].tolist() == [2, row, col]
@@ -6,6 +6,12 @@ from move_base_msgs.msg import *
 from sim.utils import *
 from random_box_map import *
 from navi import *
+from raycast import cast_scan, clearance_map
+from scan_bank import scan_bank_key, scan_bank_path, load_scan_bank, save_scan_bank, scan_array, encode_scans
+from parallel import WorkerPool, build_scan_bank
+from belief import TransitionModel, BeliefFilter, BeliefWindow
+from particle_filter import ParticleFilter
+from gtl import cosine_sim, corr, gtl_cos, gtl_cos_fft, bank_spectra, cos_bank, gtl_cos_bank, gtl_cos_at, sparse_top_k, sparse_to_dense
 
 from sensor_msgs.msg import LaserScan
 from nav_msgs.msg import Odometry
@@ -21,6 +27,7 @@ import pdb
 import glob
 import os
 import multiprocessing 
+import tempfile
 import errno
 import re
 import time
@@ -44,6 +51,7 @@ from copy import deepcopy
 from networks import policy_A3C
 
 from resnet_pm import resnet18, resnet34, resnet50, resnet101, resnet152
+from resnet_pm import split_resnet18, split_resnet34, split_resnet50
 from torchvision.models.resnet import resnet18 as resnet18s
 from torchvision.models.resnet import resnet34 as resnet34s
 from torchvision.models.resnet import resnet50 as resnet50s
@@ -125,8 +133,112 @@ class Lidar():
         
 
 
+def perceptual_model_from_args(args):
+    # the LM of --pm-net, with the weights of --pm-model and the output layer of --n-pre-classes. None for "none"
+    num_dirs = 1
+
+    num_classes = args.n_lm_grids ** 2 * num_dirs
+    final_num_classes = num_classes
+      
+    if args.n_pre_classes is not None:
+        num_classes = args.n_pre_classes
+    else:
+        num_classes = final_num_classes
+
+    if args.pm_net == "none":
+        model = None
+    elif args.pm_net == "densenet121":
+        model = densenet121(pretrained = args.use_pretrained, drop_rate = args.drop_rate)
+        num_ftrs = model.classifier.in_features # 1024
+        model.classifier = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "densenet169":
+        model = densenet169(pretrained = args.use_pretrained, drop_rate = args.drop_rate)
+        num_ftrs = model.classifier.in_features # 1664
+        model.classifier = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "densenet201":
+        model = densenet201(pretrained = args.use_pretrained, drop_rate = args.drop_rate)
+        num_ftrs = model.classifier.in_features # 1920
+        model.classifier = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "densenet161":
+        model = densenet161(pretrained = args.use_pretrained, drop_rate = args.drop_rate)
+        num_ftrs = model.classifier.in_features # 2208
+        model.classifier = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "resnet18s":
+        model = resnet18s(pretrained=args.use_pretrained)
+        num_ftrs = model.fc.in_features
+        model.fc = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "resnet34s":
+        model = resnet34s(pretrained=args.use_pretrained)
+        num_ftrs = model.fc.in_features
+        model.fc = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "resnet50s":
+        model = resnet50s(pretrained=args.use_pretrained)
+        num_ftrs = model.fc.in_features
+        model.fc = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "resnet101s":
+        model = resnet101s(pretrained=args.use_pretrained)
+        num_ftrs = model.fc.in_features
+        model.fc = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "resnet152s":
+        model = resnet152s(pretrained=args.use_pretrained)
+        num_ftrs = model.fc.in_features
+        model.fc = nn.Linear(num_ftrs, num_classes)
+    elif args.pm_net == "resnet18":
+        model = resnet18(num_classes = num_classes)
+        num_ftrs = model.fc.in_features
+    elif args.pm_net == "resnet34":
+        model = resnet34(num_classes = num_classes)
+        num_ftrs = model.fc.in_features
+    elif args.pm_net == "resnet50":
+        model = resnet50(num_classes = num_classes)
+        num_ftrs = model.fc.in_features
+    elif args.pm_net == "resnet101":
+        model = resnet101(num_classes = num_classes)
+        num_ftrs = model.fc.in_features
+    elif args.pm_net == "resnet152":
+        model = resnet152(num_classes = num_classes)
+        num_ftrs = model.fc.in_features # 2048
+    elif args.pm_net == "split-resnet18":
+        model = split_resnet18(num_classes = num_classes)
+        num_ftrs = model.fc.in_features
+    elif args.pm_net == "split-resnet34":
+        model = split_resnet34(num_classes = num_classes)
+        num_ftrs = model.fc.in_features
+    elif args.pm_net == "split-resnet50":
+        model = split_resnet50(num_classes = num_classes)
+        num_ftrs = model.fc.in_features # 2048
+    else:
+        raise Exception('pm-net required: resnet or densenet')
+
+    if args.pm_model is not None and args.pm_model != "none":
+        state_dict = torch.load(args.pm_model)
+        new_state_dict = OrderedDict()
+
+        for k,v in state_dict.items():
+            if 'module.' in k:
+                name = k[7:]
+            else:
+                name = k
+            new_state_dict[name] = v
+        model.load_state_dict(new_state_dict)
+        print ('perceptual model %s is loaded.'%args.pm_model)
+
+
+    # change n-classes
+    if args.n_pre_classes is not None:
+        # resize the output layer:
+        new_num_classes = final_num_classes
+        if "resnet" in args.pm_net:
+            model.fc = nn.Linear(model.fc.in_features, new_num_classes, bias=True)
+        elif "densenet" in args.pm_net:
+            num_ftrs = model.classifier.in_features
+            model.classifier = nn.Linear(num_ftrs, new_num_classes)
+        print ('model: num_classes now changed to', new_num_classes)
+    return model
+
+
 class LocalizationNode(object):
-    def __init__(self, args):
+    def __init__(self, args, lm=None):
 
         self.next_action = None
         self.skip_to_end = False
@@ -163,101 +275,18 @@ class LocalizationNode(object):
         self.grid_cols = self.args.n_local_grids #self.args.map_size * self.args.sub_resolution
         self.grid_dirs = self.args.n_headings
 
-        num_dirs = 1
-
-        num_classes = self.args.n_lm_grids ** 2 * num_dirs
-        final_num_classes = num_classes
-          
-        if self.args.n_pre_classes is not None:
-            num_classes = self.args.n_pre_classes
-        else:
-            num_classes = final_num_classes
-
-        if self.args.pm_net == "none":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = None
-        elif self.args.pm_net == "densenet121":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = densenet121(pretrained = self.args.use_pretrained, drop_rate = self.args.drop_rate)
-            num_ftrs = self.perceptual_model.classifier.in_features # 1024
-            self.perceptual_model.classifier = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "densenet169":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = densenet169(pretrained = self.args.use_pretrained, drop_rate = self.args.drop_rate)
-            num_ftrs = self.perceptual_model.classifier.in_features # 1664
-            self.perceptual_model.classifier = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "densenet201":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = densenet201(pretrained = self.args.use_pretrained, drop_rate = self.args.drop_rate)
-            num_ftrs = self.perceptual_model.classifier.in_features # 1920
-            self.perceptual_model.classifier = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "densenet161":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = densenet161(pretrained = self.args.use_pretrained, drop_rate = self.args.drop_rate)
-            num_ftrs = self.perceptual_model.classifier.in_features # 2208
-            self.perceptual_model.classifier = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "resnet18s":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet18s(pretrained=self.args.use_pretrained)
-            num_ftrs = self.perceptual_model.fc.in_features
-            self.perceptual_model.fc = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "resnet34s":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet34s(pretrained=self.args.use_pretrained)
-            num_ftrs = self.perceptual_model.fc.in_features
-            self.perceptual_model.fc = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "resnet50s":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet50s(pretrained=self.args.use_pretrained)
-            num_ftrs = self.perceptual_model.fc.in_features
-            self.perceptual_model.fc = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "resnet101s":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet101s(pretrained=self.args.use_pretrained)
-            num_ftrs = self.perceptual_model.fc.in_features
-            self.perceptual_model.fc = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "resnet152s":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet152s(pretrained=self.args.use_pretrained)
-            num_ftrs = self.perceptual_model.fc.in_features
-            self.perceptual_model.fc = nn.Linear(num_ftrs, num_classes)
-        elif self.args.pm_net == "resnet18":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet18(num_classes = num_classes)
-            num_ftrs = self.perceptual_model.fc.in_features
-        elif self.args.pm_net == "resnet34":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet34(num_classes = num_classes)
-            num_ftrs = self.perceptual_model.fc.in_features
-        elif self.args.pm_net == "resnet50":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet50(num_classes = num_classes)
-            num_ftrs = self.perceptual_model.fc.in_features
-        elif self.args.pm_net == "resnet101":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet101(num_classes = num_classes)
-            num_ftrs = self.perceptual_model.fc.in_features
-        elif self.args.pm_net == "resnet152":
-            self.map_rows = 224
-            self.map_cols = 224
-            self.perceptual_model = resnet152(num_classes = num_classes)
-            num_ftrs = self.perceptual_model.fc.in_features # 2048
-        else:
-            raise Exception('pm-net required: resnet or densenet')
+        self.map_rows = 224
+        self.map_cols = 224
+        # lm: a client of an LMService (lm_service.py), which then runs the LM for this node
+        self.lm_client = lm
+        self.perceptual_model = perceptual_model_from_args(self.args) if lm is None else None
+        if lm is not None and self.args.update_pm_by != "NONE":
+            raise Exception('an LM service serves a fixed LM: --update-pm-by NONE')
+        if self.args.pm_net.startswith("split-") and self.args.ch3 in ("ZERO", "RAND"):
+            raise Exception('split LMs take the map and the scan only: no --ch3')
+        # split LMs with --update-pm-by NONE: the map features of lm_map, see split_lm_forward
+        self.lm_map = None
+        self.lm_map_features = None
 
 
         if self.args.RL_type == 0:
@@ -277,20 +306,6 @@ class LocalizationNode(object):
             self.args.pm_model = None
         
         # load models
-        if self.args.pm_model is not None:
-            state_dict = torch.load(self.args.pm_model)
-            new_state_dict = OrderedDict()
-
-            for k,v in state_dict.items():
-                if 'module.' in k:
-                    name = k[7:]
-                else:
-                    name = k
-                new_state_dict[name] = v
-            self.perceptual_model.load_state_dict(new_state_dict)
-            print ('perceptual model %s is loaded.'%self.args.pm_model)
-
-
         if self.args.rl_model is not None:
             state_dict = torch.load(self.args.rl_model)
             new_state_dict = OrderedDict()
@@ -307,18 +322,6 @@ class LocalizationNode(object):
             self.intri_model.load_state_dict(torch.load(self.args.ir_model))
             print ('intri model %s is loaded.'%self.args.ir_model)
 
-        # change n-classes
-        if self.args.n_pre_classes is not None:
-            # resize the output layer:
-            new_num_classes = final_num_classes
-            if "resnet" in self.args.pm_net:
-                self.perceptual_model.fc = nn.Linear(self.perceptual_model.fc.in_features, new_num_classes, bias=True)
-            elif "densenet" in args.pm_net:
-                num_ftrs = self.perceptual_model.classifier.in_features
-                self.perceptual_model.classifier = nn.Linear(num_ftrs, new_num_classes)
-            print ('model: num_classes now changed to', new_num_classes)
-
-
         # data parallel, multi GPU
         # https://pytorch.org/tutorials/beginner/blitz/data_parallel_tutorial.html
         if self.device==torch.device("cuda") and torch.cuda.device_count()>0:
@@ -441,6 +444,10 @@ class LocalizationNode(object):
         self.collision = False
         self.collision_attempt = 0
         self.sigma_xy = self.args.sigma_xy # self.cell_size * 0.05
+        # the motion model of every action, made once for this grid (see belief.TransitionModel)
+        self.transition = TransitionModel(self.grid_dirs, self.grid_rows, self.grid_cols, rot_step=self.args.rot_step,
+                                          fwd_step=self.args.fwd_step, trans_belief=self.args.trans_belief,
+                                          sigma_xy=self.sigma_xy, device=self.device)
         
         self.cr_pixels = int(np.ceil(self.collision_radius / self.args.map_pixel))
 
@@ -448,21 +455,39 @@ class LocalizationNode(object):
         self.side_margin_pixels = int(np.ceil(self.collision_radius / self.args.map_pixel))
 
 
-        self.scans_over_map = np.zeros((self.grid_rows,self.grid_cols,360))
+        self.scan_2d = None # (grid_dirs, map_rows, map_cols) scan image, refilled in place every step
+        self.scan_2d_slide = None # (map_rows, map_cols), the same
+        self.scan_points = None # (heading, row, col) indices of the ones in scan_2d
+        self.scans_over_map = scan_array((self.grid_rows,self.grid_cols,360), self.args.scan_storage)
+        self.scans_spectra = None # for --gtl-kernel fft, once per scans_over_map
+        self.scans_cos_bank = None # for --gtl-kernel bank, once per scans_over_map
+        self.scans_id = None # names scans_over_map for the GTL cache, set in make_scans_over_map
+        self.scans_count = 0
+        self.scans_high = None # per-pixel scans of map_for_LM, see make_scans_high
+        self.scans_high_id = None
+        self.gtl_cache = OrderedDict() # (scans_id, head, row, col) -> (GTL, unnormalized GTL, their top-k), LRU first
 
 
         self.scan_2d_low_tensor = torch.zeros((1,self.args.n_state_grids, self.args.n_state_grids),device=torch.device(self.device))
         self.map_for_LM = np.zeros((self.map_rows, self.map_cols))
         self.map_for_pose = np.zeros((self.grid_rows, self.grid_cols),dtype='float')
         self.map_for_RL = torch.zeros((1,self.args.n_state_grids, self.args.n_state_grids),device=torch.device(self.device))
+        self.map_clearance = None # for --raycast edt, set in make_low_dim_maps
+
+        # ray casting and GTL workers, forked once and fed the map in make_low_dim_maps. see parallel.py
+        self.workers = WorkerPool(self.args.n_workers, (self.map_rows, self.map_cols), (self.grid_rows, self.grid_cols),
+                                  self.grid_dirs, self.xlim, self.ylim, (self.min_scan_range, self.max_scan_range),
+                                  scan_step=self.args.pm_scan_step, raycast=self.args.raycast,
+                                  storage=self.args.scan_storage)
 
         self.data_cnt = 0
         
-        self.explored_space = np.zeros((self.grid_dirs,self.grid_rows, self.grid_cols),dtype='float')
+        self.explored = set() # (head, row, col) of the true poses visited in this episode
 
         self.new_pose = False
         self.new_bel = False
-        self.bel_list = []
+        self.bel_set = set() # (head, row, col) of the argmax of the belief in this episode
+        self.bel_stats = None # see product_belief
         self.scan_list = []
         self.target_list = []
 
@@ -472,10 +497,25 @@ class LocalizationNode(object):
         self.likelihood = self.likelihood / self.likelihood.sum()
 
         self.gt_likelihood = np.ones((self.grid_dirs,self.grid_rows,self.grid_cols))
+        self.gt_likelihood_sparse = None # top-k GTL with --sparse-gtl, set in normalize_gtl
+        self.gt_likelihood_unnormalized_sparse = None
         self.gt_likelihood_unnormalized = np.ones((self.grid_dirs,self.grid_rows,self.grid_cols))        
         
-        self.belief = torch.ones((self.grid_dirs,self.grid_rows, self.grid_cols),device=torch.device(self.device))
-        self.belief = self.belief / self.belief.sum()
+        # a filter of one episode: self.belief is its batch entry 0 (see the belief property)
+        self.bel_filter = BeliefFilter(1, self.grid_dirs, self.grid_rows, self.grid_cols, transition=self.transition,
+                                       device=torch.device(self.device))
+        # --localizer particle: the belief is the histogram of a particle filter, see product_belief
+        self.particle_filter = None
+        if self.args.localizer == 'particle':
+            self.particle_filter = ParticleFilter(self.args.n_particles, self.grid_dirs, self.grid_rows, self.grid_cols,
+                                                  self.xlim, self.ylim, self.fwd_step_meters, self.heading_resol*self.args.rot_step,
+                                                  process_error=self.args.process_error, device=torch.device(self.device))
+        # --belief-window: a finer belief around the mode, refined by the GTL of its own cells, see window_likelihood
+        self.bel_window = None
+        if self.args.belief_window > 0 and self.particle_filter is None:
+            self.bel_window = BeliefWindow(self.bel_filter, self.args.belief_window, self.args.window_sub,
+                                           rot_step=self.args.rot_step, fwd_step=self.args.fwd_step,
+                                           trans_belief=self.args.trans_belief, sigma_xy=self.sigma_xy)
 
         self.bel_ent = (self.belief * torch.log(self.belief)).sum().detach()
         # self.bel_ent = np.log(1.0/(self.grid_dirs*self.grid_rows*self.grid_cols))
@@ -642,6 +682,14 @@ class LocalizationNode(object):
         #end of init
 
 
+    @property
+    def belief(self):
+        return self.bel_filter.belief[0]
+
+    @belief.setter
+    def belief(self, bel):
+        self.bel_filter.belief = bel.unsqueeze(0)
+
     def loop(self): 
 
         if self.current_state == "new_env_pose":
@@ -662,7 +710,7 @@ class LocalizationNode(object):
             self.make_low_dim_maps()
 
             if self.args.gtl_off == False:
-                self.get_synth_scan_mp(self.scans_over_map, map_img=self.map_for_LM, xlim=self.xlim, ylim=self.ylim) # generate synthetic scan data over the map (and directions)
+                self.make_scans_over_map() # generate synthetic scan data over the map (and directions)
 
             self.reset_explored()
             if self.args.init_pose is not None:
@@ -702,8 +750,7 @@ class LocalizationNode(object):
                     #save roll-out for next episode.
                     self.roll_out_filepath = os.path.join(self.log_dir, 'roll-out-%03d-%03d.txt'%(self.env_count,self.episode_count))
                     print ('roll-out saving: %s'%self.roll_out_filepath)
-            self.scan_2d, self.scan_2d_low = self.get_scan_2d_n_headings(self.scan_data, self.xlim, self.ylim)
-            self.slide_scan()
+            self.preprocess_scan()
             ### 2. update likelihood from observation
 
             self.compute_gtl(self.scans_over_map)
@@ -717,7 +764,7 @@ class LocalizationNode(object):
                 self.next_step()
                 return
 
-            self.likelihood = self.update_likelihood_rotate(self.map_for_LM, self.scan_2d)
+            self.likelihood = self.update_likelihood_rotate(self.map_for_LM, self.scan_points)
             if self.args.mask:
                 self.mask_likelihood()
             #self.likelihood.register_hook(print)
@@ -1252,7 +1299,7 @@ class LocalizationNode(object):
 
     def update_gtl_dist(self,ax):
         # y = (self.gt_likelihood.cpu().detach().numpy().flatten())
-        y = self.gt_likelihood.flatten()
+        y = self.gtl_array().flatten()
         if self.obj_gtl_dist == None:
             x = range(y.size)
             self.obj_gtl_dist, = ax.plot(x,y,'.')
@@ -1317,7 +1364,7 @@ class LocalizationNode(object):
 
     def update_gtl_plot(self,ax):
         # gtl = self.gt_likelihood.cpu().detach().numpy()
-        gtl = self.gt_likelihood
+        gtl = self.gtl_array()
         gtl, side = square_clock(gtl, self.grid_dirs)
         if self.obj_gtl == None:
             self.obj_gtl = ax.imshow(gtl,interpolation='nearest')
@@ -1649,11 +1696,28 @@ class LocalizationNode(object):
         mdt = np.clip(mdt, 0.0, 1.0)
         self.map_for_RL[0,:,:] = torch.tensor(mdt).float().to(self.device)
 
+        if self.args.raycast == 'edt':
+            self.map_clearance = clearance_map(self.map_for_LM, self.xlim, self.ylim)
+
+        # free grid cells of this map, once per map:
+        # GTL is computed on the cells with no obstacle within 5 cm of the center,
+        # place_turtle and sample_a_pose pick from those clear within collision_radius and 0.5 m,
+        # and mask_likelihood keeps the cells that are mostly open in map_for_pose.
+        self.gtl_free = grid_free_mask(self.map_for_LM, self.grid_rows, self.grid_cols, 0.05, self.xlim, self.ylim)
+        self.place_free = grid_free_mask(self.map_for_LM, self.grid_rows, self.grid_cols, self.collision_radius, self.xlim, self.ylim)
+        self.sample_free = grid_free_mask(self.map_for_LM, self.grid_rows, self.grid_cols, 0.50, self.xlim, self.ylim)
+        self.likelihood_mask = torch.tensor((self.map_for_pose <= 0.5).astype(float)).float().to(self.device)
+        self.workers.set_map(self.map_for_LM, self.gtl_free, self.map_clearance)
+        if self.particle_filter is not None:
+            self.particle_filter.set_map(self.map_for_LM)
+            self.particle_filter.reset()
+
 
     def clear_objects(self):
         self.map_for_LM = np.zeros((self.map_rows, self.map_cols))
         self.map_for_pose = np.zeros((self.grid_rows, self.grid_cols),dtype='float')
         self.map_for_RL = torch.zeros((1,self.args.n_state_grids, self.args.n_state_grids),device=torch.device(self.device))
+        self.map_clearance = None
         
         
                         
@@ -1728,20 +1792,18 @@ class LocalizationNode(object):
 
         # self.map_for_pose[x0:x1, y0:y1]=1.0
     def sample_a_pose(self):
-        # new turtle location (random)
-        check = True
-        collision_radius = 0.50
-        while (check):
-            turtle_can = range(self.grid_rows*self.grid_cols)
-            turtle_bin = np.random.choice(turtle_can,1)
-
-            self.true_grid.row = turtle_bin//self.grid_cols
-            self.true_grid.col = turtle_bin% self.grid_cols
-            self.true_grid.head = np.random.randint(self.grid_dirs)
-            self.goal_pose.x = to_real(self.true_grid.row, self.xlim, self.grid_rows)
-            self.goal_pose.y = to_real(self.true_grid.col, self.ylim, self.grid_cols)
-            self.goal_pose.theta = wrap(self.true_grid.head*self.heading_resol)
-            check =  self.collision_fnc(self.goal_pose.x, self.goal_pose.y, collision_radius, self.map_for_LM)
+        # new turtle location (random), among the cells clear within 0.5 m
+        turtle_can = np.flatnonzero(self.sample_free)
+        if turtle_can.size == 0:
+            raise Exception('sample_a_pose: no grid cell of the map is clear within 0.5 m')
+        turtle_bin = np.random.choice(turtle_can,1)
+
+        self.true_grid.row = turtle_bin//self.grid_cols
+        self.true_grid.col = turtle_bin% self.grid_cols
+        self.true_grid.head = np.random.randint(self.grid_dirs)
+        self.goal_pose.x = to_real(self.true_grid.row, self.xlim, self.grid_rows)
+        self.goal_pose.y = to_real(self.true_grid.col, self.ylim, self.grid_cols)
+        self.goal_pose.theta = wrap(self.true_grid.head*self.heading_resol)
 
     def set_init_pose(self):
 
@@ -1777,23 +1839,18 @@ class LocalizationNode(object):
         return True
     
     def place_turtle(self):
-        # new turtle location (random)
-        check = True
-        cnt = 0
-        while (check):
-            if cnt > 100:
-                return False
-            cnt += 1            
-            turtle_can = range(self.grid_rows*self.grid_cols)
-            turtle_bin = np.random.choice(turtle_can,1)
-
-            self.true_grid.row = turtle_bin//self.grid_cols
-            self.true_grid.col = turtle_bin% self.grid_cols
-            self.true_grid.head = np.random.randint(self.grid_dirs)
-            self.goal_pose.x = to_real(self.true_grid.row, self.xlim, self.grid_rows)
-            self.goal_pose.y = to_real(self.true_grid.col, self.ylim, self.grid_cols)
-            self.goal_pose.theta = wrap(self.true_grid.head*self.heading_resol)
-            check =  self.collision_fnc(self.goal_pose.x, self.goal_pose.y, self.collision_radius, self.map_for_LM)
+        # new turtle location (random), among the cells clear within collision_radius
+        turtle_can = np.flatnonzero(self.place_free)
+        if turtle_can.size == 0:
+            return False
+        turtle_bin = np.random.choice(turtle_can,1)
+
+        self.true_grid.row = turtle_bin//self.grid_cols
+        self.true_grid.col = turtle_bin% self.grid_cols
+        self.true_grid.head = np.random.randint(self.grid_dirs)
+        self.goal_pose.x = to_real(self.true_grid.row, self.xlim, self.grid_rows)
+        self.goal_pose.y = to_real(self.true_grid.col, self.ylim, self.grid_cols)
+        self.goal_pose.theta = wrap(self.true_grid.head*self.heading_resol)
 
         check = True
         cnt = 0
@@ -1852,27 +1909,22 @@ class LocalizationNode(object):
     
         
     def reset_explored(self): # reset explored area to all 0's
-        self.explored_space = np.zeros((self.grid_dirs,self.grid_rows, self.grid_cols),dtype='float')
+        self.explored = set() # (head, row, col) of the true poses visited in this episode
         self.new_pose = False
         return
 
     def update_bel_list(self):
-        guess = self.bel_grid
-        # guess = np.unravel_index(np.argmax(self.belief.cpu().detach().numpy(), axis=None), self.belief.shape)
-        if guess not in self.bel_list:
-            self.new_bel = True
-            self.bel_list.append(guess)
+        guess = (self.bel_grid.head, self.bel_grid.row, self.bel_grid.col)
+        self.new_bel = guess not in self.bel_set
+        if self.new_bel:
+            self.bel_set.add(guess)
             if self.args.verbose > 2:
-                print ("bel_list", len(self.bel_list))
-        else:
-            self.new_bel = False
+                print ("bel_set", len(self.bel_set))
 
     def update_explored(self):
-        if self.explored_space[self.true_grid.head,self.true_grid.row, self.true_grid.col] == 0.0:
-            self.new_pose = True
-        else:
-            self.new_pose = False
-        self.explored_space[self.true_grid.head,self.true_grid.row, self.true_grid.col] = 1.0
+        pose = (self.true_grid.head, self.true_grid.row, self.true_grid.col)
+        self.new_pose = pose not in self.explored
+        self.explored.add(pose)
         return
 
     def normalize_gtl(self):
@@ -1890,272 +1942,94 @@ class LocalizationNode(object):
             # gt = torch.from_numpy(gt/gt.sum()).float().to(self.device)
         # self.gt_likelihood = torch.tensor(gt).float().to(self.device)
         self.gt_likelihood = gt
-
-
-    def get_gtl_cos_mp(self, ref_scans, scan_data, my_dirs, return_dict):
-        chk_rad = 0.05
-        offset = 360.0/self.grid_dirs
-        y= np.array(scan_data.ranges_2pi)[::self.args.pm_scan_step]
-        y = np.clip(y, self.min_scan_range, self.max_scan_range)
-        # y = np.clip(y, self.min_scan_range, np.inf)
-        for heading in my_dirs:
-            X = np.roll(ref_scans, -int(offset*heading),axis=2)[:,:,::self.args.pm_scan_step]
-            gtl = np.zeros((self.grid_rows, self.grid_cols))
-            for i_ld in range(self.grid_rows):
-                for j_ld in range(self.grid_cols):
-                    if self.collision_fnc(to_real(i_ld, self.xlim, self.grid_rows), to_real(j_ld, self.ylim, self.grid_cols), chk_rad, self.map_for_LM):
-                    # if self.map_for_pose[i_ld, j_ld]>0.4:
-                        gtl[i_ld,j_ld]=0.0
-                    else:
-                        x = X[i_ld,j_ld,:]
-                        x = np.clip(x, self.min_scan_range, self.max_scan_range)
-                        # x = np.clip(x, self.min_scan_range, np.inf)                        
-                        gtl[i_ld,j_ld] = self.get_cosine_sim(x,y)
-            ###
-            return_dict[heading] = {'gtl': gtl}
-
-
-    def get_gtl_cos_mp2(self, my_dirs, scan_data, return_dict):
-        chk_rad = 0.05
-        offset = 360.0/self.grid_dirs
-        y= np.array(scan_data.ranges_2pi)[::self.args.pm_scan_step]
-        y = np.clip(y, self.min_scan_range, self.max_scan_range)
-        for heading in my_dirs:
-            X = np.roll(self.scans_over_map, -int(offset*heading), axis=2)[:,:,::self.args.pm_scan_step]
-            gtl = np.zeros((self.grid_rows, self.grid_cols))
-            for i_ld in range(self.grid_rows):
-                for j_ld in range(self.grid_cols):
-                    if self.collision_fnc(to_real(i_ld, self.xlim, self.grid_rows), to_real(j_ld, self.ylim, self.grid_cols), chk_rad, self.map_for_LM):
-                    # if self.map_for_pose[i_ld, j_ld]>0.4:
-                        gtl[i_ld,j_ld]=0.0
-                    else:
-                        x = X[i_ld,j_ld,:]
-                        x = np.clip(x, self.min_scan_range, self.max_scan_range)
-                        gtl[i_ld,j_ld] = self.get_cosine_sim(x,y)
-            ###
-            return_dict[heading] = {'gtl': gtl}
-
-            
-    def get_gtl_corr_mp(self, ref_scans, my_dirs, return_dict, clip):
-        chk_rad = 0.05
-        offset = 360/self.grid_dirs
-        y= np.array(self.scan_data_at_unperturbed.ranges_2pi)[::self.args.pm_scan_step]
-        y = np.clip(y, self.min_scan_range, self.max_scan_range)
-        for heading in my_dirs:
-            X = np.roll(ref_scans, -offset*heading,axis=2)[:,:,::self.args.pm_scan_step]
-            gtl = np.zeros((self.grid_rows, self.grid_cols))
-            for i_ld in range(self.grid_rows):
-                for j_ld in range(self.grid_cols):
-                    if self.collision_fnc(to_real(i_ld, self.xlim, self.grid_rows), to_real(j_ld, self.ylim, self.grid_cols), chk_rad, self.map_for_LM):
-                    # if self.map_for_pose[i_ld, j_ld]>0.4:
-                        gtl[i_ld,j_ld]=0.0
-                    else:
-                        x = X[i_ld,j_ld,:]
-                        x = np.clip(x, self.min_scan_range, self.max_scan_range)
-                        gtl[i_ld,j_ld] = self.get_corr(x,y,clip=clip)
-            ###
-            return_dict[heading] = {'gtl': gtl}
+        if self.args.sparse_gtl > 0:
+            # keep only the top-k poses and a floor for the others, and use that GTL from here on.
+            # the dense arrays are dropped: gtl_tensor expands it on the device
+            self.gt_likelihood_sparse = sparse_top_k(gt, self.args.sparse_gtl)
+            self.gt_likelihood_unnormalized_sparse = sparse_top_k(self.gt_likelihood_unnormalized, self.args.sparse_gtl)
+            self.gt_likelihood = None
+            self.gt_likelihood_unnormalized = None
+
+    def gtl_tensor(self):
+        # GTL on the device. with --sparse-gtl only the top-k values are sent
+        sp = self.gt_likelihood_sparse
+        if sp is None:
+            return torch.tensor(self.gt_likelihood).float().to(self.device)
+        gtl = torch.full((int(np.prod(sp['shape'])),), sp['floor'], device=self.device)
+        gtl[torch.from_numpy(sp['index']).long().to(self.device)] = torch.from_numpy(sp['value']).to(self.device)
+        return gtl.view(*sp['shape'])
+
+    def gtl_array(self):
+        # GTL on the host, for the figures
+        if self.gt_likelihood is None:
+            return sparse_to_dense(self.gt_likelihood_sparse)
+        return self.gt_likelihood
+
+    def gtl_target(self):
+        # unnormalized GTL as a training target: the top-k dict with --sparse-gtl
+        if self.gt_likelihood_unnormalized is None:
+            return self.gt_likelihood_unnormalized_sparse
+        return self.gt_likelihood_unnormalized
 
 
     def get_gt_likelihood_cossim(self, ref_scans, scan_data):
         # start_time = time.time()
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-
-        accum = 0
-        procs = []
-        for i_worker in range(min(self.args.n_workers, self.grid_dirs)):
-            n_dirs = self.grid_dirs//self.args.n_workers
-            if i_worker < self.grid_dirs % self.args.n_workers:
-                n_dirs +=1
-            my_dirs = range(accum, accum+n_dirs)
-            accum += n_dirs
-            if len(my_dirs)>0:
-                pro = multiprocessing.Process(target = self.get_gtl_cos_mp,
-                                          args = [ref_scans, scan_data, my_dirs, return_dict])
-                procs.append(pro)
-
-        [pro.start() for pro in procs]
-        [pro.join() for pro in procs]
-
-        gtl = np.ones((self.grid_dirs,self.grid_rows,self.grid_cols))
-        for i in range(self.grid_dirs):
-            ret = return_dict[i]    
-            gtl[i,:,:] = ret['gtl']
-        return gtl
-
-        # for i in range(self.grid_dirs):
-        #     ret = return_dict[i]    
-        #     self.gt_likelihood[i,:,:] = ret['gtl']
-        #     # self.gt_likelihood[i,:,:] = torch.tensor(ret['gtl']).float().to(self.device)
+        y = np.array(scan_data.ranges_2pi)[::self.args.pm_scan_step]
+        y = np.clip(y, self.min_scan_range, self.max_scan_range)
+        if self.args.gtl_kernel == 'bank':
+            # reference scans prepared once per map: one matrix product per call
+            if ref_scans is not self.scans_over_map:
+                bank = cos_bank(ref_scans, self.grid_dirs, self.args.pm_scan_step, (self.min_scan_range, self.max_scan_range))
+            else:
+                if self.scans_cos_bank is None:
+                    self.scans_cos_bank = cos_bank(ref_scans, self.grid_dirs, self.args.pm_scan_step, (self.min_scan_range, self.max_scan_range))
+                bank = self.scans_cos_bank
+            return gtl_cos_bank(bank, y, free=self.gtl_free)
+        if self.args.gtl_kernel == 'vec':
+            return gtl_cos(ref_scans, y, self.grid_dirs, free=self.gtl_free, scan_step=self.args.pm_scan_step,
+                           scan_range=(self.min_scan_range, self.max_scan_range))
+        if self.args.gtl_kernel == 'fft':
+            spectra = None
+            if ref_scans is self.scans_over_map:
+                if self.scans_spectra is None:
+                    self.scans_spectra = bank_spectra(ref_scans, (self.min_scan_range, self.max_scan_range))
+                spectra = self.scans_spectra
+            return gtl_cos_fft(ref_scans, y, self.grid_dirs, free=self.gtl_free, scan_step=self.args.pm_scan_step,
+                               scan_range=(self.min_scan_range, self.max_scan_range),
+                               pool=self.args.heading_pool, spectra=spectra)
+        # the worker pool already holds the map and the reference scans: only the measured scan is sent
+        if ref_scans is not self.workers.scans_src:
+            self.workers.set_scans(ref_scans)
+        return self.workers.gtl_cossim(y)
 
             
-    def get_gt_likelihood_cossim2(self, scan_data):
-        # start_time = time.time()
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-
-        accum = 0
-        procs = []
-        for i_worker in range(min(self.args.n_workers, self.grid_dirs)):
-            n_dirs = self.grid_dirs//self.args.n_workers
-            if i_worker < self.grid_dirs % self.args.n_workers:
-                n_dirs +=1
-            my_dirs = range(accum, accum+n_dirs)
-            accum += n_dirs
-            if len(my_dirs)>0:
-                pro = multiprocessing.Process(target = self.get_gtl_cos_mp2,
-                                          args = [ref_scans, scan_data, my_dirs, return_dict])
-                procs.append(pro)
-
-        [pro.start() for pro in procs]
-        [pro.join() for pro in procs]
-
-        gtl = np.ones((self.grid_dirs,self.grid_rows,self.grid_cols))
-
-        for i in range(self.grid_dirs):
-            ret = return_dict[i]    
-            gtl[i,:,:] = ret['gtl']
-
-        return gtl
-
     def get_gt_likelihood_corr(self, ref_scans, clip=0):
         # start_time = time.time()
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-
-        accum = 0
-        procs = []
-        for i_worker in range(min(self.args.n_workers, self.grid_dirs)):
-            n_dirs = self.grid_dirs//self.args.n_workers
-            if i_worker < self.grid_dirs % self.args.n_workers:
-                n_dirs +=1
-            my_dirs = range(accum, accum+n_dirs)
-            accum += n_dirs
-            if len(my_dirs)>0:
-                pro = multiprocessing.Process(target = self.get_gtl_corr_mp,
-                                              args = [ref_scans, my_dirs, return_dict, clip])
-                procs.append(pro)
-
-        [pro.start() for pro in procs]
-        [pro.join() for pro in procs]
-
-        for i in range(self.grid_dirs):
-            ret = return_dict[i]    
-            self.gt_likelihood[i,:,:] = ret['gtl']
-            # self.gt_likelihood[i,:,:] = torch.tensor(ret['gtl']).float().to(self.device)
+        if ref_scans is not self.workers.scans_src:
+            self.workers.set_scans(ref_scans)
+        y = np.array(self.scan_data_at_unperturbed.ranges_2pi)[::self.args.pm_scan_step]
+        y = np.clip(y, self.min_scan_range, self.max_scan_range)
+        self.gt_likelihood = self.workers.gtl_corr(y, clip=clip)
         
 
     def get_cosine_sim(self,x,y):
         # numpy arrays.
-        non_inf_x = ~np.isinf(x)
-        non_nan_x = ~np.isnan(x)
-        non_inf_y = ~np.isinf(y)
-        non_nan_y = ~np.isnan(y)
-
-        numbers_only = non_inf_x & non_nan_x & non_inf_y & non_nan_y
-        x=x[numbers_only]
-        y=y[numbers_only]
-        return sum(x*y)/np.linalg.norm(y,2)/np.linalg.norm(x,2)
+        return cosine_sim(x, y)
 
 
     def get_corr(self,x,y,clip=1):
-        mx=np.mean(x)
-        my=np.mean(y)
-        corr=sum((x-mx)*(y-my))/np.linalg.norm(y-my,2)/np.linalg.norm(x-mx,2)
-        # return 0.5*(corr+1.0)
-        if clip==1:
-            return np.clip(corr, 0, 1.0)
-        else:
-            return 0.5*(corr+1.0)
-        
-    def get_a_scan(self, x_real, y_real, offset=0, scan_step=1, noise=0, sigma=0, fov=False):
-        #class member variables: map_rows, map_cols, xlim, ylim, min_scan_range, max_scan_range, map_2d
-        
-        row_hd = to_index(x_real, self.map_rows, self.xlim)  # from real to hd
-        col_hd = to_index(y_real, self.map_cols, self.ylim)  # from real to hd
-        scan = np.zeros(360)
-        missing = np.random.choice(360, noise, replace=False)
-        gaussian_noise = np.random.normal(scale=sigma, size=360)
-        for i_ray in range(0,360, scan_step):
-            if fov and i_ray > self.args.fov[0] and i_ray < self.args.fov[1]:
-                scan[i_ray]=np.nan
-                continue
-            else:
-                pass
-            
-            theta = math.radians(i_ray)+offset
-            if i_ray in missing:
-                dist = np.inf
-            else:
-                dist = self.min_scan_range
-            while True:
-                if dist >= self.max_scan_range: 
-                    dist = np.inf
-                    break
-                x_probe = x_real + dist * np.cos(theta)
-                y_probe = y_real + dist * np.sin(theta)
-                # see if there's something
-                i_hd_prb = to_index(x_probe, self.map_rows, self.xlim)
-                j_hd_prb = to_index(y_probe, self.map_cols, self.ylim)
-                if i_hd_prb < 0 or i_hd_prb >= self.map_rows: 
-                    dist = np.inf
-                    break
-                if j_hd_prb < 0 or j_hd_prb >= self.map_cols: 
-                    dist = np.inf
-                    break
-                if self.map_for_LM[i_hd_prb, j_hd_prb] >= 0.5: 
-                    break
-                dist += 0.01+0.01*(np.random.rand())
-            scan[i_ray]=dist+gaussian_noise[i_ray]
-        return scan
+        return corr(x, y, clip=clip)
         
-
-    def get_a_scan_mp(self, range_place, return_dict, offset=0, scan_step=1, map_img=None, xlim=None, ylim=None, fov=False):
-
-        # print (os.getpid(), min(range_place), max(range_place))
-        for i_place in range_place:
+    def get_a_scan(self, x_real, y_real, offset=0, scan_step=1, noise=0, sigma=0, fov=False, method=None):
         #class member variables: map_rows, map_cols, xlim, ylim, min_scan_range, max_scan_range, map_2d
-            row_ld = i_place // self.grid_cols
-            col_ld = i_place %  self.grid_cols
-            x_real = to_real(row_ld, xlim, self.grid_rows ) # from low-dim location to real
-            y_real = to_real(col_ld, ylim, self.grid_cols ) # from low-dim location to real
-            row_hd = to_index(x_real, self.map_rows, xlim)  # from real to hd
-            col_hd = to_index(y_real, self.map_cols, ylim)  # from real to hd
-            scan = np.zeros(360)
+        # all rays are cast at once, sensor noise is added after. see raycast.py
+        return cast_scan(self.map_for_LM, x_real, y_real, self.xlim, self.ylim,
+                         (self.min_scan_range, self.max_scan_range),
+                         offset=offset, scan_step=scan_step, noise=noise, sigma=sigma,
+                         fov=self.args.fov if fov else None, method=method or self.args.raycast,
+                         clearance=self.map_clearance)
         
-            for i_ray in range(0,360, scan_step):
-                if fov and i_ray > self.args.fov[0] and i_ray < self.args.fov[1]:
-                    scan[i_ray]=np.nan
-                    continue
-                else:
-                    pass
-                
-                theta = math.radians(i_ray)+offset
-                dist = self.min_scan_range
-                while True:
-                    if dist >= self.max_scan_range: 
-                        dist = np.inf
-                        break
-                    x_probe = x_real + dist * np.cos(theta)
-                    y_probe = y_real + dist * np.sin(theta)
-                    # see if there's something
-                    i_hd_prb = to_index(x_probe, self.map_rows, xlim)
-                    j_hd_prb = to_index(y_probe, self.map_cols, ylim)
-                    if i_hd_prb < 0 or i_hd_prb >= self.map_rows: 
-                        dist = np.inf
-                        break
-                    if j_hd_prb < 0 or j_hd_prb >= self.map_cols: 
-                        dist = np.inf
-                        break
-                    if map_img[i_hd_prb, j_hd_prb] >= 0.5: 
-                        break
-                    dist += 0.01+0.01*(np.random.rand())
-                scan[i_ray]=dist
-            #return scan
-            return_dict[i_place]={'scan':scan}
 
-        
     # def get_synth_scan(self):
     #     # start_time = time.time()                
     #     # place sensor at a location, then reach out in 360 rays all around it and record when each ray gets hit.
@@ -2174,59 +2048,97 @@ class LocalizationNode(object):
         
 
     
-    def get_synth_scan_mp(self, scans, map_img=None, xlim=None, ylim=None):
+    def make_scans_over_map(self):
+        # scans_over_map of map_for_LM, memory-mapped from --scan-cache if this map has been seen before
+        self.scans_spectra = None
+        self.scans_cos_bank = None
+        key = scan_bank_key(self.map_for_LM, self.grid_rows, self.grid_cols, self.xlim, self.ylim,
+                            self.args.pm_scan_step, (self.min_scan_range, self.max_scan_range),
+                            self.args.raycast, self.args.scan_storage)
+        self.scans_id = key
+        if self.args.scan_cache is not None:
+            bank = load_scan_bank(self.args.scan_cache, key)
+            if bank is not None:
+                self.scans_over_map = bank
+                self.workers.set_scans(self.scans_over_map)
+                return
+        if not self.scans_over_map.flags.writeable:
+            self.scans_over_map = scan_array((self.grid_rows,self.grid_cols,360), self.args.scan_storage)
+        self.get_synth_scan_mp(self.scans_over_map)
+        self.workers.set_scans(self.scans_over_map)
+        if self.args.scan_cache is not None:
+            save_scan_bank(self.args.scan_cache, key, self.scans_over_map)
+        elif self.args.raycast != 'dda':
+            # random probe steps: the same map gives other scans next time
+            self.scans_count += 1
+            self.scans_id = '%s-%d' % (key, self.scans_count)
+
+    def make_scans_high(self):
+        # scans from every pixel of map_for_LM, built on first use into --scan-cache (or the temp dir)
+        # and memory-mapped. cast by dda so that the bank on disk is exact for its map.
+        key = scan_bank_key(self.map_for_LM, self.map_rows, self.map_cols, self.xlim, self.ylim,
+                            self.args.pm_scan_step, (self.min_scan_range, self.max_scan_range),
+                            'dda', self.args.scan_storage)
+        if key != self.scans_high_id:
+            path = scan_bank_path(self.args.scan_cache or tempfile.gettempdir(), key)
+            self.scans_high = build_scan_bank(path, self.map_for_LM, self.xlim, self.ylim,
+                                              (self.min_scan_range, self.max_scan_range),
+                                              scan_step=self.args.pm_scan_step, raycast='dda',
+                                              storage=self.args.scan_storage, n_workers=self.args.n_workers,
+                                              verbose=self.args.verbose > 0)
+            self.scans_high_id = key
+        return self.scans_high
+
+    def get_gtl_high(self, scan_data, x_real, y_real):
+        # cosine GTL of all headings at the map pixels under (x_real, y_real), (grid_dirs, n):
+        # sub-cell lookups, for a finer grid than scans_over_map or for refining a pose within a cell
+        rows = to_index_array(x_real, self.map_rows, self.xlim).ravel()
+        cols = to_index_array(y_real, self.map_cols, self.ylim).ravel()
+        y = np.array(scan_data.ranges_2pi)[::self.args.pm_scan_step]
+        y = np.clip(y, self.min_scan_range, self.max_scan_range)
+        return gtl_cos_at(self.make_scans_high(), y, rows, cols, self.grid_dirs,
+                          scan_step=self.args.pm_scan_step, scan_range=(self.min_scan_range, self.max_scan_range))
+
+    def window_likelihood(self):
+        # likelihood of the fine cells of the belief window: their GTL from the per-pixel scans,
+        # made a distribution as in normalize_gtl. only the window is computed, whatever the size of the map
+        rows, cols = self.bel_window.fine_cells()
+        sub = self.bel_window.sub
+        x_real, y_real = np.meshgrid(to_real(rows, self.xlim, self.grid_rows*sub), to_real(cols, self.ylim, self.grid_cols*sub), indexing='ij')
+        gtl = self.get_gtl_high(self.scan_data, x_real, y_real).reshape(self.bel_window.shape)
+        if self.args.gtl_output == "softmax":
+            gtl = softmax(gtl, self.args.temperature)
+        elif self.args.gtl_output == "softermax":
+            gtl = softermax(gtl)
+        elif self.args.gtl_output == "linear":
+            gtl = np.clip(gtl, 1e-5, 1.0)
+        return torch.tensor(gtl, dtype=self.bel_window.belief.dtype, device=self.device)
 
-        # print (multiprocessing.cpu_count())
-        # start_time = time.time()    
+    def get_synth_scan_mp(self, scans):
         # place sensor at a location, then reach out in 360 rays all around it and record when each ray gets hit.
-        n_places=self.grid_rows * self.grid_cols
-        
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-        procs = []
-        
-        accum = 0
-        for worker in range(min(self.args.n_workers, n_places)):
-            n_myplaces = n_places//self.args.n_workers
-            if worker < n_places % self.args.n_workers:
-                n_myplaces += 1
-            range_place = range(accum, accum+n_myplaces)
-            accum += n_myplaces
-
-            kwargs = {'scan_step': self.args.pm_scan_step, 'map_img':map_img, 'xlim':xlim, 'ylim':ylim, 'fov':False}
-            pro = multiprocessing.Process(target = self.get_a_scan_mp, args = [range_place, return_dict ], kwargs = kwargs)
-            procs.append(pro)
-
-        [pro.start() for pro in procs]
-        [pro.join() for pro in procs]
-        
-        # scans = np.ndarray((self.grid_rows*self.grid_cols, 360))
-
-        for i_place in range(n_places):
-            ### multi-processing
-            rd = return_dict[i_place]
-            scan = rd['scan']
-            # scans [i_place, :] = np.clip(scan, self.min_scan_range, self.max_scan_range)
-            row_ld = i_place // self.grid_cols
-            col_ld = i_place %  self.grid_cols
-            # scans[row_ld, col_ld,:] = np.clip(scan, self.min_scan_range, np.inf)            
-            scans[row_ld, col_ld,:] = np.clip(scan, self.min_scan_range, self.max_scan_range)
-            # self.scans_over_map[row_ld, col_ld,:] = np.clip(scan, self.min_scan_range, self.max_scan_range)
+        # the pool workers cast from the map given to them in make_low_dim_maps (map_for_LM, xlim, ylim).
+        scans_out = self.workers.synth_scans()
+        scans[:,:,:] = encode_scans(np.clip(scans_out.reshape(self.grid_rows, self.grid_cols, 360), self.min_scan_range, self.max_scan_range), scans.dtype)
 
         
     def slide_scan(self):
-        # slide scan_2d downward for self.front_margin_pixels, and then left/righ for collision radius
-        self.scan_2d_slide = np.copy(self.scan_2d[0,:,:])
-        for i in range(self.front_margin_pixels):
-            self.scan_2d_slide += shift(self.scan_2d_slide, 1, axis=0, fill=1.0)
-        # self.scan_2d_slide = np.clip(self.scan_2d_slide,0.0,1.0)
-        for i in range(self.side_margin_pixels):
-            self.scan_2d_slide += shift(self.scan_2d_slide, +1, axis=1, fill=1.0)
-            self.scan_2d_slide += shift(self.scan_2d_slide, -1, axis=1, fill=1.0)
-        self.scan_2d_slide = np.clip(self.scan_2d_slide,0.0,1.0)
-
-
-    def get_scan_2d_n_headings(self, scan_data, xlim, ylim):
+        # slide scan_2d downward for self.front_margin_pixels, and then left/righ for collision radius.
+        # one dilation into the last scan_2d_slide (see utils.slide_scan_img)
+        self.scan_2d_slide = slide_scan_img(self.scan_2d[0,:,:], self.front_margin_pixels, self.side_margin_pixels,
+                                            out=self.scan_2d_slide)
+
+    def preprocess_scan(self):
+        # scan_data to scan_points (end points of all headings, the LM input), scan_2d (the same as an image),
+        # scan_2d_low and scan_2d_slide, refilling the buffers of the last step
+        data = self.scan_data
+        self.scan_points = scan_2d_points(data.ranges, data.angle_min, data.angle_max, self.grid_dirs,
+                                          (self.map_rows, self.map_cols), self.xlim, self.ylim, self.args.fov)
+        self.scan_2d, self.scan_2d_low = self.get_scan_2d_n_headings(self.scan_data, self.xlim, self.ylim, out=self.scan_2d,
+                                                                     points=self.scan_points)
+        self.slide_scan()
+
+
+    def get_scan_2d_n_headings(self, scan_data, xlim, ylim, out=None, points=None):
         if self.args.verbose > 1:
             print('get_scan_2d_n_headings')
 
@@ -2239,22 +2151,9 @@ class LocalizationNode(object):
         O=self.grid_dirs
         N=self.map_rows
         M=self.map_cols
-        scan_2d = np.zeros(shape=(O,N,M))
-        angles = np.linspace(data.angle_min, data.angle_max, data.ranges.size, endpoint=False)
-
-        for i,dist in enumerate(data.ranges):
-            for rotate in range(O):
-                offset = 2*np.pi/O*rotate
-                angle = offset + angles[i]
-                if angle > math.radians(self.args.fov[0]) and angle < math.radians(self.args.fov[1]):
-                    continue
-                if ~np.isinf(dist) and ~np.isnan(dist):
-                    x = (dist)*np.cos(angle)
-                    y = (dist)*np.sin(angle)
-                    n = to_index(x, N, xlim)
-                    m = to_index(y, M, ylim)
-                    if n>=0 and n<N and m>0 and m<M:
-                        scan_2d[rotate,n,m] = 1.0
+        # all rays of all headings at once, into out when it is given (see utils.scan_2d_n_headings)
+        scan_2d = scan_2d_n_headings(data.ranges, data.angle_min, data.angle_max, O, (N,M), xlim, ylim,
+                                     self.args.fov, out=out, points=points)
 
         rows1 = self.args.n_state_grids
         cols1 = self.args.n_state_grids
@@ -2284,22 +2183,8 @@ class LocalizationNode(object):
         O=self.grid_dirs
         N=self.map_rows
         M=self.map_cols
-        self.scan_2d = np.zeros(shape=(O,N,M))
-        angles = np.linspace(data.angle_min, data.angle_max, data.ranges.size, endpoint=False)
-
-        for i,dist in enumerate(data.ranges):
-            for rotate in range(O):
-                offset = 2*np.pi/O*rotate
-                angle = offset + angles[i]
-                if angle > math.radians(self.args.fov[0]) and angle < math.radians(self.args.fov[1]):
-                    continue
-                if ~np.isinf(dist) and ~np.isnan(dist):
-                    x = (dist)*np.cos(angle)
-                    y = (dist)*np.sin(angle)
-                    n = to_index(x, N, self.xlim)
-                    m = to_index(y, M, self.ylim)
-                    if n>=0 and n<N and m>0 and m<M:
-                        self.scan_2d[rotate,n,m] = 1.0
+        self.scan_2d = scan_2d_n_headings(data.ranges, data.angle_min, data.angle_max, O, (N,M), self.xlim, self.ylim,
+                                          self.args.fov, out=self.scan_2d)
 
         rows1 = self.args.n_state_grids
         cols1 = self.args.n_state_grids
@@ -2324,7 +2209,9 @@ class LocalizationNode(object):
         # map file number = D//N = E
 
         index = "%05d"%(self.data_cnt)
-        target_data = self.gt_likelihood_unnormalized
+        target_data = self.gtl_target()
+        if isinstance(target_data, dict):
+            target_data = sparse_to_dense(target_data)
         range_data=np.array(self.scan_data.ranges)
         angle_array = np.linspace(self.scan_data.angle_min, self.scan_data.angle_max,range_data.size, endpoint=False)
         scan_data_to_save = np.stack((range_data,angle_array),axis=1) #first column: range, second column: angle
@@ -2351,7 +2238,9 @@ class LocalizationNode(object):
 
     def stack_data(self):
 
-        target_data = self.gt_likelihood_unnormalized
+        target_data = self.gtl_target()
+        if isinstance(target_data, dict):
+            target_data = sparse_to_dense(target_data)
         range_data = np.array(self.scan_data.ranges_2pi, np.float32)
         angle_array = np.array(self.scan_data.angles_2pi, np.float32)
         scan_data_to_save = np.stack((range_data,angle_array),axis=1) #first column: range, second column: angle
@@ -2396,7 +2285,7 @@ class LocalizationNode(object):
             #save the map
             np.save(map_file, self.map_for_LM)
 
-        target_data = self.gt_likelihood_unnormalized
+        target_data = self.gtl_target()
         gt_pose = np.array((self.true_grid.head,self.true_grid.row,self.true_grid.col)).reshape(1,-1)
         map_num = np.array([self.env_count])
         range_data=np.array(self.scan_data.ranges)
@@ -2415,6 +2304,12 @@ class LocalizationNode(object):
                         'reward': self.reward_vector.reshape(1,-1),
                         'gt_pose': gt_pose,
                         'real_pose': real_pose}
+        if self.args.sparse_gtl > 0:
+            # top-k poses and a floor for the others. gtl.sparse_to_dense gives the arrays back
+            for key in ['target', 'belief', 'like']:
+                if not isinstance(dict_to_save[key], dict):
+                    dict_to_save[key] = sparse_top_k(dict_to_save[key], self.args.sparse_gtl)
+            dict_to_save['sparse'] = self.args.sparse_gtl
 
         np.save(os.path.join(self.data_path, 'data-%s.npy'%index), dict_to_save)
 
@@ -2428,8 +2323,25 @@ class LocalizationNode(object):
             gt = np.clip(gt, 1e-5, 1.0)
             gt=gt/gt.sum()
             self.gt_likelihood = gt
+            self.gt_likelihood_sparse = None
+            self.gt_likelihood_unnormalized_sparse = None
             # self.gt_likelihood = torch.tensor(gt).float().to(self.device)
         else:
+            # with --gtl-cache, the unperturbed scan is noise-free and cast by dda (see get_lidar),
+            # so the GTL only depends on the reference scans and the true grid pose
+            cache_key = None
+            if self.args.gtl_cache > 0 and not (self.args.gazebo or self.args.jay1) and ref_scans is self.scans_over_map:
+                cache_key = (self.scans_id,) + tuple(int(np.asarray(v).item()) for v in (self.true_grid.head, self.true_grid.row, self.true_grid.col))
+                if cache_key in self.gtl_cache:
+                    self.gtl_cache.move_to_end(cache_key)
+                    # the dense arrays, or None and the top-k dicts with --sparse-gtl
+                    gt, gt_unnormalized, gt_sparse, gt_unnormalized_sparse = self.gtl_cache[cache_key]
+                    self.gt_likelihood = gt if gt is None else np.copy(gt)
+                    self.gt_likelihood_unnormalized = gt_unnormalized if gt_unnormalized is None else np.copy(gt_unnormalized)
+                    self.gt_likelihood_sparse = gt_sparse
+                    self.gt_likelihood_unnormalized_sparse = gt_unnormalized_sparse
+                    return
+
             if self.args.gtl_src == 'hd-corr':
                 self.get_gt_likelihood_corr(ref_scans, clip=0)
             elif self.args.gtl_src == 'hd-corr-clip':
@@ -2440,6 +2352,14 @@ class LocalizationNode(object):
                 raise Exception('GTL source required: --gtl-src= [low-dim-map, high-dim-map]')
             self.normalize_gtl()
 
+            if cache_key is not None:
+                if self.gt_likelihood is None:
+                    self.gtl_cache[cache_key] = (None, None, self.gt_likelihood_sparse, self.gt_likelihood_unnormalized_sparse)
+                else:
+                    self.gtl_cache[cache_key] = (np.copy(self.gt_likelihood), np.copy(self.gt_likelihood_unnormalized), None, None)
+                if len(self.gtl_cache) > self.args.gtl_cache:
+                    self.gtl_cache.popitem(last=False)
+
     def run_action_module(self, no_update_fig=False):
         if self.args.random_policy:
             fwd_collision = self.collision_fnc(0, 0, 0, self.scan_2d_slide)
@@ -2488,7 +2408,7 @@ class LocalizationNode(object):
             map_img[xs,ys]=1-map_img[xs,ys]
             
         time_mark = time.time()        
-        if self.perceptual_model == None:
+        if self.perceptual_model == None and self.lm_client is None:
             return self.likelihood
         else:
             likelihood = torch.zeros((self.grid_dirs,self.grid_rows, self.grid_cols),
@@ -2496,25 +2416,13 @@ class LocalizationNode(object):
                                      dtype=torch.float)
 
         if self.args.verbose>1: print("update_likelihood_rotate")
-        if self.args.ch3=="ZERO":
-            input_batch = np.zeros((self.grid_dirs, 3, self.map_rows, self.map_cols))            
-            for i in range(self.grid_dirs): # for all orientations
-                input_batch[i, 0, :,:] = map_img
-                input_batch[i, 1, :,:] = scan_imgs[i,:,:]
-                input_batch[i, 2, :,:] = np.zeros_like(map_img)
-        elif self.args.ch3=="RAND":
-            input_batch = np.zeros((self.grid_dirs, 3, self.map_rows, self.map_cols))            
-            for i in range(self.grid_dirs): # for all orientations
-                input_batch[i, 0, :,:] = map_img
-                input_batch[i, 1, :,:] = scan_imgs[i,:,:]
-                input_batch[i, 2, :,:] = np.random.random(map_img.shape)
+        input_batch = self.lm_input(map_img, scan_imgs)
+        if self.lm_client is not None:
+            output = torch.from_numpy(self.lm_client(input_batch.cpu())).to(self.device)
+        elif self.args.pm_net.startswith("split-") and self.args.update_pm_by == "NONE":
+            output = self.split_lm_forward(map_img, input_batch)
         else:
-            input_batch = np.zeros((self.grid_dirs, 2, self.map_rows, self.map_cols))            
-            for i in range(self.grid_dirs): # for all orientations
-                input_batch[i, 0, :,:] = map_img
-                input_batch[i, 1, :,:] = scan_imgs[i,:,:]
-        input_batch = torch.from_numpy(input_batch).float()
-        output = self.perceptual_model.forward(input_batch)
+            output = self.perceptual_model.forward(input_batch)
         output_softmax  = F.softmax(output.view([1,-1])/self.args.temperature, dim= 1) # shape (1,484)
 
         if self.args.n_lm_grids !=  self.args.n_local_grids:
@@ -2538,8 +2446,33 @@ class LocalizationNode(object):
         # self.likelihood = torch.clamp(self.likelihood, 1e-9, 1.0)
         # self.likelihood = self.likelihood/self.likelihood.sum()
 
+    def split_lm_forward(self, map_img, input_batch):
+        # a fixed split LM (resnet_pm.SplitResNet): the map is encoded once per map_for_LM
+        # (every step with --flip-map), then only the scan images go through the network
+        model = self.perceptual_model.module if isinstance(self.perceptual_model, nn.DataParallel) else self.perceptual_model
+        if self.lm_map is None or not np.array_equal(self.lm_map, map_img):
+            with torch.no_grad():
+                self.lm_map_features = model.encode_map(input_batch[:1, 0:1])
+            self.lm_map = map_img
+        return model.forward_scan(input_batch[:, 1:2], self.lm_map_features)
+
+    def lm_input(self, map_img, scan_imgs):
+        # LM input batch (grid_dirs, 2 or 3, map_rows, map_cols), float32, built on the device:
+        # the map in every heading, and the scan end points scattered into channel 1.
+        # scan_imgs: (heading, row, col) end points (see utils.scan_2d_points) or the (grid_dirs, rows, cols) image
+        if isinstance(scan_imgs, np.ndarray):
+            scan_imgs = np.nonzero(scan_imgs)
+        n_ch = 3 if self.args.ch3 in ("ZERO", "RAND") else 2
+        input_batch = torch.zeros((self.grid_dirs, n_ch, self.map_rows, self.map_cols), device=self.device)
+        input_batch[:, 0] = torch.from_numpy(map_img).float().to(self.device)
+        heading, row, col = [torch.from_numpy(np.asarray(a)).long().to(self.device) for a in scan_imgs]
+        input_batch[heading, 1, row, col] = 1.0
+        if self.args.ch3 == "RAND":
+            input_batch[:, 2] = torch.rand((self.grid_dirs, self.map_rows, self.map_cols), device=self.device)
+        return input_batch
+
     def compute_loss(self, likelihood):
-        gtl = torch.tensor(self.gt_likelihood).float().to(self.device)
+        gtl = self.gtl_tensor()
         if self.args.pm_loss == "KL":
             self.loss_ll = (gtl * torch.log(gtl/likelihood)).sum()            
         elif self.args.pm_loss == "L1":
@@ -2558,12 +2491,8 @@ class LocalizationNode(object):
                 
 
     def mask_likelihood(self):
-        the_mask = torch.tensor(np.ones([self.grid_dirs, self.grid_rows, self.grid_cols])).float().to(self.device)
-        for i in range(self.grid_rows):
-            for j in range(self.grid_cols):
-                if self.map_for_pose[i, j]>0.5:
-                    the_mask[:,i,j]=0.0
-        self.likelihood = self.likelihood * the_mask
+        # likelihood_mask: map_for_pose <= 0.5, set in make_low_dim_maps
+        self.likelihood = self.likelihood * self.likelihood_mask
         #self.likelihood = torch.clamp(self.likelihood, 1e-9, 1.0)
         self.likelihood = self.likelihood/self.likelihood.sum()
 
@@ -2571,18 +2500,26 @@ class LocalizationNode(object):
     def product_belief(self):
         if self.args.verbose>1: print("product_belief")
 
-        if self.args.use_gt_likelihood :
+        if self.particle_filter is not None:
+            # weight the particles, then the histogram of their weights is the belief
+            if self.args.pf_measure == 'scan':
+                self.particle_filter.update(self.scan_data.ranges, self.scan_data.angle_min, self.scan_data.angle_max, self.max_scan_range)
+            else:
+                self.particle_filter.update_grid(self.gtl_tensor() if self.args.use_gt_likelihood else self.likelihood)
+            self.belief = self.particle_filter.histogram()
+        elif self.args.use_gt_likelihood :
             # gt = torch.from_numpy(self.gt_likelihood/self.gt_likelihood.sum()).float().to(self.divice)
-            gt = torch.tensor(self.gt_likelihood).float().to(self.device)
-            self.belief = self.belief * (gt)
+            gt = self.gtl_tensor()
+            self.bel_filter.update(gt)
             #self.belief = self.belief * (self.gt_likelihood)
         else:
-            self.belief = self.belief * (self.likelihood)
-        #normalize belief
-        self.belief /= self.belief.sum()
-        #update bel_grid
-        guess = np.unravel_index(np.argmax(self.belief.cpu().detach().numpy(), axis=None), self.belief.shape)
-        self.bel_grid = Grid(head=guess[0],row=guess[1],col=guess[2])
+            self.bel_filter.update(self.likelihood)
+        if self.bel_window is not None:
+            self.bel_window.update(self.window_likelihood())
+        #update bel_grid, and what get_reward needs of the belief: one pass on the device, one transfer
+        true_pose = [[int(self.true_grid.head), int(self.true_grid.row), int(self.true_grid.col)]]
+        self.bel_stats = dict(zip(BeliefFilter.STATS, self.bel_filter.stats(true_pose)[0].tolist()))
+        self.bel_grid = Grid(head=int(self.bel_stats['head']),row=int(self.bel_stats['row']),col=int(self.bel_stats['col']))
 
 
     
@@ -2617,9 +2554,7 @@ class LocalizationNode(object):
         for afp, action_str in enumerate(action_space):
             virtual_target = self.get_virtual_target_pose(action_str)
             ### transit the belief according to the action
-            bel = self.belief.cpu().detach().numpy() # copy current belief into numpy
-            bel = self.trans_bel(bel, action_str)  # transition off the actual trajectory
-            bel = torch.from_numpy(bel).float().to(self.device)#$ requires_grad=True)
+            bel = self.trans_bel(self.belief.detach(), action_str)  # transition off the actual trajectory
             ent_diff = self.do_the_honors(virtual_target, bel)
             if ent_diff > max_ent_diff:
                 max_ent_diff = ent_diff
@@ -3069,7 +3004,7 @@ class LocalizationNode(object):
             x = to_real(self.true_grid.row, self.xlim, self.grid_rows)
             y = to_real(self.true_grid.col, self.ylim, self.grid_cols)
             offset = self.heading_resol*self.true_grid.head
-            ranges = self.get_a_scan(x, y, offset=offset, noise=0)
+            ranges = self.get_a_scan(x, y, offset=offset, noise=0, method='dda' if self.args.gtl_cache > 0 else None)
             params = {'ranges': ranges,
                       'angle_min': math.radians(mindeg),
                       'angle_max': math.radians(maxdeg),
@@ -3166,68 +3101,25 @@ class LocalizationNode(object):
 
     def transit_belief(self):
         if self.args.verbose>1: print("transit_belief")
-        self.belief = self.belief.cpu().detach().numpy()
         if self.collision == True:
-            self.belief = torch.from_numpy(self.belief).float().to(self.device)
             return
-        self.belief=self.trans_bel(self.belief, self.action_str)
-        self.belief = torch.from_numpy(self.belief).float().to(self.device)#$ requires_grad=True)
+        if self.particle_filter is not None:
+            self.particle_filter.predict(self.action_str)
+            return
+        if self.bel_window is not None:
+            self.bel_window.predict(self.action_str)
+        self.bel_filter.predict([self.action_str])
         
         
     def trans_bel(self, bel, action):
-        rotation_step = self.args.rot_step
-
-        if action == "turn_right":
-            bel=np.roll(bel,-rotation_step, axis=0)
-        elif action == "turn_left":
-            bel=np.roll(bel, rotation_step, axis = 0)
-        elif action == "go_fwd":
-            if self.args.trans_belief == "roll":
-                i=0
-                bel[i,:,:]=np.roll(bel[i,:,:], -1, axis=0)
-                i=1
-                bel[i,:,:]=np.roll(bel[i,:,:], -1, axis=1)
-                i=2
-                bel[i,:,:]=np.roll(bel[i,:,:], 1, axis=0)
-                i=3
-                bel[i,:,:]=np.roll(bel[i,:,:], 1, axis=1)
-
-            elif self.args.trans_belief == "stoch-shift" or self.args.trans_belief == "shift":
-                prior = bel.min()
-                for i in range(self.grid_dirs):
-                    theta = i * self.heading_resol
-                    fwd_dist = self.args.fwd_step
-                    dx = fwd_dist*np.cos(theta+np.pi)
-                    dy = fwd_dist*np.sin(theta+np.pi)
-                    # simpler way:
-                    DX = np.round(dx)
-                    DY = np.round(dy)
-                    shft_hrz = shift(bel[i,:,:], int(DY), axis=1, fill=prior)
-                    bel[i,:,:]=shift(shft_hrz, int(DX), axis=0, fill=prior)
-
-        if self.args.trans_belief == "stoch-shift" and action != "hold":
-            for ch in range(self.grid_dirs):
-                bel[ch,:,:] = ndimage.gaussian_filter(bel[ch,:,:], sigma=self.sigma_xy)
-            
-            n_dir = self.grid_dirs//4
-            p_roll = 0.20
-            roll_n = []
-            roll_p = []
-            for r in range(1, n_dir):
-                if roll_n == [] and roll_p == []:
-                    roll_n.append(p_roll*np.roll(bel,-1,axis=0))
-                    roll_p.append(p_roll*np.roll(bel, 1,axis=0))
-                else:
-                    roll_n.append(p_roll*np.roll(roll_n[-1],-1,axis=0))
-                    roll_p.append(p_roll*np.roll(roll_p[-1], 1,axis=0))
-            bel = sum(roll_n + roll_p)+bel                    
-        bel /= np.sum(bel)
-        return bel
+        # on the device of bel, one call per action
+        return self.transition(bel, action)
 
         
     def get_reward(self):
-        self.xyerrs.append(self.get_manhattan(self.belief.cpu().detach().numpy(), ignore_hd = True) )
-        self.manhattan = self.get_manhattan(self.belief.cpu().detach().numpy(), ignore_hd = False) #manhattan distance between gt and belief.
+        # bel_grid and bel_stats are set in product_belief: the belief itself stays on the device
+        self.xyerrs.append(self.bel_stats['xy_error'])
+        self.manhattan = self.bel_stats['manhattan'] #manhattan distance between gt and belief.
         self.manhattans.append(self.manhattan)
         if self.args.verbose > 2:
             print ("manhattans", len(self.manhattans))
@@ -3244,17 +3136,17 @@ class LocalizationNode(object):
         if self.args.rew_bel_new and self.new_bel: # and self.collision_attempt==0:
             self.reward_vector[1] += 1.0
             self.reward += 1.0
+        bel_gt = self.bel_stats['bel_gt']
         if self.args.rew_bel_gt: # and self.collision_attempt==0:
             N = self.grid_dirs*self.grid_rows*self.grid_cols
-            self.reward_vector[2] += torch.log(N*self.belief[self.true_grid.head,self.true_grid.row,self.true_grid.col]).item() #detach().cpu().numpy()
-            self.reward += torch.log(N*self.belief[self.true_grid.head,self.true_grid.row,self.true_grid.col]).item() #.data #detach().cpu().numpy()
+            self.reward_vector[2] += np.log(N*bel_gt)
+            self.reward += np.log(N*bel_gt)
 
         if self.args.rew_bel_gt_nonlog: # and self.collision_attempt==0:
-            self.reward_vector[2] += self.belief[self.true_grid.head,self.true_grid.row,self.true_grid.col].item()#detach().cpu().numpy()
-            self.reward += self.belief[self.true_grid.head, self.true_grid. row,self.true_grid.col].item()#detach().cpu().numpy()
+            self.reward_vector[2] += bel_gt
+            self.reward += bel_gt
 
         if self.args.rew_KL_bel_gt: # and self.collision_attempt==0:
-            bel_gt = self.belief[self.true_grid.head, self.true_grid.row, self.true_grid.col].item()#detach().cpu().numpy()
             N = self.grid_dirs*self.grid_rows*self.grid_cols
             new_bel_gt = 1.0/N * np.log(N*np.clip(bel_gt,1e-9,1.0))
             self.reward_vector[2] += new_bel_gt
@@ -3263,11 +3155,8 @@ class LocalizationNode(object):
         if self.args.rew_infogain: # and self.collision_attempt==0:
             #entropy = -p*log(p)
             # reward = -entropy, low entropy
-            bel = torch.clamp(self.belief, 1e-9, 1.0)
-            # info gain = p*log(p) - q*log(q)
-            # bel=self.belief
-            # info_gain = (bel * torch.log(bel)).sum().detach() - self.bel_ent
-            new_bel_ent = float((bel * torch.log(bel)).sum())
+            # info gain = p*log(p) - q*log(q), p clamped to [1e-9, 1]
+            new_bel_ent = self.bel_stats['neg_ent_clamped']
             info_gain = new_bel_ent - self.bel_ent
             self.bel_ent = new_bel_ent
             self.reward += info_gain 
@@ -3276,10 +3165,9 @@ class LocalizationNode(object):
         if self.args.rew_bel_ent: # and self.collision_attempt==0:
             #entropy = -p*log(p)
             # reward = -entropy, low entropy
-            # bel = torch.clamp(self.belief, 1e-9, 1.0)
-            bel=self.belief
-            self.reward += (bel * torch.log(bel)).sum().item() #detach().cpu().numpy()
-            self.reward_vector[3] += (bel * torch.log(bel)).sum().item() #detach().cpu().numpy()
+            neg_ent = self.bel_stats['neg_ent']
+            self.reward += neg_ent
+            self.reward_vector[3] += neg_ent
 
         if self.args.rew_hit: # and self.collision_attempt==0:
             self.reward += 1 if self.manhattan==0 else 0
@@ -3439,13 +3327,17 @@ class LocalizationNode(object):
 
         self.action_from_policy = -1
         self.action_idx = -1
-        self.bel_list = []
+        self.bel_set = set()
         self.step_count = 0
         self.collision = False
         # reset belief too
         self.belief[:,:,:]=1.0
         self.belief /= self.belief.sum()#np.sum(self.belief, dtype=float)
         self.bel_ent = (self.belief * torch.log(self.belief)).sum().detach()
+        if self.particle_filter is not None:
+            self.particle_filter.reset()
+        if self.bel_window is not None:
+            self.bel_window.reset()
 
         self.acc_epi_cnt +=1
         self.episode_count += 1
@@ -3613,7 +3505,7 @@ class LocalizationNode(object):
 
         if self.args.gtl_off == False:
             # generate synthetic scan data over the map (and directions)
-            self.get_synth_scan_mp(self.scans_over_map, map_img=self.map_for_LM, xlim=self.xlim, ylim=self.ylim) 
+            self.make_scans_over_map()
         self.reset_explored()
         self.update_current_pose_from_robot()
         self.update_true_grid()
@@ -3681,16 +3573,15 @@ class LocalizationNode(object):
             # process lidar data
             self.get_lidar(raw=False)
             time_mark = time.time()
-            self.do_scan_2d_n_headings()
+            self.preprocess_scan()
             print ("[TIME for SCAN TO 2D IMAGE] %.3f sec"%(time.time()-time_mark))
-            self.slide_scan()
             # do localization and action sampling
             self.update_explored()
             time_mark = time.time()            
             self.compute_gtl(self.scans_over_map)
             print ("[TIME for GTL] %.2f sec"%(time.time()-time_mark))
             time_mark = time.time()                        
-            self.likelihood = self.update_likelihood_rotate(self.map_for_LM, self.scan_2d)
+            self.likelihood = self.update_likelihood_rotate(self.map_for_LM, self.scan_points)
 
             print ("[TIME for LM] %.2f sec"%(time.time()-time_mark))            
             # if self.collision == False:
@@ -3841,7 +3732,7 @@ class LocalizationNode(object):
             print ("[NEW EPISODE]")
         self.action_from_policy = -1
         self.action_idx = -1
-        self.bel_list = []
+        self.bel_set = set()
         self.step_count = 0
         self.scan_cnt = 0
         self.collision = False
@@ -3849,6 +3740,10 @@ class LocalizationNode(object):
         self.belief[:,:,:]=1.0
         self.belief /= self.belief.sum()#np.sum(self.belief, dtype=float)
         self.bel_ent = (self.belief * torch.log(self.belief)).sum().detach()
+        if self.particle_filter is not None:
+            self.particle_filter.reset()
+        if self.bel_window is not None:
+            self.bel_window.reset()
 
         if self.args.load_init_poses=="none" and self.episode_count==0:
             cnt = 0
@@ -4010,6 +3905,9 @@ if __name__ == '__main__':
     parser.add_argument("--lidar-noise", help="number of random noisy rays in a scan", type=int, default=0)
     parser.add_argument("--lidar-sigma", help="sigma for lidar (1d) range", type=float, default=0)
     parser.add_argument("--scan-range", help="[min, max] scan range (m)", type=float, nargs=2, default=[0.10, 3.5])
+    parser.add_argument("--raycast", help="march: 1~2 cm random probe steps, dda: exact map cell traversal, edt: march that jumps by the clearance (distance transform) in open space", choices=['march','dda','edt'], default='march')
+    parser.add_argument("--scan-storage", help="dtype of scans_over_map: float64, float16 ranges or uint16 millimetres", choices=['float64','float16','mm'], default='float64')
+    parser.add_argument("--scan-cache", help="directory to keep scans_over_map by map content, reused across runs", type=str, default=None)
 
     ## VISUALIZE INFORMATION
     parser.add_argument("-v", "--verbose", help="increase output verbosity", type=int, default=0, nargs='?', const=1)
@@ -4029,6 +3927,11 @@ if __name__ == '__main__':
     parser.add_argument("--fwd-step", "-fs", type=int, default=1)
     parser.add_argument("--rot-step", "-rs", type=int, default=1)
     parser.add_argument("--sigma-xy", "-sxy", type=float, default=.5)
+    parser.add_argument("--localizer", help="histogram: Bayes filter on the (heading, row, col) grid, particle: particle filter projected onto that grid", choices=['histogram','particle'], default='histogram')
+    parser.add_argument("--n-particles", help="--localizer particle: number of particles", type=int, default=5000)
+    parser.add_argument("--belief-window", help="--localizer histogram: grid cells on a side of a finer belief window that follows the mode, refined by the GTL of its cells. 0: off", type=int, default=0)
+    parser.add_argument("--window-sub", help="--belief-window: fine cells per grid cell on a side", type=int, default=4)
+    parser.add_argument("--pf-measure", help="--localizer particle: weight by the scan end points on the map (scan) or by the likelihood of the grid cell (likelihood: LM, or GTL with --use-gt-likelihood)", choices=['scan','likelihood'], default='scan')
 
     ## RL-GENERAL
     parser.add_argument('--update-rl', dest='update_rl', action='store_true')
@@ -4071,6 +3974,10 @@ if __name__ == '__main__':
 
     ## TRUE LIKELIHOOD
     parser.add_argument("--gtl-src", help="source of GTL", choices=['hd-cos','hd-corr','hd-corr-clip'], default='hd-cos')
+    parser.add_argument("--gtl-kernel", help="hd-cos GTL. bank: reference scans normalized once per map, one matrix product per step, vec: all headings and cells at once in-process, fft: all 360 shifts at once then pooled to the headings, pool: cell by cell on the worker pool", choices=['bank','vec','fft','pool'], default='bank')
+    parser.add_argument("--sparse-gtl", help="keep only the top K poses of the GTL (and of likelihood, belief in saved roll-outs) plus a floor value. 0: dense", type=int, default=0)
+    parser.add_argument("--gtl-cache", help="keep the GTL of this many (map, true grid pose) pairs, least recently used out. 0: off. the unperturbed scan is then cast by dda", type=int, default=0)
+    parser.add_argument("--heading-pool", help="--gtl-kernel fft: sample the shift of each heading (same as vec), or max/mean over the shifts that round to it", choices=['sample','max','mean'], default='sample')
     parser.add_argument("--gtl-output", choices=['softmax','softermax','linear'], default='softmax')
     parser.add_argument("-go", "--gtl-off", action="store_true")
 
@@ -4081,7 +3988,8 @@ if __name__ == '__main__':
     parser.add_argument('--pm-net', help ="select PM network",
                         choices = ['none', 'densenet121', 'densenet169', 'densenet201', 'densenet161',
                                    'resnet18', 'resnet50', 'resnet101', 'resnet152',
-                                   'resnet18s', 'resnet50s', 'resnet101s', 'resnet152s'],
+                                   'resnet18s', 'resnet50s', 'resnet101s', 'resnet152s',
+                                   'split-resnet18', 'split-resnet34', 'split-resnet50'],
                         default='none')
     parser.add_argument('--pm-loss', choices=['L1','KL'], default='KL')
     parser.add_argument('--pm-scan-step', type=int, default=1)
@@ -0,0 +1,304 @@
+import numpy as np
+
+from scan_bank import decode_scans
+
+
+def cosine_sim(x, y):
+    # numpy arrays. over the rays that are numbers in both scans
+    non_inf_x = ~np.isinf(x)
+    non_nan_x = ~np.isnan(x)
+    non_inf_y = ~np.isinf(y)
+    non_nan_y = ~np.isnan(y)
+
+    numbers_only = non_inf_x & non_nan_x & non_inf_y & non_nan_y
+    x = x[numbers_only]
+    y = y[numbers_only]
+    return sum(x * y) / np.linalg.norm(y, 2) / np.linalg.norm(x, 2)
+
+
+def corr(x, y, clip=1):
+    mx = np.mean(x)
+    my = np.mean(y)
+    c = sum((x - mx) * (y - my)) / np.linalg.norm(y - my, 2) / np.linalg.norm(x - mx, 2)
+    if clip == 1:
+        return np.clip(c, 0, 1.0)
+    else:
+        return 0.5 * (c + 1.0)
+
+
+def gtl_cos_heading(ref_scans, y, heading, grid_dirs, free, scan_step=1, scan_range=(0.1, 3.5)):
+    # GTL of one heading: cosine similarity of the measured scan y against the reference scans
+    # rolled by the heading, on the free cells. 0 elsewhere.
+    # ref_scans in any of scan_bank.SCAN_DTYPES, here and in the other kernels.
+    offset = 360.0 / grid_dirs
+    X = decode_scans(np.roll(ref_scans, -int(offset * heading), axis=2)[:, :, ::scan_step])
+    X = np.clip(X, scan_range[0], scan_range[1])
+    gtl = np.zeros(free.shape)
+    for i_ld, j_ld in zip(*np.nonzero(free)):
+        gtl[i_ld, j_ld] = cosine_sim(X[i_ld, j_ld, :], y)
+    return gtl
+
+
+def gtl_corr_heading(ref_scans, y, heading, grid_dirs, free, scan_step=1, scan_range=(0.1, 3.5), clip=0):
+    # same as gtl_cos_heading with the correlation coefficient
+    offset = 360.0 / grid_dirs
+    X = decode_scans(np.roll(ref_scans, -int(offset * heading), axis=2)[:, :, ::scan_step])
+    X = np.clip(X, scan_range[0], scan_range[1])
+    gtl = np.zeros(free.shape)
+    for i_ld, j_ld in zip(*np.nonzero(free)):
+        gtl[i_ld, j_ld] = corr(X[i_ld, j_ld, :], y, clip=clip)
+    return gtl
+
+
+def heading_index(grid_dirs, scan_step=1):
+    # (grid_dirs, 360/scan_step) ray indices: row d is np.roll(scan, -int(offset*d))[::scan_step]
+    offset = 360.0 / grid_dirs
+    shifts = np.array([int(offset * d) for d in range(grid_dirs)])
+    return (np.arange(0, 360, scan_step)[np.newaxis, :] + shifts[:, np.newaxis]) % 360
+
+
+def gtl_cos(ref_scans, y, grid_dirs, free=None, scan_step=1, scan_range=(0.1, 3.5)):
+    # GTL of all headings and cells at once, (grid_dirs, rows, cols). same values as gtl_cos_heading:
+    # cosine similarity over the rays that are numbers (not nan/inf) in both scans, 0 off the free cells.
+    # instead of rolling the bank per heading, the measured scan is laid out on the 360 rays of
+    # each heading, so all the sums are products of (rows*cols, 360) and (360, grid_dirs) matrices.
+    rows, cols = ref_scans.shape[:2]
+    X = np.clip(decode_scans(ref_scans.reshape(rows * cols, 360)), scan_range[0], scan_range[1])
+    y = np.asarray(y, dtype=float)
+    valid_x = np.isfinite(X)
+    valid_y = np.isfinite(y)
+    X = np.where(valid_x, X, 0)
+    y = np.where(valid_y, y, 0)
+
+    Y = heading_layout(y, grid_dirs, scan_step)
+    V = heading_layout(valid_y.astype(float), grid_dirs, scan_step)
+    # masked dot products: rays missing in either scan drop out of the product and of both norms
+    dot = X.dot(Y)
+    xx = (X * X).dot(V)
+    yy = valid_x.astype(float).dot(Y * Y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gtl = dot / np.sqrt(xx) / np.sqrt(yy)
+    gtl = gtl.T.reshape(grid_dirs, rows, cols)
+    if free is not None:
+        gtl[:, ~free] = 0.0
+    return gtl
+
+
+def gtl_cos_at(ref_scans, y, rows, cols, grid_dirs, scan_step=1, scan_range=(0.1, 3.5)):
+    # gtl_cos at some cells of the bank only, (grid_dirs, len(rows)). with a per-pixel bank
+    # (parallel.build_scan_bank) this is the GTL at any point of the map, e.g. for a finer grid or pose refinement.
+    X = np.asarray(ref_scans[np.asarray(rows), np.asarray(cols)])
+    return gtl_cos(X[:, np.newaxis], y, grid_dirs, scan_step=scan_step, scan_range=scan_range)[:, :, 0]
+
+
+def bank_spectra(ref_scans, scan_range=(0.1, 3.5)):
+    # what gtl_cos_fft needs of the reference bank, once per map:
+    # the spectra of the clipped ranges, their squares and their validity, (rows*cols, 181) each
+    rows, cols = ref_scans.shape[:2]
+    X = np.clip(decode_scans(ref_scans.reshape(rows * cols, 360)), scan_range[0], scan_range[1])
+    valid_x = np.isfinite(X)
+    X = np.where(valid_x, X, 0)
+    return np.fft.rfft(X), np.fft.rfft(X * X), np.fft.rfft(valid_x.astype(float))
+
+
+def gtl_cos_shifts(ref_scans, y, scan_step=1, scan_range=(0.1, 3.5), spectra=None):
+    # cosine similarity for every shift s of every cell, (rows, cols, 360):
+    # np.roll(ref_scans, -s, axis=2)[:, :, ::scan_step] against y, masked as in gtl_cos.
+    # the three masked sums are circular cross-correlations, done by FFT for all 360 shifts at once.
+    rows, cols = ref_scans.shape[:2]
+    if spectra is None:
+        spectra = bank_spectra(ref_scans, scan_range)
+    fx, fxx, fvx = spectra
+    y = np.asarray(y, dtype=float)
+    valid_y = np.isfinite(y)
+    y360 = np.zeros(360)
+    v360 = np.zeros(360)
+    y360[::scan_step] = np.where(valid_y, y, 0)
+    v360[::scan_step] = valid_y
+    dot = np.fft.irfft(fx * np.conj(np.fft.rfft(y360)), 360)
+    xx = np.fft.irfft(fxx * np.conj(np.fft.rfft(v360)), 360)
+    yy = np.fft.irfft(fvx * np.conj(np.fft.rfft(y360 * y360)), 360)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sims = dot / np.sqrt(np.maximum(xx, 0)) / np.sqrt(np.maximum(yy, 0))
+    return sims.reshape(rows, cols, 360)
+
+
+def pool_headings(sims, grid_dirs, pool='sample'):
+    # (rows, cols, 360) similarities over shifts to (grid_dirs, rows, cols).
+    # sample: the shift of each heading, as gtl_cos. max/mean: over the shifts that round to the heading.
+    offset = 360.0 / grid_dirs
+    if pool == 'sample':
+        shifts = [int(offset * d) for d in range(grid_dirs)]
+        return np.moveaxis(sims[:, :, shifts], 2, 0)
+    bins = np.round(np.arange(360) / offset).astype(int) % grid_dirs
+    reduce = np.max if pool == 'max' else np.mean
+    return np.array([reduce(sims[:, :, bins == d], axis=2) for d in range(grid_dirs)])
+
+
+def gtl_cos_fft(ref_scans, y, grid_dirs, free=None, scan_step=1, scan_range=(0.1, 3.5), pool='sample',
+                spectra=None):
+    # gtl_cos for any number of headings at the cost of one: all 360 shifts by FFT, then pooled.
+    gtl = pool_headings(gtl_cos_shifts(ref_scans, y, scan_step, scan_range, spectra), grid_dirs, pool)
+    if free is not None:
+        gtl[:, ~free] = 0.0
+    return gtl
+
+
+def heading_layout(y, grid_dirs, scan_step=1):
+    # (360, grid_dirs): column d holds y on the rays that heading d compares it with, 0 elsewhere
+    idx = heading_index(grid_dirs, scan_step)
+    Y = np.zeros((360, grid_dirs))
+    Y[idx.ravel(), np.repeat(np.arange(grid_dirs), idx.shape[1])] = np.tile(y, grid_dirs)
+    return Y
+
+
+def cos_bank(ref_scans, grid_dirs, scan_step=1, scan_range=(0.1, 3.5)):
+    # what gtl_cos needs of the reference scans, once per map: the clipped scans with 0 for the rays
+    # that are not numbers (X), their squares (X2), their validity (V, None if all rays are numbers),
+    # and 1/|x| over the strided rays of every heading (inv_norm).
+    rows, cols = ref_scans.shape[:2]
+    X = np.clip(decode_scans(ref_scans.reshape(rows * cols, 360)), scan_range[0], scan_range[1])
+    valid_x = np.isfinite(X)
+    X = np.where(valid_x, X, 0)
+    with np.errstate(divide='ignore'):
+        inv_norm = 1.0 / np.sqrt((X * X).dot(heading_layout(np.ones(len(range(0, 360, scan_step))), grid_dirs, scan_step)))
+    return {'X': X, 'X2': X * X, 'V': None if valid_x.all() else valid_x.astype(float),
+            'inv_norm': inv_norm, 'grid_dirs': grid_dirs, 'scan_step': scan_step, 'shape': (rows, cols)}
+
+
+def gtl_cos_bank(bank, y, free=None):
+    # gtl_cos from a cos_bank. per step it is one matrix product, X.Y, scaled by the stored 1/|x|
+    # and by 1/|y|. corrections only when rays are missing: the norm of x over the rays valid in y
+    # when y has a fov gap, and the norm of y over the rays valid in x when x has any.
+    grid_dirs = bank['grid_dirs']
+    y = np.asarray(y, dtype=float)
+    valid_y = np.isfinite(y)
+    y = np.where(valid_y, y, 0)
+    Y = heading_layout(y, grid_dirs, bank['scan_step'])
+    gtl = bank['X'].dot(Y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if valid_y.all():
+            gtl *= bank['inv_norm']
+        else:
+            gtl /= np.sqrt(bank['X2'].dot(heading_layout(valid_y.astype(float), grid_dirs, bank['scan_step'])))
+        if bank['V'] is None:
+            gtl /= np.sqrt(y.dot(y))
+        else:
+            gtl /= np.sqrt(bank['V'].dot(Y * Y))
+    gtl = gtl.T.reshape((grid_dirs,) + bank['shape'])
+    if free is not None:
+        gtl[:, ~free] = 0.0
+    return gtl
+
+
+def sparse_top_k(p, k, min_floor=1e-12):
+    # the k largest entries of p by flat index, and one floor value for all the others:
+    # their mean, so the sum of p is kept. {'shape', 'index', 'value', 'floor'}
+    # no pose gets less than min_floor, e.g. when a sharp softmax leaves nothing outside the top k,
+    # so the likelihood is never zero. then all is rescaled to the sum of p again
+    p = np.asarray(p, dtype=np.float64)
+    flat = p.ravel()
+    k = min(k, flat.size)
+    index = np.argpartition(flat, flat.size - k)[flat.size - k:]
+    value = flat[index]
+    rest = flat.size - k
+    total = flat.sum()
+    floor = (total - value.sum()) / rest if rest > 0 else 0.0
+    if value.min() < min_floor or (rest > 0 and floor < min_floor):
+        floor = max(floor, min_floor)
+        value = np.maximum(value, min_floor)
+        scale = total / (value.sum() + rest * floor)
+        if scale > 0:
+            value = value * scale
+            floor = max(floor * scale, min_floor)
+    return {'shape': p.shape, 'index': index.astype(np.int32), 'value': value.astype(np.float32),
+            'floor': float(floor)}
+
+
+def sparse_to_dense(sp):
+    p = np.full(int(np.prod(sp['shape'])), sp['floor'])
+    p[sp['index']] = sp['value']
+    return p.reshape(sp['shape'])
+
+
+if __name__ == "__main__":
+    # the vectorized kernel against the cell-by-cell one, 33x33 cells x 36 headings
+    import time
+    rows, cols, dirs, step = 33, 33, 36, 3
+    ref_scans = np.random.uniform(0.1, 3.5, (rows, cols, 360))
+    ref_scans[np.random.rand(rows, cols, 360) < 0.05] = np.inf
+    ref_scans[:, :, 130:230] = np.where(np.random.rand(rows, cols, 1) < 0.2, np.nan, ref_scans[:, :, 130:230])
+    y = np.clip(ref_scans[10, 20, ::step], 0.1, 3.5)
+    y[(np.arange(y.size) * step > 130) & (np.arange(y.size) * step < 230)] = np.nan
+    free = np.random.rand(rows, cols) > 0.3
+
+    mark = time.time()
+    ref = np.array([gtl_cos_heading(ref_scans, y, d, dirs, free, scan_step=step) for d in range(dirs)])
+    t_loop = time.time() - mark
+    mark = time.time()
+    out = gtl_cos(ref_scans, y, dirs, free, scan_step=step)
+    t_vec = time.time() - mark
+    print('loop %.3f sec, vectorized %.3f sec' % (t_loop, t_vec))
+    assert np.allclose(ref, out, equal_nan=True)
+    assert np.isclose(out[0, 10, 20], 1.0) or not free[10, 20]
+
+    # the normalized bank: one matrix-vector product per step
+    mark = time.time()
+    bank = cos_bank(ref_scans, dirs, scan_step=step)
+    t_bank = time.time() - mark
+    mark = time.time()
+    out = gtl_cos_bank(bank, y, free)
+    t_step = time.time() - mark
+    print('bank %.4f sec per step (%.3f sec once per map)' % (t_step, t_bank))
+    assert np.allclose(ref, out, equal_nan=True)
+    y_full = np.clip(ref_scans[3, 4, ::step], 0.1, 3.5)
+    mark = time.time()
+    out = gtl_cos_bank(bank, y_full, free)
+    print('bank %.4f sec per step without fov gap' % (time.time() - mark))
+    assert np.allclose(gtl_cos(ref_scans, y_full, dirs, free, scan_step=step), gtl_cos_bank(bank, y_full, free), equal_nan=True)
+
+    # FFT over all 360 shifts, pooled to the headings
+    spectra = bank_spectra(ref_scans)
+    for n_dirs in [4, 8, 12, 16, 24, 36, 360]:
+        mark = time.time()
+        out = gtl_cos_fft(ref_scans, y, n_dirs, free, scan_step=step, spectra=spectra)
+        t_fft = time.time() - mark
+        mark = time.time()
+        ref = gtl_cos(ref_scans, y, n_dirs, free, scan_step=step)
+        t_vec = time.time() - mark
+        print('%d headings: vectorized %.4f sec, fft %.4f sec (bank spectra once per map)' % (n_dirs, t_vec, t_fft))
+        assert np.allclose(ref, out, equal_nan=True)
+    out = gtl_cos_fft(ref_scans, y, 8, free, scan_step=step, pool='max', spectra=spectra)
+    assert (np.nan_to_num(out) >= np.nan_to_num(gtl_cos(ref_scans, y, 8, free, scan_step=step)) - 1e-9).all()
+
+    # a few cells only
+    rr, cc = np.nonzero(free)
+    assert np.allclose(gtl_cos(ref_scans, y, dirs, free, scan_step=step)[:, rr, cc],
+                       gtl_cos_at(ref_scans, y, rr, cc, dirs, scan_step=step), equal_nan=True)
+
+    # compact banks are read as they are stored
+    from scan_bank import SCAN_DTYPES, encode_scans
+    ref = gtl_cos(ref_scans, y, dirs, free, scan_step=step)
+    for storage in ['float16', 'mm']:
+        compact = encode_scans(ref_scans, SCAN_DTYPES[storage])
+        mark = time.time()
+        out = gtl_cos_bank(cos_bank(compact, dirs, scan_step=step), y, free)
+        print('%s bank: max GTL error %.1e (%.3f sec)' % (storage, np.nanmax(np.abs(out - ref)), time.time() - mark))
+        assert np.allclose(ref, out, atol=1e-4, equal_nan=True)
+        assert np.allclose(ref, gtl_cos(compact, y, dirs, free, scan_step=step), atol=1e-4, equal_nan=True)
+        assert np.allclose(ref[2], gtl_cos_heading(compact, y, 2, dirs, free, scan_step=step), atol=1e-4, equal_nan=True)
+
+    # top-k with a floor keeps the mass and the peak of a peaked GTL
+    gtl = np.exp((np.nan_to_num(gtl_cos(ref_scans, y, dirs, free, scan_step=step)) - 1) / 0.01)
+    gtl /= gtl.sum()
+    sp = sparse_top_k(gtl, 100)
+    approx = sparse_to_dense(sp)
+    print('top-100 of %d poses hold %.4f of the mass' % (gtl.size, sp['value'].sum()))
+    assert np.isclose(approx.sum(), 1.0) and np.argmax(approx) == np.argmax(gtl)
+    # nothing left outside the top k: a small positive floor, no pose at zero, still a distribution
+    peaked = np.zeros_like(gtl)
+    peaked.flat[np.argmax(gtl)] = 1.0
+    sp = sparse_top_k(peaked, 100)
+    approx = sparse_to_dense(sp)
+    assert sp['floor'] > 0 and (approx > 0).all() and np.isclose(approx.sum(), 1.0)
+    assert np.isfinite(np.log(approx)).all() and np.argmax(approx) == np.argmax(gtl)
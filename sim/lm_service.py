@@ -0,0 +1,200 @@
+import time
+import queue
+import multiprocessing
+import numpy as np
+import torch
+
+from parallel import shared_array
+
+
+def _serve(make_model, device, inputs, outputs, errors, done, requests, counters, max_batch, max_wait, alive):
+    # the server process, with the only copy of the model.
+    # a batch is the first request waiting plus those that come within max_wait, up to max_batch images.
+    # alive is never written: the clients see it closed when this process is gone
+    model = make_model().to(device).eval()
+    per_request = inputs.shape[1]
+    stop = False
+    while not stop:
+        first = requests.get()
+        if first is None:
+            break
+        batch = [first]
+        deadline = time.time() + max_wait
+        while (len(batch) + 1) * per_request <= max_batch:
+            try:
+                i = requests.get(timeout=max(deadline - time.time(), 1e-4))
+            except queue.Empty:
+                break
+            if i is None:
+                stop = True
+                break
+            batch.append(i)
+        mark = time.time()
+        try:
+            x = torch.from_numpy(inputs[batch].reshape((-1,) + inputs.shape[2:])).to(device)
+            with torch.no_grad():
+                y = model(x).cpu().numpy()
+            outputs[batch] = y.reshape((len(batch), per_request, -1))
+        except Exception as e:
+            # e.g. out of memory: the clients of this batch raise it, the server goes on
+            message = np.frombuffer(('%s: %s' % (type(e).__name__, e)).encode()[:errors.shape[1] - 1], np.uint8)
+            for i in batch:
+                errors[i, :len(message)] = message
+        counters[0] += len(batch)
+        counters[1] += 1
+        counters[2] += time.time() - mark
+        for i in batch:
+            done[i].set()
+
+
+class LMService:
+    # one copy of the LM for n_clients simulator processes (LocalizationNode, lm=client).
+    # a server process runs their requests, input_shape (e.g. (grid_dirs, 2, 224, 224)) each,
+    # in batches of up to max_batch images (default: one request of every client),
+    # waiting at most max_wait sec after the first request for the others to join.
+    # inputs and outputs stay in shared memory, so a request is an index on a queue and an event back.
+    # make_model builds the model in the server process, so e.g. CUDA is initialised there only.
+    # make the service, then fork the clients: client(i) is used in process i only.
+    def __init__(self, make_model, n_clients, input_shape, n_outputs, max_batch=0, max_wait=0.005, device='cpu'):
+        self.per_request = input_shape[0]
+        self.inputs = shared_array((n_clients,) + tuple(input_shape), np.float32)
+        self.outputs = shared_array((n_clients, input_shape[0], n_outputs), np.float32)
+        # the error of the last request of each client, empty if none
+        self.errors = shared_array((n_clients, 512), np.uint8)
+        # requests, batches, seconds in the model
+        self.counters = shared_array((3,))
+        self.done = [multiprocessing.Event() for _ in range(n_clients)]
+        self.requests = multiprocessing.Queue()
+        self.start = time.time()
+        # only the server holds the writing end, so the reading end is at EOF once it is gone,
+        # in the clients as well (Process.is_alive works in this process only)
+        self.alive, alive = multiprocessing.Pipe(duplex=False)
+        self.server = multiprocessing.Process(target=_serve,
+                                              args=(make_model, device, self.inputs, self.outputs, self.errors,
+                                                    self.done, self.requests, self.counters,
+                                                    max_batch or n_clients * input_shape[0], max_wait, alive))
+        self.server.daemon = True
+        self.server.start()
+        alive.close()
+
+    def client(self, i):
+        return LMClient(self, i)
+
+    def is_alive(self):
+        return not self.alive.poll()
+
+    def stats(self):
+        # throughput counters since the start
+        requests, batches, busy = self.counters
+        elapsed = time.time() - self.start
+        return {'requests': int(requests), 'batches': int(batches),
+                'images_per_batch': requests * self.per_request / max(batches, 1),
+                'images_per_sec': requests * self.per_request / elapsed,
+                'busy': busy / elapsed}
+
+    def close(self):
+        self.requests.put(None)
+        self.server.join()
+
+
+class LMClient:
+    # raises RuntimeError if the model fails on the request or the server is gone
+    def __init__(self, service, index, poll=1.0):
+        self.index = index
+        self.service = service
+        self.input = service.inputs[index]
+        self.output = service.outputs[index]
+        self.error = service.errors[index]
+        self.done = service.done[index]
+        self.requests = service.requests
+        self.poll = poll
+
+    def __call__(self, input_batch):
+        # model(input_batch) (no graph) as a numpy array, input_shape[0] rows of n_outputs
+        self.input[:] = np.asarray(input_batch)
+        self.error[:] = 0
+        self.done.clear()
+        self.requests.put(self.index)
+        while not self.done.wait(self.poll):
+            if not self.service.is_alive():
+                raise RuntimeError('LM service: the server process is gone')
+        if self.error[0]:
+            raise RuntimeError('LM service: ' + bytes(self.error).rstrip(b'\0').decode(errors='replace'))
+        return np.array(self.output)
+
+
+if __name__ == "__main__":
+    import torch.nn as nn
+    # n simulator workers asking for 4 headings each: one served model against a copy per worker.
+    # a small conv net stands in for the LM
+    n_workers, n_steps = 4, 20
+    shape = (4, 2, 224, 224)
+
+    def make_model():
+        torch.manual_seed(0)
+        return nn.Sequential(nn.Conv2d(2, 16, 7, stride=4), nn.ReLU(), nn.Conv2d(16, 32, 5, stride=4), nn.ReLU(),
+                             nn.AdaptiveAvgPool2d(4), nn.Flatten(), nn.Linear(512, 121))
+
+    def own_copy(out, worker):
+        torch.set_num_threads(1)
+        model = make_model().eval()
+        for step in range(n_steps):
+            x = torch.rand(shape)
+            with torch.no_grad():
+                out[worker, step] = model(x).numpy()
+
+    def served(out, lm, worker):
+        torch.manual_seed(worker)
+        for step in range(n_steps):
+            x = torch.rand(shape)
+            out[worker, step] = lm(x)
+
+    for name in ['own copy', 'served']:
+        out = shared_array((n_workers, n_steps) + (4, 121), np.float32)
+        if name == 'served':
+            service = LMService(make_model, n_workers, shape, 121, max_wait=0.01)
+            procs = [multiprocessing.Process(target=served, args=(out, service.client(i), i)) for i in range(n_workers)]
+        else:
+            procs = [multiprocessing.Process(target=own_copy, args=(out, i)) for i in range(n_workers)]
+        mark = time.time()
+        [pro.start() for pro in procs]
+        [pro.join() for pro in procs]
+        print('%s: %.1f images/sec' % (name, n_workers * n_steps * shape[0] / (time.time() - mark)))
+    stats = service.stats()
+    print('served: %d requests in %d batches, %.1f images per batch' % (stats['requests'], stats['batches'], stats['images_per_batch']))
+    service.close()
+    assert stats['requests'] == n_workers * n_steps
+    # the outputs are those of the model for each worker's own inputs
+    model = make_model().eval()
+    for worker in range(n_workers):
+        torch.manual_seed(worker)
+        for step in range(n_steps):
+            x = torch.rand(shape)
+            with torch.no_grad():
+                assert np.allclose(out[worker, step], model(x).numpy(), atol=1e-5)
+
+    # a model error comes back to the client that sent the batch, and the server goes on
+    service = LMService(make_model, 1, (4, 3, 224, 224), 121)
+    lm = service.client(0)
+    try:
+        lm(np.zeros((4, 3, 224, 224), np.float32))
+        assert False
+    except RuntimeError as e:
+        print('model error: %s' % str(e)[:80])
+    service.close()
+    # a server that dies (here in make_model) makes its clients raise instead of wait
+    def broken_model():
+        raise MemoryError('no model')
+    service = LMService(broken_model, 1, shape, 121)
+    result = multiprocessing.Queue()
+
+    def ask(lm):
+        try:
+            lm(np.zeros(shape, np.float32))
+            result.put('answered')
+        except RuntimeError as e:
+            result.put(str(e))
+    pro = multiprocessing.Process(target=ask, args=(service.client(0),))
+    pro.start()
+    print('dead server: %s' % result.get(timeout=10))
+    pro.join()
@@ -0,0 +1,281 @@
+import os
+import time
+import fcntl
+import ctypes
+import multiprocessing
+import numpy as np
+
+from utils import to_real
+from raycast import cast_scans, clearance_map
+from gtl import gtl_cos_heading, gtl_corr_heading
+from scan_bank import SCAN_DTYPES, encode_scans
+
+
+def shared_array(shape, dtype=np.float64):
+    # zero-filled ndarray in shared memory. forked workers write their own slices of it
+    # in place and the parent reads them back as is: no pickling, no Manager process.
+    # no lock, so workers must write disjoint slices.
+    dtype = np.dtype(dtype)
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    buf = multiprocessing.RawArray(ctypes.c_char, max(n_bytes, 1))
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def split_range(n, n_workers):
+    # [0, n) into at most n_workers contiguous chunks, the first n % n_workers one longer
+    chunks = []
+    accum = 0
+    for worker in range(min(n_workers, n)):
+        size = n // n_workers
+        if worker < n % n_workers:
+            size += 1
+        chunks.append(range(accum, accum + size))
+        accum += size
+    return chunks
+
+
+# what a pool worker holds: the shared buffers and the settings of the node, set once at fork
+_worker = {}
+
+
+def _init_worker(state):
+    _worker.update(state)
+
+
+def _cast_places(places):
+    w = _worker
+    places = np.array(places)
+    rows, cols = w['free'].shape
+    x_real = to_real(places // cols, w['xlim'], rows)
+    y_real = to_real(places % cols, w['ylim'], cols)
+    clearance = w['clearance'] if w['raycast'] == 'edt' else None
+    w['scans_out'][places] = cast_scans(w['map_img'], x_real, y_real, w['xlim'], w['ylim'], w['scan_range'],
+                                        scan_step=w['scan_step'], method=w['raycast'], clearance=clearance)
+
+
+def _gtl_cos(my_dirs, y):
+    w = _worker
+    for heading in my_dirs:
+        w['gtl'][heading] = gtl_cos_heading(w['scans'], y, heading, w['gtl'].shape[0], w['free'],
+                                            scan_step=w['scan_step'], scan_range=w['scan_range'])
+
+
+def _gtl_corr(my_dirs, y, clip):
+    w = _worker
+    for heading in my_dirs:
+        w['gtl'][heading] = gtl_corr_heading(w['scans'], y, heading, w['gtl'].shape[0], w['free'],
+                                             scan_step=w['scan_step'], scan_range=w['scan_range'], clip=clip)
+
+
+def _cast_rows(rows):
+    # one row block of a bank on disk: cast, write, flush. the parent marks the rows done after that
+    w = _worker
+    bank = np.load(w['partial'], mmap_mode='r+')
+    n_rows, n_cols = bank.shape[:2]
+    rows = np.array(rows)
+    x_real = to_real(np.repeat(rows, n_cols), w['xlim'], n_rows)
+    y_real = to_real(np.tile(np.arange(n_cols), len(rows)), w['ylim'], n_cols)
+    scans = cast_scans(w['map_img'], x_real, y_real, w['xlim'], w['ylim'], w['scan_range'],
+                       scan_step=w['scan_step'], method=w['raycast'], clearance=w['clearance'])
+    scans = np.clip(scans, w['scan_range'][0], w['scan_range'][1])
+    bank[rows] = encode_scans(scans.reshape(len(rows), n_cols, 360), bank.dtype)
+    bank.flush()
+    del bank
+    return rows
+
+
+def build_scan_bank(path, map_img, xlim, ylim, scan_range, shape=None, scan_step=1, raycast='dda',
+                    storage='float64', n_workers=4, block_rows=4, verbose=True):
+    # reference scans from the center of every cell of a shape (rows, cols) grid over the map,
+    # by default one per map pixel, written into <path>.partial as row blocks come back from the workers
+    # and renamed to path after the last one, so path is always a complete bank.
+    # the rows already written are kept in <path>.partial.rows.npy, so an interrupted build resumes
+    # where it stopped. one process builds a given path at a time (<path>.lock), the others wait for it.
+    # returns the bank memory-mapped read-only.
+    shape = tuple(shape or map_img.shape)
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            _build_scan_bank(path, map_img, xlim, ylim, scan_range, shape, scan_step, raycast, storage,
+                             n_workers, block_rows, verbose)
+    return np.load(path, mmap_mode='r')
+
+
+def _build_scan_bank(path, map_img, xlim, ylim, scan_range, shape, scan_step, raycast, storage,
+                     n_workers, block_rows, verbose):
+    partial = path + '.partial'
+    progress_path = partial + '.rows.npy'
+    if os.path.exists(partial) and os.path.exists(progress_path):
+        done = np.load(progress_path)
+    else:
+        # the progress file is written after the memmap, so a partial bank without one is not trusted
+        np.lib.format.open_memmap(partial, mode='w+', dtype=SCAN_DTYPES[storage], shape=shape + (360,)).flush()
+        done = np.zeros(shape[0], dtype=bool)
+        np.save(progress_path, done)
+    todo = np.flatnonzero(~done)
+    blocks = [todo[i:i + block_rows] for i in range(0, len(todo), block_rows)]
+    state = {'partial': partial, 'map_img': np.array(map_img), 'xlim': np.array(xlim), 'ylim': np.array(ylim),
+             'scan_range': tuple(scan_range), 'scan_step': scan_step, 'raycast': raycast,
+             'clearance': clearance_map(map_img, xlim, ylim) if raycast == 'edt' else None}
+    n_rays = shape[1] * len(range(0, 360, scan_step))
+    n_done = 0
+    mark = time.time()
+    pool = multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(state,))
+    try:
+        for i_block, rows in enumerate(pool.imap_unordered(_cast_rows, blocks)):
+            done[rows] = True
+            np.save(progress_path, done)
+            n_done += len(rows)
+            if verbose and (i_block % 8 == 7 or i_block == len(blocks) - 1):
+                print('scan bank %d/%d rows, %.2e rays/s' % (done.sum(), shape[0], n_rays * n_done / (time.time() - mark)))
+    finally:
+        pool.close()
+        pool.join()
+    os.rename(partial, path)
+    os.remove(progress_path)
+
+
+class WorkerPool:
+    # long-lived workers for ray casting and GTL, forked once.
+    # the map, its free cells and the reference scans are kept in shared memory,
+    # so each call only sends the work items (places, headings, the measured scan).
+    # storage: dtype of the shared reference scans, see scan_bank.SCAN_DTYPES
+    def __init__(self, n_workers, map_shape, grid_shape, grid_dirs, xlim, ylim, scan_range,
+                 scan_step=1, raycast='march', storage='float64'):
+        self.n_workers = n_workers
+        self.grid_dirs = grid_dirs
+        self.grid_shape = tuple(grid_shape)
+        self.n_places = grid_shape[0] * grid_shape[1]
+        self.scans_src = None
+        self.state = {'map_img': shared_array(map_shape),
+                      'clearance': shared_array(map_shape),
+                      'free': shared_array(grid_shape, dtype=bool),
+                      'scans': shared_array(self.grid_shape + (360,), dtype=SCAN_DTYPES[storage]),
+                      'scans_out': shared_array((self.n_places, 360)),
+                      'gtl': shared_array((grid_dirs,) + self.grid_shape),
+                      'xlim': np.array(xlim), 'ylim': np.array(ylim),
+                      'scan_range': tuple(scan_range), 'scan_step': scan_step, 'raycast': raycast}
+        self.pool = multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(self.state,))
+
+    def set_map(self, map_img, free, clearance=None):
+        # free: grid cells where the GTL is computed
+        self.state['map_img'][:] = map_img
+        self.state['free'][:] = free
+        if clearance is not None:
+            self.state['clearance'][:] = clearance
+
+    def set_scans(self, scans):
+        self.state['scans'][:] = encode_scans(scans, self.state['scans'].dtype) if scans.dtype != self.state['scans'].dtype else scans
+        self.scans_src = scans
+
+    def synth_scans(self):
+        # noise-free scans from the center of every grid cell, (n_places, 360). read it before the next call.
+        self.pool.map(_cast_places, split_range(self.n_places, self.n_workers))
+        return self.state['scans_out']
+
+    def gtl_cossim(self, y):
+        chunks = split_range(self.grid_dirs, self.n_workers)
+        self.pool.starmap(_gtl_cos, [(my_dirs, y) for my_dirs in chunks])
+        return np.array(self.state['gtl'])
+
+    def gtl_corr(self, y, clip=0):
+        chunks = split_range(self.grid_dirs, self.n_workers)
+        self.pool.starmap(_gtl_corr, [(my_dirs, y, clip) for my_dirs in chunks])
+        return np.array(self.state['gtl'])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+if __name__ == "__main__":
+    import time
+
+    def work(out, my_rows):
+        for i in my_rows:
+            out[i] = i
+
+    out = shared_array((33, 33, 360))
+    mark = time.time()
+    procs = [multiprocessing.Process(target=work, args=[out, rows]) for rows in [range(0, 9), range(9, 17), range(17, 25), range(25, 33)]]
+    [pro.start() for pro in procs]
+    [pro.join() for pro in procs]
+    print('%.3f sec' % (time.time() - mark))
+    assert (out == np.arange(33)[:, np.newaxis, np.newaxis]).all()
+
+    # the pool against per-call processes, on the SAIT map with an 11x11x4 grid
+    import os
+    from gtl import gtl_cos_heading
+    map_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps', 'mlab-02-map-224x224.npy')
+    map_img = np.load(map_file)
+    xlim = ylim = (-4.48, 4.48)
+    scan_range = (0.1, 3.5)
+    free = np.ones((11, 11), dtype=bool)
+    workers = WorkerPool(4, map_img.shape, (11, 11), 4, xlim, ylim, scan_range, scan_step=3)
+    workers.set_map(map_img, free)
+    mark = time.time()
+    scans = np.clip(workers.synth_scans().reshape(11, 11, 360), scan_range[0], scan_range[1])
+    print('scans over map %.3f sec' % (time.time() - mark))
+    workers.set_scans(scans)
+    y = scans[5, 5, ::3]
+    mark = time.time()
+    for _ in range(10):
+        gtl = workers.gtl_cossim(y)
+    print('pool: %.4f sec per GTL' % ((time.time() - mark) / 10))
+
+    def gtl_proc(out, my_dirs):
+        for heading in my_dirs:
+            out[heading] = gtl_cos_heading(scans, y, heading, 4, free, scan_step=3, scan_range=scan_range)
+
+    mark = time.time()
+    for _ in range(10):
+        out = shared_array((4, 11, 11))
+        procs = [multiprocessing.Process(target=gtl_proc, args=[out, my_dirs]) for my_dirs in split_range(4, 4)]
+        [pro.start() for pro in procs]
+        [pro.join() for pro in procs]
+    print('per-call processes: %.4f sec per GTL' % ((time.time() - mark) / 10))
+    assert np.allclose(gtl, out)
+    assert np.isclose(gtl[0, 5, 5], 1.0)
+    workers.close()
+
+    # a per-pixel bank on disk, interrupted and resumed
+    import tempfile
+    from scan_bank import decode_scans
+    path = os.path.join(tempfile.mkdtemp(), 'high.npy')
+    build_scan_bank(path, map_img, xlim, ylim, scan_range, shape=(224, 224), scan_step=3, storage='mm',
+                    block_rows=16, verbose=False)
+    assert not os.path.exists(path + '.partial') and not os.path.exists(path + '.partial.rows.npy')
+    os.rename(path, path + '.partial')
+    done = np.zeros(224, dtype=bool)
+    done[:100] = True
+    np.save(path + '.partial.rows.npy', done)
+    bank = np.load(path + '.partial', mmap_mode='r+')
+    bank[100:] = 0
+    bank.flush()
+    del bank
+    mark = time.time()
+    bank = build_scan_bank(path, map_img, xlim, ylim, scan_range, scan_step=3, storage='mm')
+    print('resumed 124 rows in %.2f sec' % (time.time() - mark))
+    assert not os.path.exists(path + '.partial.rows.npy') and (bank[100:, :, ::3] > 0).all()
+    # a partial bank without its progress file (killed right after creating it) is built again
+    path2 = os.path.join(os.path.dirname(path), 'high2.npy')
+    np.lib.format.open_memmap(path2 + '.partial', mode='w+', dtype=np.uint16, shape=(224, 224, 360)).flush()
+    bank2 = build_scan_bank(path2, map_img, xlim, ylim, scan_range, scan_step=3, storage='mm', verbose=False)
+    assert (bank2[:, :, ::3] == bank[:, :, ::3]).all()
+    # two processes asking for the same bank: one builds it, the other waits and reads it
+    path3 = os.path.join(os.path.dirname(path), 'high3.npy')
+    builders = [multiprocessing.Process(target=build_scan_bank, args=(path3, map_img, xlim, ylim, scan_range),
+                                        kwargs={'scan_step': 3, 'storage': 'mm', 'verbose': False}) for _ in range(2)]
+    [pro.start() for pro in builders]
+    [pro.join() for pro in builders]
+    assert all(pro.exitcode == 0 for pro in builders)
+    assert (np.load(path3, mmap_mode='r')[:, :, ::3] == bank[:, :, ::3]).all()
+    # the pixels at the centers of the 11x11 grid cells
+    centers = (np.arange(11) * 224 + 112) // 11
+    ref = cast_scans(map_img, to_real(np.repeat(centers, 11), xlim, 224), to_real(np.tile(centers, 11), ylim, 224),
+                     xlim, ylim, scan_range, scan_step=3, method='dda')
+    assert np.allclose(decode_scans(bank[centers][:, centers]).reshape(121, 360), np.clip(ref, 0.1, 3.5), atol=1e-3)
@@ -0,0 +1,219 @@
+import math
+import numpy as np
+import torch
+
+from raycast import clearance_map
+
+
+def wrap_t(theta):
+    # torch version of utils.wrap: angles to [-pi, pi)
+    return torch.remainder(theta + math.pi, 2 * math.pi) - math.pi
+
+
+class ParticleFilter:
+    # Monte Carlo localization with a fixed budget of particles (x, y, theta) in metres and radians,
+    # on the device. the cost of a step depends on n_particles and n_beams, not on the grid.
+    # predict: the commanded step of the action plus gaussian noise of process_error (at least min_noise),
+    # update: the end points of the scan against a likelihood field of the map (or, update_grid,
+    # a (grid_dirs, rows, cols) likelihood read at the cell of each particle),
+    # then low variance resampling when the effective sample size drops below resample_ratio.
+    # histogram() projects the weights onto the (grid_dirs, rows, cols) belief of the node.
+    def __init__(self, n_particles, grid_dirs, rows, cols, xlim, ylim, fwd_step, rot_step,
+                 process_error=(0, 0), min_noise=(0.02, 0.02), sigma_hit=0.3, z_rand=0.05, n_beams=20,
+                 resample_ratio=0.5, floor=1e-6, device=None, dtype=torch.float32):
+        self.n = n_particles
+        self.shape = (grid_dirs, rows, cols)
+        self.xlim = (float(xlim[0]), float(xlim[1]))
+        self.ylim = (float(ylim[0]), float(ylim[1]))
+        self.fwd_step = fwd_step
+        self.rot_step = rot_step
+        self.sigma_xy = max(process_error[0], min_noise[0])
+        self.sigma_theta = max(process_error[1], min_noise[1])
+        self.sigma_hit = sigma_hit
+        self.z_rand = z_rand
+        self.n_beams = n_beams
+        self.resample_ratio = resample_ratio
+        # every cell of the projection keeps at least this much of the mass, so log(belief) stays finite
+        self.floor = floor
+        self.device = device
+        self.dtype = dtype
+        self.particles = torch.zeros((n_particles, 3), dtype=dtype, device=device)
+        self.log_w = torch.full((n_particles,), -math.log(n_particles), dtype=dtype, device=device)
+        self.map_shape = None
+
+    def set_map(self, map_img):
+        # the likelihood field: log(z_hit * N(distance to the nearest wall; sigma_hit) + z_rand) per map cell,
+        # and the free cells, where reset puts the particles. once per map
+        self.map_shape = map_img.shape
+        dist = clearance_map(map_img, self.xlim, self.ylim)
+        field = (1 - self.z_rand) * np.exp(-0.5 * (dist / self.sigma_hit) ** 2) + self.z_rand
+        self.log_field = torch.tensor(np.log(field).ravel(), dtype=self.dtype, device=self.device)
+        free = np.asarray(map_img) < 0.5
+        # a particle inside a wall keeps a little weight, so the filter survives a map that is slightly off
+        self.log_wall = torch.tensor(np.where(free, 0.0, math.log(1e-3)).ravel(), dtype=self.dtype, device=self.device)
+        self.free_cells = torch.tensor(np.flatnonzero(free), device=self.device)
+
+    def reset(self):
+        # uniform over the free map cells and the headings
+        rows, cols = self.map_shape
+        pick = self.free_cells[torch.randint(len(self.free_cells), (self.n,), device=self.device)]
+        u = torch.rand((self.n, 3), dtype=self.dtype, device=self.device)
+        x = self.xlim[1] - (self.xlim[1] - self.xlim[0]) / rows * ((pick // cols).to(self.dtype) + u[:, 0])
+        y = self.ylim[1] - (self.ylim[1] - self.ylim[0]) / cols * ((pick % cols).to(self.dtype) + u[:, 1])
+        self.particles = torch.stack((x, y, (u[:, 2] * 2 - 1) * math.pi), dim=1)
+        self.log_w = torch.full((self.n,), -math.log(self.n), dtype=self.dtype, device=self.device)
+
+    def predict(self, action):
+        # None (a blocked move) and hold leave the particles where they are
+        if action is None or action == 'hold':
+            return
+        x, y, theta = self.particles.unbind(1)
+        if action == 'turn_left':
+            theta = theta + self.rot_step
+        elif action == 'turn_right':
+            theta = theta - self.rot_step
+        elif action == 'go_fwd':
+            x = x + torch.cos(theta) * self.fwd_step
+            y = y + torch.sin(theta) * self.fwd_step
+        else:
+            raise ValueError('undefined action name %s' % action)
+        noise = torch.randn((self.n, 3), dtype=self.dtype, device=self.device)
+        self.particles = torch.stack((x + noise[:, 0] * self.sigma_xy,
+                                      y + noise[:, 1] * self.sigma_xy,
+                                      wrap_t(theta + noise[:, 2] * self.sigma_theta)), dim=1)
+
+    def map_index(self, x, y):
+        # flat map cell of the points (x, y), clipped to the map as utils.to_index
+        rows, cols = self.map_shape
+        i = torch.floor(rows * (self.xlim[1] - x) / (self.xlim[1] - self.xlim[0])).clamp(0, rows - 1).long()
+        j = torch.floor(cols * (self.ylim[1] - y) / (self.ylim[1] - self.ylim[0])).clamp(0, cols - 1).long()
+        return i * cols + j
+
+    def cells(self):
+        # (n_particles, 3): head, row, col of each particle on the localization grid, as update_true_grid
+        dirs, rows, cols = self.shape
+        x, y, theta = self.particles.unbind(1)
+        head = torch.floor(dirs * torch.remainder(theta + math.pi / dirs, 2 * math.pi) / (2 * math.pi)).long() % dirs
+        row = torch.floor(rows * (self.xlim[1] - x) / (self.xlim[1] - self.xlim[0])).clamp(0, rows - 1).long()
+        col = torch.floor(cols * (self.ylim[1] - y) / (self.ylim[1] - self.ylim[0])).clamp(0, cols - 1).long()
+        return torch.stack((head, row, col), dim=1)
+
+    def update(self, ranges, angle_min, angle_max, range_max):
+        # ranges of one scan, bearings from angle_min to angle_max. n_beams of the rays that hit
+        # something (finite and short of range_max), evenly spread, are scored at once for all particles
+        ranges = np.asarray(ranges, dtype=float)
+        bearings = np.linspace(angle_min, angle_max, len(ranges))
+        with np.errstate(invalid='ignore'):
+            hit = np.flatnonzero(np.isfinite(ranges) & (ranges < range_max))
+        if len(hit) == 0:
+            return
+        beams = hit[np.linspace(0, len(hit) - 1, min(self.n_beams, len(hit))).astype(int)]
+        r = torch.tensor(ranges[beams], dtype=self.dtype, device=self.device)
+        b = torch.tensor(bearings[beams], dtype=self.dtype, device=self.device)
+        x, y, theta = self.particles.unbind(1)
+        angle = theta[:, None] + b[None, :]
+        ends = self.map_index(x[:, None] + r * torch.cos(angle), y[:, None] + r * torch.sin(angle))
+        self.log_w = self.log_w + self.log_field[ends].sum(dim=1) + self.log_wall[self.map_index(x, y)]
+        self.normalize()
+
+    def update_grid(self, likelihood):
+        # likelihood (grid_dirs, rows, cols), e.g. the output of the LM or the GTL
+        head, row, col = self.cells().unbind(1)
+        lik = likelihood.detach().to(self.dtype)[head, row, col]
+        x, y, _ = self.particles.unbind(1)
+        self.log_w = self.log_w + torch.log(torch.clamp(lik, min=1e-30)) + self.log_wall[self.map_index(x, y)]
+        self.normalize()
+
+    def normalize(self):
+        self.log_w = self.log_w - torch.logsumexp(self.log_w, dim=0)
+        if 1.0 / torch.exp(2 * self.log_w).sum() < self.resample_ratio * self.n:
+            self.resample()
+
+    def resample(self):
+        # low variance (systematic) resampling: one random offset, n evenly spaced pointers into the cdf
+        cdf = torch.cumsum(torch.exp(self.log_w), dim=0)
+        pointers = (torch.rand(1, dtype=self.dtype, device=self.device)
+                    + torch.arange(self.n, dtype=self.dtype, device=self.device)) / self.n
+        pick = torch.searchsorted(cdf, pointers * cdf[-1]).clamp(max=self.n - 1)
+        self.particles = self.particles[pick]
+        self.log_w = torch.full((self.n,), -math.log(self.n), dtype=self.dtype, device=self.device)
+
+    def histogram(self):
+        # (grid_dirs, rows, cols) belief: the weights summed per cell, mixed with a uniform floor
+        dirs, rows, cols = self.shape
+        head, row, col = self.cells().unbind(1)
+        bel = torch.zeros(dirs * rows * cols, dtype=self.dtype, device=self.device)
+        bel.index_add_(0, (head * rows + row) * cols + col, torch.exp(self.log_w))
+        bel = (1 - self.floor) * bel / bel.sum() + self.floor / bel.numel()
+        return bel.view(self.shape)
+
+
+if __name__ == "__main__":
+    # tracking on the SAIT map from a uniform start, 4 and 36 headings
+    import os
+    import time
+    from raycast import cast_scan
+    map_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps', 'mlab-02-map-224x224.npy')
+    map_img = np.load(map_file)
+    xlim = ylim = (-4.48, 4.48)
+    scan_range = (0.1, 3.5)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    # low variance resampling keeps the counts within one of n * w
+    pf = ParticleFilter(1000, 4, 11, 11, xlim, ylim, 0.8, np.pi / 2)
+    pf.particles = torch.arange(1000, dtype=torch.float32)[:, None].repeat(1, 3)
+    w = torch.tensor([0.5, 0.3, 0.2] + [0.0] * 997)
+    pf.log_w = torch.log(w)
+    pf.resample()
+    counts = np.bincount(pf.particles[:, 0].long().numpy(), minlength=3)[:3]
+    assert (np.abs(counts - np.array([500, 300, 200])) <= 1).all(), counts
+
+    def wall_ahead(x, y, theta, dist):
+        for d in np.linspace(0.05, dist, 10):
+            i = int(np.clip(np.floor(224 * (xlim[1] - (x + d * np.cos(theta))) / 8.96), 0, 223))
+            j = int(np.clip(np.floor(224 * (ylim[1] - (y + d * np.sin(theta))) / 8.96), 0, 223))
+            if map_img[i, j] >= 0.5:
+                return True
+        return False
+
+    for dirs, grid in [(4, 11), (36, 33)]:
+        cell = 8.96 / grid
+        pf = ParticleFilter(5000, dirs, grid, grid, xlim, ylim, cell, 2 * np.pi / dirs, process_error=(0.02, 0.02))
+        pf.set_map(map_img)
+        pf.reset()
+        free = np.argwhere(map_img < 0.5)
+        while True:
+            i, j = free[np.random.randint(len(free))]
+            x, y = xlim[1] - (i + 0.5) * 8.96 / 224, ylim[1] - (j + 0.5) * 8.96 / 224
+            if not any(wall_ahead(x, y, t, 0.4) for t in np.linspace(0, 2 * np.pi, 8, endpoint=False)):
+                break
+        theta = 0.0
+        t_step = 0
+        for step in range(30):
+            ranges = cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=theta, method='dda')
+            mark = time.time()
+            pf.update(ranges, 0.0, np.radians(359), scan_range[1])
+            bel = pf.histogram()
+            t_step += time.time() - mark
+            if wall_ahead(x, y, theta, cell + 0.3):
+                action = 'turn_left'
+                theta = float(wrap_t(torch.tensor(theta + 2 * np.pi / dirs)))
+            else:
+                action = 'go_fwd'
+                x, y = x + np.cos(theta) * cell, y + np.sin(theta) * cell
+            mark = time.time()
+            pf.predict(action)
+            t_step += time.time() - mark
+        ranges = cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=theta, method='dda')
+        pf.update(ranges, 0.0, np.radians(359), scan_range[1])
+        bel = pf.histogram()
+        guess = np.unravel_index(int(torch.argmax(bel)), bel.shape)
+        true_row = int(np.floor(grid * (xlim[1] - x) / 8.96))
+        true_col = int(np.floor(grid * (ylim[1] - y) / 8.96))
+        true_head = int(np.floor(dirs * ((theta + np.pi / dirs) % (2 * np.pi)) / (2 * np.pi))) % dirs
+        err = min(abs(guess[0] - true_head), dirs - abs(guess[0] - true_head)) + abs(guess[1] - true_row) + abs(guess[2] - true_col)
+        print('%d headings, %dx%d grid: %.4f sec per step, manhattan error %d, belief at the truth %.3f'
+              % (dirs, grid, grid, t_step / 30, err, bel[true_head, true_row, true_col].item()))
+        assert np.isclose(bel.sum().item(), 1.0, atol=1e-4) and (bel > 0).all()
+        assert err <= 2, (guess, (true_head, true_row, true_col))
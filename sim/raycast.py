@@ -0,0 +1,308 @@
+import math
+import time
+import numpy as np
+from scipy import ndimage
+
+from utils import to_index, to_index_array
+
+
+def ray_bearings(scan_step=1, fov=None):
+    # bearings (deg) of the rays to cast, and of those in the fov gap (fov[0], fov[1])
+    bearings = np.arange(0, 360, scan_step)
+    if fov is None:
+        return bearings, bearings[:0]
+    gap = (bearings > fov[0]) & (bearings < fov[1])
+    return bearings[~gap], bearings[gap]
+
+
+def march_rays(map_img, x, y, theta, xlim, ylim, scan_range, jitter=True):
+    # march all rays at once, 1~2 cm per probe (fixed 1.5 cm if not jitter).
+    # x, y, theta: broadcastable arrays, one ray per element.
+    # returns the hit distance of each ray, inf if nothing within scan_range.
+    x, y, theta = np.broadcast_arrays(np.asarray(x, dtype=float),
+                                      np.asarray(y, dtype=float),
+                                      np.asarray(theta, dtype=float))
+    shape = theta.shape
+    x = x.ravel()
+    y = y.ravel()
+    cos = np.cos(theta.ravel())
+    sin = np.sin(theta.ravel())
+    rows, cols = map_img.shape
+    min_range, max_range = scan_range
+
+    ranges = np.full(cos.size, np.inf)
+    dist = np.full(cos.size, float(min_range))
+    active = np.arange(cos.size)
+    while active.size > 0:
+        active = active[dist[active] < max_range]
+        d = dist[active]
+        i_prb = to_index_array(x[active] + d * cos[active], rows, xlim)
+        j_prb = to_index_array(y[active] + d * sin[active], cols, ylim)
+        hit = map_img[i_prb, j_prb] >= 0.5
+        ranges[active[hit]] = d[hit]
+        active = active[~hit]
+        if jitter:
+            dist[active] += 0.01 + 0.01 * np.random.rand(active.size)
+        else:
+            dist[active] += 0.015
+    return ranges.reshape(shape)
+
+
+def dda_rays(map_img, x, y, theta, xlim, ylim, scan_range):
+    # exact grid traversal (Amanatides & Woo) of all rays at once, one map cell per iteration.
+    # returns the distance at which each ray enters the first occupied cell (>= 0.5),
+    # inf if it leaves the map or scan_range first. deterministic.
+    x, y, theta = np.broadcast_arrays(np.asarray(x, dtype=float),
+                                      np.asarray(y, dtype=float),
+                                      np.asarray(theta, dtype=float))
+    shape = theta.shape
+    rows, cols = map_img.shape
+    min_range, max_range = scan_range
+    # continuous cell coordinates: row index grows as x decreases, col index as y decreases
+    su = rows / float(xlim[1] - xlim[0])
+    sv = cols / float(ylim[1] - ylim[0])
+    du = -np.cos(theta.ravel()) * su
+    dv = -np.sin(theta.ravel()) * sv
+    u = (xlim[1] - x.ravel()) * su + min_range * du
+    v = (ylim[1] - y.ravel()) * sv + min_range * dv
+
+    i = np.floor(u).astype(int)
+    j = np.floor(v).astype(int)
+    step_i = np.where(du > 0, 1, -1)
+    step_j = np.where(dv > 0, 1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta_i = np.where(du != 0, 1.0 / np.abs(du), np.inf)
+        delta_j = np.where(dv != 0, 1.0 / np.abs(dv), np.inf)
+        next_i = np.where(du > 0, i + 1 - u, u - i) * delta_i
+        next_j = np.where(dv > 0, j + 1 - v, v - j) * delta_j
+    next_i = np.where(du != 0, min_range + next_i, np.inf)
+    next_j = np.where(dv != 0, min_range + next_j, np.inf)
+    t = np.full(theta.size, float(min_range))
+
+    ranges = np.full(theta.size, np.inf)
+    active = np.arange(theta.size)
+    while active.size > 0:
+        ia = i[active]
+        ja = j[active]
+        inside = (t[active] < max_range) & (ia >= 0) & (ia < rows) & (ja >= 0) & (ja < cols)
+        active = active[inside]
+        hit = map_img[ia[inside], ja[inside]] >= 0.5
+        ranges[active[hit]] = t[active[hit]]
+        active = active[~hit]
+
+        # step into the next cell across the nearer boundary
+        cross_i = next_i[active] < next_j[active]
+        a = active[cross_i]
+        t[a] = next_i[a]
+        i[a] += step_i[a]
+        next_i[a] += delta_i[a]
+        a = active[~cross_i]
+        t[a] = next_j[a]
+        j[a] += step_j[a]
+        next_j[a] += delta_j[a]
+    return ranges.reshape(shape)
+
+
+def clearance_map(map_img, xlim, ylim):
+    # distance (m) from each cell center to the nearest occupied cell center, 0 on occupied cells.
+    # once per map, it is what edt_rays jumps by.
+    rows, cols = map_img.shape
+    free = map_img < 0.5
+    if free.all():
+        return np.full(map_img.shape, np.inf)
+    return ndimage.distance_transform_edt(free, sampling=((xlim[1] - xlim[0]) / float(rows),
+                                                          (ylim[1] - ylim[0]) / float(cols)))
+
+
+def edt_rays(map_img, x, y, theta, xlim, ylim, scan_range, jitter=True, clearance=None):
+    # sphere tracing: every probe jumps by the clearance around it, less one cell diagonal
+    # so that no occupied cell is skipped, and by 1~2 cm like march_rays near the walls.
+    # same hit test and ranges as march_rays, with far fewer probes in open space.
+    x, y, theta = np.broadcast_arrays(np.asarray(x, dtype=float),
+                                      np.asarray(y, dtype=float),
+                                      np.asarray(theta, dtype=float))
+    shape = theta.shape
+    x = x.ravel()
+    y = y.ravel()
+    cos = np.cos(theta.ravel())
+    sin = np.sin(theta.ravel())
+    rows, cols = map_img.shape
+    min_range, max_range = scan_range
+    if clearance is None:
+        clearance = clearance_map(map_img, xlim, ylim)
+    margin = np.hypot((xlim[1] - xlim[0]) / float(rows), (ylim[1] - ylim[0]) / float(cols))
+
+    ranges = np.full(cos.size, np.inf)
+    dist = np.full(cos.size, float(min_range))
+    active = np.arange(cos.size)
+    while active.size > 0:
+        active = active[dist[active] < max_range]
+        d = dist[active]
+        x_prb = x[active] + d * cos[active]
+        y_prb = y[active] + d * sin[active]
+        i_prb = to_index_array(x_prb, rows, xlim)
+        j_prb = to_index_array(y_prb, cols, ylim)
+        hit = map_img[i_prb, j_prb] >= 0.5
+        ranges[active[hit]] = d[hit]
+        miss = ~hit
+        active = active[miss]
+        # no jumps off the map, where probes are clipped to the border cells
+        inside = ((x_prb[miss] > xlim[0]) & (x_prb[miss] < xlim[1])
+                  & (y_prb[miss] > ylim[0]) & (y_prb[miss] < ylim[1]))
+        jump = np.where(inside, clearance[i_prb[miss], j_prb[miss]] - margin, 0)
+        if jitter:
+            dist[active] += np.maximum(jump, 0.01 + 0.01 * np.random.rand(active.size))
+        else:
+            dist[active] += np.maximum(jump, 0.015)
+    return ranges.reshape(shape)
+
+
+RAYCASTERS = {'march': march_rays, 'dda': dda_rays, 'edt': edt_rays}
+
+
+def add_scan_noise(scan, noise=0, sigma=0, scan_step=1):
+    # sensor noise, kept apart from ray casting: 'noise' random rays go missing (inf),
+    # and gaussian noise of scale sigma is added to the ranges of the cast rays.
+    scan = np.array(scan, dtype=float)
+    missing = np.random.choice(360, noise, replace=False)
+    gaussian_noise = np.random.normal(scale=sigma, size=360)
+    bearings = np.arange(0, 360, scan_step)
+    missing = missing[(missing % scan_step == 0) & ~np.isnan(scan[missing])]
+    scan[missing] = np.inf
+    scan[bearings] += gaussian_noise[bearings]
+    return scan
+
+
+def _cast(method, map_img, x, y, theta, xlim, ylim, scan_range, clearance=None):
+    if method == 'edt':
+        return edt_rays(map_img, x, y, theta, xlim, ylim, scan_range, clearance=clearance)
+    return RAYCASTERS[method](map_img, x, y, theta, xlim, ylim, scan_range)
+
+
+def cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=0, scan_step=1,
+              noise=0, sigma=0, fov=None, method='march', clearance=None):
+    # a 360-ray scan at (x, y) heading offset. same layout as LocalizationNode.get_a_scan:
+    # rays not cast (scan_step) are 0, rays in the fov gap are nan, 'noise' random rays are inf.
+    # clearance: clearance_map of map_img for method 'edt', computed here if not given.
+    scan = np.zeros(360)
+    bearings, gap = ray_bearings(scan_step, fov)
+    scan[gap] = np.nan
+    theta = np.radians(bearings) + offset
+    scan[bearings] = _cast(method, map_img, x, y, theta, xlim, ylim, scan_range, clearance)
+    if noise > 0 or sigma > 0:
+        scan = add_scan_noise(scan, noise=noise, sigma=sigma, scan_step=scan_step)
+    return scan
+
+
+def cast_scans(map_img, xs, ys, xlim, ylim, scan_range, offset=0, scan_step=1, fov=None,
+               method='march', clearance=None):
+    # noise-free scans from many places in one go. returns (len(xs), 360)
+    xs = np.asarray(xs, dtype=float).reshape(-1, 1)
+    ys = np.asarray(ys, dtype=float).reshape(-1, 1)
+    scans = np.zeros((xs.shape[0], 360))
+    bearings, gap = ray_bearings(scan_step, fov)
+    scans[:, gap] = np.nan
+    theta = np.radians(bearings)[np.newaxis, :] + offset
+    scans[:, bearings] = _cast(method, map_img, xs, ys, theta, xlim, ylim, scan_range, clearance)
+    return scans
+
+
+def march_a_scan_loop(map_img, x, y, xlim, ylim, scan_range, offset=0, scan_step=1, fov=None):
+    # the original ray-by-ray marching. kept as the reference for the parity check below.
+    rows, cols = map_img.shape
+    min_range, max_range = scan_range
+    scan = np.zeros(360)
+    for i_ray in range(0, 360, scan_step):
+        if fov is not None and i_ray > fov[0] and i_ray < fov[1]:
+            scan[i_ray] = np.nan
+            continue
+        theta = math.radians(i_ray) + offset
+        dist = min_range
+        while True:
+            if dist >= max_range:
+                dist = np.inf
+                break
+            i_prb = to_index(x + dist * np.cos(theta), rows, xlim)
+            j_prb = to_index(y + dist * np.sin(theta), cols, ylim)
+            if map_img[i_prb, j_prb] >= 0.5:
+                break
+            dist += 0.01 + 0.01 * (np.random.rand())
+        scan[i_ray] = dist
+    return scan
+
+
+def bench_scans_over_map(name, map_img, xlim, ylim, scan_range, n_grids=11):
+    # one scan per low-dim cell, as in get_synth_scan_mp, with each caster
+    rows, cols = map_img.shape
+    places = np.arange(n_grids * n_grids)
+    xs = xlim[1] - (places // n_grids + 0.5) * (xlim[1] - xlim[0]) / n_grids
+    ys = ylim[1] - (places % n_grids + 0.5) * (ylim[1] - ylim[0]) / n_grids
+    mark = time.time()
+    clearance = clearance_map(map_img, xlim, ylim)
+    t_edt_map = time.time() - mark
+    out = {}
+    for method in ['march', 'edt', 'dda']:
+        mark = time.time()
+        out[method] = cast_scans(map_img, xs, ys, xlim, ylim, scan_range, method=method,
+                                 clearance=clearance)
+        out[method + '_t'] = time.time() - mark
+    exact = np.clip(out['dda'], 0, scan_range[1])
+    err = {m: np.mean(np.abs(np.clip(out[m], 0, scan_range[1]) - exact)) for m in ['march', 'edt']}
+    print('%-10s march %.3f sec, edt %.3f sec (+%.3f sec clearance map), dda %.3f sec'
+          % (name, out['march_t'], out['edt_t'], t_edt_map, out['dda_t']))
+    print('%-10s mean |range - exact|: march %.4f m, edt %.4f m' % ('', err['march'], err['edt']))
+
+
+if __name__ == "__main__":
+    # time of cast_scan with each caster against the ray-by-ray loop on the SAIT map (parity: test_raycast.py),
+    # then scans_over_map with each caster on maze, randombox and the loaded map.
+    import os
+    map_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps', 'mlab-02-map-224x224.npy')
+    map_img = np.load(map_file)
+    map_pixel = 0.04
+    side = 224 * map_pixel
+    xlim = np.array((-0.5 * side, 0.5 * side))
+    ylim = np.array((-0.5 * side, 0.5 * side))
+    scan_range = (0.1, 3.5)
+    fov = (130, 230)
+    clearance = clearance_map(map_img, xlim, ylim)
+
+    free = np.argwhere(map_img < 0.5)
+    picks = free[np.random.choice(len(free), 20, replace=False)]
+    t_loop = 0
+    t_vec = 0
+    t_dda = 0
+    t_edt = 0
+    for i, j in picks:
+        x = xlim[1] - (i + 0.5) * map_pixel
+        y = ylim[1] - (j + 0.5) * map_pixel
+        offset = 2 * np.pi * np.random.rand()
+        mark = time.time()
+        march_a_scan_loop(map_img, x, y, xlim, ylim, scan_range, offset=offset, fov=fov)
+        t_loop += time.time() - mark
+        mark = time.time()
+        cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=offset, fov=fov)
+        t_vec += time.time() - mark
+        mark = time.time()
+        cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=offset, fov=fov, method='dda')
+        t_dda += time.time() - mark
+        mark = time.time()
+        cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=offset, fov=fov, method='edt', clearance=clearance)
+        t_edt += time.time() - mark
+    print('loop %.3f sec, vectorized %.3f sec, dda %.3f sec, edt %.3f sec per scan'
+          % (t_loop / len(picks), t_vec / len(picks), t_dda / len(picks), t_edt / len(picks)))
+
+    import cv2
+    from maze import generate_map
+    maze = generate_map(11, 10)
+    maze = cv2.resize(maze, (224, 224), interpolation=cv2.INTER_NEAREST)
+    bench_scans_over_map('maze', maze, xlim, ylim, scan_range)
+    try:
+        from random_box_map import PartitionSpace
+        ps = PartitionSpace(rooms_row=(2, 3), rooms_col=(1, 3), slant_scale=2, n_boxes=(1, 8),
+                            thick=50, thick_scale=3)
+        ps.connect_rooms(p_open=1.0)
+        bench_scans_over_map('randombox', ps.get_map(224, 224), xlim, ylim, scan_range)
+    except Exception as e:
+        print('randombox skipped: %s' % e)
+    bench_scans_over_map(os.path.basename(map_file), map_img, xlim, ylim, scan_range)
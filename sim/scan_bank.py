@@ -0,0 +1,115 @@
+import os
+import hashlib
+import numpy as np
+
+
+# how a bank of reference scans (rows, cols, 360) is stored. float64 as computed,
+# float16 ranges (about 1 mm at 3.5 m), or uint16 millimetres: a quarter of the memory either way
+SCAN_DTYPES = {'float64': np.float64, 'float16': np.float16, 'mm': np.uint16}
+# uint16 codes of the rays that are not numbers
+MM_INF = 65535
+MM_NAN = 65534
+
+
+def scan_array(shape, storage='float64'):
+    return np.zeros(shape, dtype=SCAN_DTYPES[storage])
+
+
+def encode_scans(ranges, dtype):
+    # ranges in metres to a bank of the given dtype
+    dtype = np.dtype(dtype)
+    if dtype != np.uint16:
+        return np.asarray(ranges).astype(dtype)
+    ranges = np.asarray(ranges, dtype=float)
+    with np.errstate(invalid='ignore'):
+        mm = np.round(np.clip(ranges * 1000.0, 0, MM_NAN - 1))
+    mm[np.isposinf(ranges)] = MM_INF
+    mm[np.isnan(ranges)] = MM_NAN
+    return mm.astype(np.uint16)
+
+
+def decode_scans(scans):
+    # ranges in metres of a bank in any of SCAN_DTYPES. float64 is returned as is,
+    # the compact ones as float32 (so a chunk of the bank is decoded at a time where it is read)
+    scans = np.asarray(scans)
+    if scans.dtype == np.float64:
+        return scans
+    if scans.dtype != np.uint16:
+        return scans.astype(np.float32)
+    ranges = scans.astype(np.float32) * np.float32(0.001)
+    ranges[scans == MM_INF] = np.inf
+    ranges[scans == MM_NAN] = np.nan
+    return ranges
+
+
+def scan_bank_key(map_img, grid_rows, grid_cols, xlim, ylim, scan_step, scan_range, method='march',
+                  storage='float64'):
+    # content address of scans_over_map: everything get_synth_scan_mp depends on, and how it is stored
+    h = hashlib.sha1()
+    map_img = np.ascontiguousarray(map_img, dtype=np.float64)
+    h.update(str(map_img.shape).encode())
+    h.update(map_img.tobytes())
+    params = (grid_rows, grid_cols, tuple(np.asarray(xlim, dtype=float)), tuple(np.asarray(ylim, dtype=float)),
+              scan_step, tuple(float(r) for r in scan_range), method)
+    if storage != 'float64':
+        # the float64 keys of existing caches stay as they were
+        params += (storage,)
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+def scan_bank_path(cache_dir, key):
+    return os.path.join(cache_dir, 'scans-%s.npy' % key)
+
+
+def load_scan_bank(cache_dir, key):
+    # memory-mapped (read-only) bank, or None on a miss
+    path = scan_bank_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def save_scan_bank(cache_dir, key, scans):
+    # write to a temp file and rename, so that concurrent runs never read half a bank
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path = scan_bank_path(cache_dir, key)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, scans)
+    os.rename(tmp, path)
+    return path
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import tempfile
+    map_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps', 'mlab-02-map-224x224.npy')
+    map_img = np.load(map_file)
+    xlim = ylim = (-4.48, 4.48)
+    scans = np.random.rand(33, 33, 360)
+    cache_dir = tempfile.mkdtemp() if len(sys.argv) < 2 else sys.argv[1]
+    key = scan_bank_key(map_img, 33, 33, xlim, ylim, 1, (0.1, 3.5))
+    assert load_scan_bank(cache_dir, key) is None
+    save_scan_bank(cache_dir, key, scans)
+    mark = time.time()
+    bank = load_scan_bank(cache_dir, key)
+    print('hit in %.4f sec: %s' % (time.time() - mark, scan_bank_path(cache_dir, key)))
+    assert (bank == scans).all()
+    map_img[0, 0] = 1 - map_img[0, 0]
+    assert scan_bank_key(map_img, 33, 33, xlim, ylim, 1, (0.1, 3.5)) != key
+    assert scan_bank_key(map_img, 33, 33, xlim, ylim, 2, (0.1, 3.5)) != scan_bank_key(map_img, 33, 33, xlim, ylim, 1, (0.1, 3.5))
+    assert scan_bank_key(map_img, 33, 33, xlim, ylim, 1, (0.1, 3.5), storage='mm') != scan_bank_key(map_img, 33, 33, xlim, ylim, 1, (0.1, 3.5))
+
+    # compact storage: error against the float64 ranges, and the memory of a 224x224 bank
+    ranges = np.random.uniform(0.1, 3.5, (33, 33, 360))
+    ranges[0, 0, :3] = [np.inf, np.nan, 0.1]
+    for storage in ['float64', 'float16', 'mm']:
+        bank = encode_scans(ranges, SCAN_DTYPES[storage])
+        back = decode_scans(bank)
+        with np.errstate(invalid='ignore'):
+            err = np.nanmax(np.abs(np.where(np.isfinite(ranges), back - ranges, 0)))
+        print('%-7s max error %.2e m, 224x224x360 bank %.0f MB' % (storage, err, scan_array((224, 224, 360), storage).nbytes / 1e6))
+        assert np.isposinf(back[0, 0, 0]) and np.isnan(back[0, 0, 1]) and err < 2e-3
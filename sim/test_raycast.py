@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pytest
+
+from raycast import cast_scan, clearance_map, march_a_scan_loop
+
+# the casters against the ray-by-ray loop on the SAIT map, from 20 free pixels picked with a fixed seed
+map_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'maps', 'mlab-02-map-224x224.npy')
+map_pixel = 0.04
+xlim = ylim = np.array((-0.5, 0.5)) * 224 * map_pixel
+scan_range = (0.1, 3.5)
+fov = (130, 230)
+# a march probes every 1~2 cm, so it stops at most one step past a hit
+step = 0.02 + 1e-9
+
+
+@pytest.fixture(scope='module')
+def scans():
+    rng = np.random.RandomState(0)
+    map_img = np.load(map_file)
+    clearance = clearance_map(map_img, xlim, ylim)
+    free = np.argwhere(map_img < 0.5)
+    out = {'loop': [], 'march': [], 'dda': [], 'edt': []}
+    for i, j in free[rng.choice(len(free), 20, replace=False)]:
+        x = xlim[1] - (i + 0.5) * map_pixel
+        y = ylim[1] - (j + 0.5) * map_pixel
+        offset = 2 * np.pi * rng.rand()
+        # march and edt jitter their probe steps
+        np.random.seed(rng.randint(2 ** 31))
+        out['loop'].append(march_a_scan_loop(map_img, x, y, xlim, ylim, scan_range, offset=offset, fov=fov))
+        out['march'].append(cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=offset, fov=fov))
+        out['dda'].append(cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=offset, fov=fov, method='dda'))
+        out['edt'].append(cast_scan(map_img, x, y, xlim, ylim, scan_range, offset=offset, fov=fov, method='edt',
+                                    clearance=clearance))
+    return {k: np.array(v) for k, v in out.items()}
+
+
+def cast_rays(scans, method):
+    # the rays cast (not in the fov gap) of the loop and of a caster, clipped at the max range
+    ref = scans['loop']
+    out = scans[method]
+    assert (np.isnan(ref) == np.isnan(out)).all()
+    cast = ~np.isnan(ref)
+    return np.clip(ref[cast], 0, scan_range[1]), np.clip(out[cast], 0, scan_range[1])
+
+
+def test_march(scans):
+    # two marches agree within one probe step
+    ref, out = cast_rays(scans, 'march')
+    assert np.mean(np.abs(ref - out) <= step) >= 0.98
+
+
+def test_dda(scans):
+    # dda gives the exact cell boundary, which the loop reaches or passes by one step at most
+    ref, exact = cast_rays(scans, 'dda')
+    assert np.mean((ref - exact >= -1e-9) & (ref - exact <= step)) >= 0.98
+
+
+def test_edt(scans):
+    # edt marches like the loop, but with steps no longer than the clearance
+    _, exact = cast_rays(scans, 'dda')
+    _, traced = cast_rays(scans, 'edt')
+    assert np.mean((traced - exact >= -1e-9) & (traced - exact <= step)) >= 0.98
@@ -14,6 +14,79 @@ def to_index(a, N, mm):
     a_min = mm[0]
     return int(np.clip(np.floor(N*(a_max-a)/(a_max-a_min)), 0, N-1))
 
+def to_index_array(a, N, mm):
+    # same as to_index, for numpy arrays
+    a_max = mm[1]
+    a_min = mm[0]
+    return np.clip(np.floor(N*(a_max-np.asarray(a))/(a_max-a_min)), 0, N-1).astype(int)
+
+def collisions(x, y, rad, img, xlim, ylim):
+    # LocalizationNode.collision_fnc for arrays of points at once:
+    # True where a map cell within rad of (x, y) is occupied (== 1.0), or the cell at (x, y) is (> 0.5) if rad == 0
+    rows, cols = img.shape
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x0 = to_index_array(x+rad, rows, xlim)
+    y0 = to_index_array(y+rad, cols, ylim)
+    x1 = to_index_array(x-rad, rows, xlim)
+    y1 = to_index_array(y-rad, cols, ylim)
+    if rad == 0:
+        return img[x0, y0] > 0.5
+    hit = np.zeros(x.shape, dtype=bool)
+    for di in range(int((x1-x0).max())+1):
+        for dj in range(int((y1-y0).max())+1):
+            ir = np.minimum(x0+di, rows-1)
+            ic = np.minimum(y0+dj, cols-1)
+            dist = np.sqrt((to_real(ir, xlim, rows)-x)**2 + (to_real(ic, ylim, cols)-y)**2)
+            hit |= (x0+di <= x1) & (y0+dj <= y1) & (dist <= rad) & (img[ir, ic] == 1.0)
+    return hit
+
+def grid_free_mask(img, grid_rows, grid_cols, rad, xlim, ylim):
+    # (grid_rows, grid_cols) True where the center of the grid cell is clear of obstacles within rad
+    x = to_real(np.arange(grid_rows), xlim, grid_rows)[:, np.newaxis]
+    y = to_real(np.arange(grid_cols), ylim, grid_cols)[np.newaxis, :]
+    x, y = np.broadcast_arrays(x, y)
+    return ~collisions(x, y, rad, img, xlim, ylim)
+
+def scan_2d_points(ranges, angle_min, angle_max, n_dirs, shape, xlim, ylim, fov):
+    # scan end points as (heading, row, col) pixel indices of a (n_dirs, rows, cols) image,
+    # the scan rotated by each heading. rays that are not numbers or fall in the fov gap are left out,
+    # and so is column 0. at most n_dirs x (number of rays) points, duplicates included.
+    ranges = np.asarray(ranges, dtype=float)
+    rows, cols = shape
+    angles = np.linspace(angle_min, angle_max, ranges.size, endpoint=False)
+    angle = (2*np.pi/n_dirs*np.arange(n_dirs))[:, np.newaxis] + angles[np.newaxis, :]
+    keep = ~((angle > np.radians(fov[0])) & (angle < np.radians(fov[1]))) & np.isfinite(ranges)[np.newaxis, :]
+    rotate, ray = np.nonzero(keep)
+    n = to_index_array(ranges[ray]*np.cos(angle[rotate, ray]), rows, xlim)
+    m = to_index_array(ranges[ray]*np.sin(angle[rotate, ray]), cols, ylim)
+    inside = m > 0
+    return rotate[inside], n[inside], m[inside]
+
+
+def scan_2d_n_headings(ranges, angle_min, angle_max, n_dirs, shape, xlim, ylim, fov, out=None, points=None):
+    # the scan_2d_points as a 0/1 image. out: an image of that shape to refill in place instead of
+    # allocating one. points: the scan_2d_points of this scan when they are already at hand
+    rows, cols = shape
+    if points is None:
+        points = scan_2d_points(ranges, angle_min, angle_max, n_dirs, shape, xlim, ylim, fov)
+    if out is None or out.shape != (n_dirs, rows, cols):
+        out = np.zeros((n_dirs, rows, cols))
+    else:
+        out.fill(0)
+    out[points] = 1.0
+    return out
+
+
+def slide_scan_img(scan_img, front, side, out=None):
+    # a 0/1 scan image dilated down the rows by front pixels and across the columns by side pixels,
+    # the top and side borders counted as hits: the sum of front row shifts and 2*side column shifts
+    # (each filled with 1.0) clipped to [0, 1], as one dilation. out: an image to refill in place
+    kernel = np.ones((front+1, 2*side+1), np.uint8)
+    return cv2.dilate(scan_img, kernel, dst=out, anchor=(side, front),
+                      borderType=cv2.BORDER_CONSTANT, borderValue=1.0)
+
+
 def grid_cell_to_map_cell(i,j, n_bel, n_map):
     x = to_real(i, [-1.0,1.0], n_bel)
     y = to_real(j, [-1.0,1.0], n_bel)